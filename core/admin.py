@@ -1,12 +1,37 @@
+import io
+
 from django.contrib import admin
-from django.core.exceptions import ValidationError
+from django.contrib import messages
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from . import models
+from .dedupe import dismiss_duplicates, merge_patients
+from .forms import PatientImportForm
+from .patient_import import import_patients, read_spreadsheet, reject_writer
+from .reconciliation import reconcile_bills, reconcile_patient_balances
 
 # Helper: group check
 def in_group(user, name):
     return user.is_superuser or user.groups.filter(name=name).exists()
 
 
+# Helper: run a reconciliation check over the selected rows and report the result
+def report_reconciliation(modeladmin, request, check, queryset, fix):
+    found = list(check(queryset=queryset, fix=fix))
+    if not found:
+        modeladmin.message_user(request, "No mismatches found.", messages.SUCCESS)
+        return
+    shown = "; ".join(f"{m.label or m.pk} {m.field}: {m.stored} -> {m.expected}" for m in found[:20])
+    more = f" (+{len(found) - 20} more)" if len(found) > 20 else ""
+    verb = "Repaired" if fix else "Found"
+    modeladmin.message_user(request, f"{verb} {len(found)} mismatch(es): {shown}{more}",
+                            messages.SUCCESS if fix else messages.WARNING)
+
+
 # ==========================
 # USER MANAGEMENT
 # ==========================
@@ -31,6 +56,54 @@ class PatientAdmin(admin.ModelAdmin):
     list_display = ("file_number", "name", "phone_number", "city", "balance", "is_active")
     list_filter = ("is_active", "gender", "created_at")
     search_fields = ("name", "file_number", "phone_number", "email", "city", "district")
+    actions = ["check_balances", "repair_balances"]
+    change_list_template = "admin/core/patient/change_list.html"
+
+    def get_urls(self):
+        return [
+            path("import/", self.admin_site.admin_view(self.import_view), name="core_patient_import"),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """Upload a CSV/XLSX of patients; the rejected rows come back as a CSV download."""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = PatientImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            upload = form.cleaned_data["file"]
+            rejects = io.StringIO()
+            try:
+                header, rows = read_spreadsheet(upload, upload.name)
+                imported, rejected = import_patients(header, rows, user=request.user,
+                                                     on_reject=reject_writer(rejects, header))
+            except ImportError:
+                form.add_error("file", "XLSX import needs openpyxl; save the sheet as CSV.")
+            except ValueError as e:
+                form.add_error("file", str(e))
+            else:
+                self.message_user(request, f"Imported {imported} patient(s).", messages.SUCCESS)
+                if rejected:
+                    self.message_user(request, f"{rejected} row(s) rejected; their errors are in the downloaded file.",
+                                      messages.WARNING)
+                    response = HttpResponse(rejects.getvalue(), content_type="text/csv; charset=utf-8")
+                    response["Content-Disposition"] = 'attachment; filename="patients.rejects.csv"'
+                    return response
+                return redirect("admin:core_patient_changelist")
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Import patients",
+            "form": form,
+        }
+        return TemplateResponse(request, "admin/core/patient/import.html", context)
+
+    def check_balances(self, request, queryset):
+        report_reconciliation(self, request, reconcile_patient_balances, queryset, fix=False)
+    check_balances.short_description = "Check balances against bills and payments"
+
+    def repair_balances(self, request, queryset):
+        report_reconciliation(self, request, reconcile_patient_balances, queryset, fix=True)
+    repair_balances.short_description = "Repair balances from bills and payments"
 
 
 @admin.register(models.PatientMedicalHistory)
@@ -199,6 +272,15 @@ class BillAdmin(admin.ModelAdmin):
     list_display = ("bill_number", "patient", "bill_type", "total_amount", "paid_amount", "bill_date")
     list_filter = ("bill_type", "bill_date")
     search_fields = ("bill_number", "patient__name")
+    actions = ["check_totals", "repair_totals"]
+
+    def check_totals(self, request, queryset):
+        report_reconciliation(self, request, reconcile_bills, queryset, fix=False)
+    check_totals.short_description = "Check totals against items and payments"
+
+    def repair_totals(self, request, queryset):
+        report_reconciliation(self, request, reconcile_bills, queryset, fix=True)
+    repair_totals.short_description = "Repair totals from items and payments"
 
 
 @admin.register(models.BillItem)
@@ -209,10 +291,42 @@ class BillItemAdmin(admin.ModelAdmin):
 
 @admin.register(models.Payment)
 class PaymentAdmin(admin.ModelAdmin):
-    list_display = ("patient", "bill", "amount", "method", "date", "received_by")
-    list_filter = ("method", "date")
+    list_display = ("patient", "bill", "entry_type", "amount", "method", "date", "received_by")
+    list_filter = ("entry_type", "method", "date")
     search_fields = ("patient__name", "bill__bill_number")
 
+    actions = ["reverse_entries"]
+
+    # Ledger entries are append-only; mistakes are fixed with a correction entry
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    # Entries go with their patient when it is deleted (the delete permission is
+    # checked for that cascade), but are never deleted one by one
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop("delete_selected", None)
+        return actions
+
+    def delete_view(self, request, object_id, extra_context=None):
+        raise PermissionDenied
+
+    @transaction.atomic
+    def reverse_entries(self, request, queryset):
+        count = 0
+        for entry in queryset.select_related("patient"):
+            models.Payment(
+                patient=entry.patient,
+                bill_id=entry.bill_id,
+                entry_type="correction",
+                amount=-entry.amount,
+                method=entry.method,
+                received_by=request.user,
+            ).save()
+            count += 1
+        self.message_user(request, f"Posted {count} reversing correction(s).", messages.SUCCESS)
+    reverse_entries.short_description = "Reverse with a correction entry"
+
 
 @admin.register(models.Service)
 class ServiceAdmin(admin.ModelAdmin):
@@ -345,3 +459,72 @@ class ExpenseAdmin(admin.ModelAdmin):
 class DailyReportAdmin(admin.ModelAdmin):
     list_display = ("report_date", "new_patients", "total_appointments", "total_revenue", "outstanding_amount")
     list_filter = ("report_date",)
+
+
+@admin.register(models.FinanceFact)
+class FinanceFactAdmin(admin.ModelAdmin):
+    list_display = ("day", "bill_type", "item_kind", "district", "payment_method", "billed", "collected", "quantity", "count")
+    list_filter = ("bill_type", "item_kind", "payment_method", "day")
+    search_fields = ("district",)
+
+    # Derived from bills and payments; rebuild with `manage.py rebuild_finance_facts`
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(models.PatientSearchToken)
+class PatientSearchTokenAdmin(admin.ModelAdmin):
+    list_display = ("token", "patient")
+    search_fields = ("token", "patient__file_number")
+    raw_id_fields = ("patient",)
+
+    # Derived from patients; rebuild with `manage.py rebuild_patient_search`
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(models.PatientDuplicate)
+class PatientDuplicateAdmin(admin.ModelAdmin):
+    list_display = ("duplicate", "patient", "score", "reasons", "status", "created_at", "resolved_by")
+    list_filter = ("status",)
+    search_fields = ("patient__file_number", "patient__name", "duplicate__file_number", "duplicate__name")
+    raw_id_fields = ("patient", "duplicate", "resolved_by")
+    ordering = ("status", "-score")
+    actions = ["merge_pairs", "dismiss_pairs"]
+
+    # Found by `manage.py find_duplicate_patients`
+    def has_add_permission(self, request):
+        return False
+
+    def merge_pairs(self, request, queryset):
+        merged = 0
+        for pair in queryset.filter(status='open').select_related("patient", "duplicate"):
+            try:
+                merge_patients(pair.patient, pair.duplicate, user=request.user)
+            except ValueError as e:
+                self.message_user(request, f"{pair}: {e}", messages.WARNING)
+                continue
+            merged += 1
+        self.message_user(request, f"Merged {merged} duplicate patient(s).", messages.SUCCESS)
+    merge_pairs.short_description = "Merge each duplicate into the older patient"
+
+    def dismiss_pairs(self, request, queryset):
+        count = dismiss_duplicates(queryset, user=request.user)
+        self.message_user(request, f"Marked {count} pair(s) as not duplicates.", messages.SUCCESS)
+    dismiss_pairs.short_description = "Mark as not duplicates"
+
+
+@admin.register(models.ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ("report", "params", "status", "progress", "requested_by", "created_at", "finished_at")
+    list_filter = ("report", "status")
+    readonly_fields = [f.name for f in models.ReportJob._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,307 @@
+"""
+Bill persistence.
+
+Views validate the header form and item formset, then hand them over here.
+Line totals, subtotal, tax and discount are worked out in memory and the bill
+is written with a fixed number of queries, however many lines it has.
+
+Edits are applied as a diff against the stored lines: only changed rows are
+written and pharmacy stock moves by one adjustment per medicine whose sold
+quantity changed.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, When
+from django.utils import timezone
+
+from .kpis import mark_changed
+from .models import Bill, BillItem, MedicineStock, Patient, Payment, StockTransaction
+from .rollups import mark_report_day
+
+D0 = Decimal('0.00')
+
+
+def _fill_line_defaults(item):
+    """Same defaults as the BillItem pre_save handler, which bulk_create skips."""
+    if item.kind == 'service' and item.service_id:
+        if not item.description:
+            item.description = item.service.name
+        if not item.unit_price:
+            item.unit_price = item.service.default_price or D0
+    elif item.kind == 'pharmacy' and item.medicine_id:
+        if not item.description:
+            s = item.medicine.strength
+            item.description = f"{item.medicine.name}{f' ({s})' if s else ''}"
+        if not item.unit_price:
+            item.unit_price = item.medicine.selling_price or D0
+    item.total_price = (item.unit_price or D0) * (item.quantity or 0)
+
+
+def collect_bill_lines(formset, kind):
+    """
+    Return unsaved BillItem instances for the filled, non-deleted rows of a
+    validated item formset, with kind, description and line total set.
+    """
+    lines = []
+    for form in formset.forms:
+        cleaned = getattr(form, 'cleaned_data', None)
+        if getattr(form, '_empty_row_skip', False) or not cleaned or cleaned.get('DELETE'):
+            continue
+        item = form.save(commit=False)
+        item.kind = kind
+        _fill_line_defaults(item)
+        lines.append(item)
+    return lines
+
+
+def bill_totals(lines, tax_amount=D0, discount_amount=D0):
+    """Return (subtotal, grand total) for a list of prepared lines."""
+    subtotal = sum((line.total_price or D0 for line in lines), D0)
+    return subtotal, subtotal + (tax_amount or D0) - (discount_amount or D0)
+
+
+def record_stock_transactions(transactions, user=None):
+    """
+    Insert StockTransaction rows in bulk and apply their net effect to stock.
+
+    This replaces the per-row post_save handler for bulk writes: the stock rows
+    of the affected medicines are locked once, in medicine order, checked for
+    going negative and moved with a single UPDATE.
+    Raises ValueError when a medicine would go below zero.
+    """
+    if not transactions:
+        return
+
+    deltas = defaultdict(int)
+    for tx in transactions:
+        tx._normalize_quantity_sign()
+        deltas[tx.medicine_id] += tx.quantity or 0
+    deltas = {med_id: d for med_id, d in deltas.items() if d}
+
+    if deltas:
+        med_ids = sorted(deltas)
+        MedicineStock.objects.bulk_create(
+            [MedicineStock(medicine_id=m, current_quantity=0, reserved_quantity=0) for m in med_ids],
+            ignore_conflicts=True,
+        )
+        locked = (MedicineStock.objects
+                  .select_for_update()
+                  .filter(medicine_id__in=med_ids)
+                  .order_by('medicine_id')
+                  .values_list('medicine_id', 'current_quantity'))
+        for med_id, current in locked:
+            new_qty = current + deltas[med_id]
+            if new_qty < 0:
+                name = next(tx.medicine.name for tx in transactions if tx.medicine_id == med_id)
+                raise ValueError(
+                    f"Insufficient stock for {name}: would go negative ({new_qty})."
+                )
+
+        MedicineStock.objects.filter(medicine_id__in=med_ids).update(
+            current_quantity=Case(
+                *[When(medicine_id=m, then=F('current_quantity') + d) for m, d in deltas.items()],
+                default=F('current_quantity'),
+                output_field=IntegerField(),
+            ),
+            updated_by=user,
+            last_updated=timezone.now(),
+        )
+
+    StockTransaction.objects.bulk_create(transactions)
+    mark_changed('stock')  # bulk_create sends no post_save
+
+
+@transaction.atomic
+def create_bill(header_form, lines, bill_type, user):
+    """
+    Write a new bill from a validated BillHeaderForm and prepared lines.
+
+    Queries: bill number (one locked update per block), bill INSERT, one bulk
+    INSERT of items, for pharmacy bills one stock lock + UPDATE + bulk INSERT of
+    sale transactions, the payment INSERT and a single patient balance UPDATE.
+    """
+    paid = header_form.cleaned_data.get('paid_amount') or D0
+    method = header_form.cleaned_data.get('payment_method')
+
+    bill = header_form.save(commit=False)
+    bill.bill_type = bill_type
+    bill.created_by = user
+    _, bill.total_amount = bill_totals(lines, bill.tax_amount, bill.discount_amount)
+    bill.paid_amount = paid
+    bill.save()
+
+    for line in lines:
+        line.bill = bill
+    BillItem.objects.bulk_create(lines)
+
+    if bill_type == 'pharmacy':
+        record_stock_transactions([
+            StockTransaction(
+                medicine=line.medicine,
+                transaction_type='sale',
+                quantity=line.quantity,
+                unit_price=line.unit_price,
+                patient_id=bill.patient_id,
+                reference_number=bill.bill_number,
+                notes=f'Pharmacy Bill #{bill.bill_number}',
+                created_by=user,
+            )
+            for line in lines if line.medicine_id
+        ], user=user)
+
+    balance_delta = bill.total_amount
+    if paid > 0 and method:
+        Payment(
+            patient_id=bill.patient_id,
+            bill=bill,
+            amount=paid,
+            method=method,
+            received_by=user,
+        ).save(update_totals=False)
+        balance_delta -= paid
+
+    if balance_delta:
+        Patient.objects.filter(pk=bill.patient_id).update(balance=F('balance') + balance_delta)
+
+    return bill
+
+
+@transaction.atomic
+def update_bill(header_form, formset, kind, user):
+    """
+    Apply a validated edit of an existing bill (header form + item formset).
+
+    Unchanged lines are left alone; changed lines go out in one bulk UPDATE,
+    new ones in one bulk INSERT and removed ones in one DELETE. For pharmacy
+    bills the old and new quantities per medicine are compared and a single
+    'adjustment' transaction is posted for each medicine that moved, instead of
+    reversing and re-selling every line. The patient balance moves by the change
+    in bill total; when the bill is moved to another patient its ledger entries
+    go with it and its outstanding amount moves from one balance to the other.
+
+    Payments are append-only: a changed paid total posts one entry for the
+    difference (a 'correction' when it goes down), never a rewrite of history.
+    Raises ValueError when a medicine would go below zero.
+    """
+    bill = header_form.instance
+    paid = header_form.cleaned_data.get('paid_amount') or D0
+    method = header_form.cleaned_data.get('payment_method')
+    # Lock the bill so concurrent edits post their deltas against the same ledger total.
+    # The form has already set the new patient on the instance, so the old one is read here.
+    old_patient_id, old_total, old_paid, revision = Bill.objects.select_for_update().values_list(
+        'patient_id', 'total_amount', 'paid_amount', 'payment_revision').get(pk=bill.pk)
+    old_total, old_paid = old_total or D0, old_paid or D0
+
+    old_qty = {}
+    if kind == 'pharmacy':
+        old_qty = dict(
+            bill.items.filter(medicine__isnull=False)
+            .values('medicine_id')
+            .annotate(q=Sum('quantity'))
+            .values_list('medicine_id', 'q')
+        )
+
+    lines, to_create, to_update, to_delete = [], [], [], []
+    for form in formset.forms:
+        existing = not form.instance._state.adding
+        cleaned = getattr(form, 'cleaned_data', None)
+        if getattr(form, '_empty_row_skip', False) or not cleaned or cleaned.get('DELETE'):
+            if existing:
+                to_delete.append(form.instance.pk)
+            continue
+
+        item = form.save(commit=False)
+        item.bill = bill
+        item.kind = kind
+        if not existing:
+            _fill_line_defaults(item)
+            to_create.append(item)
+        elif form.has_changed():
+            if {'service', 'medicine'} & set(form.changed_data):
+                item.description = ''
+            _fill_line_defaults(item)
+            to_update.append(item)
+        lines.append(item)
+
+    if to_update:
+        BillItem.objects.bulk_update(
+            to_update,
+            ['service', 'medicine', 'kind', 'description', 'quantity', 'unit_price', 'total_price'],
+        )
+    if to_create:
+        BillItem.objects.bulk_create(to_create)
+    if to_delete:
+        from .signals import bill_recalc_suspended
+        with bill_recalc_suspended():
+            BillItem.objects.filter(pk__in=to_delete).delete()
+
+    bill = header_form.save(commit=False)
+    if not bill.created_by_id:
+        bill.created_by = user
+    _, bill.total_amount = bill_totals(lines, bill.tax_amount, bill.discount_amount)
+    bill.paid_amount = paid
+    bill.payment_revision = revision + (1 if paid != old_paid else 0)
+    bill.save()
+
+    if kind == 'pharmacy':
+        new_qty = defaultdict(int)
+        for line in lines:
+            if line.medicine_id:
+                new_qty[line.medicine_id] += line.quantity or 0
+        adjustments = []
+        for med_id in sorted(set(old_qty) | set(new_qty)):
+            returned = (old_qty.get(med_id) or 0) - new_qty.get(med_id, 0)
+            if returned:
+                adjustments.append(StockTransaction(
+                    medicine_id=med_id,
+                    transaction_type='adjustment',
+                    quantity=returned,
+                    patient_id=bill.patient_id,
+                    reference_number=bill.bill_number,
+                    notes=f'Pharmacy Bill #{bill.bill_number} (edited)',
+                    created_by=user,
+                ))
+        record_stock_transactions(adjustments, user=user)
+
+    paid_delta = paid - old_paid
+    if paid_delta:
+        Payment(
+            patient_id=bill.patient_id,
+            bill=bill,
+            entry_type='payment' if paid_delta > 0 else 'correction',
+            amount=paid_delta,
+            method=method or 'cash',
+            received_by=user,
+        ).save(update_totals=False)
+
+    new_total = bill.total_amount or D0
+    if bill.patient_id != old_patient_id:
+        # The bill moves to another patient with its ledger entries: what was
+        # due on it leaves the old balance and what is due now goes on the new one
+        Payment.objects.filter(bill=bill).update(patient_id=bill.patient_id)
+        Patient.objects.filter(pk=old_patient_id).update(balance=F('balance') - (old_total - old_paid))
+        balance_delta = new_total - paid
+    else:
+        balance_delta = new_total - old_total - paid_delta
+    if balance_delta:
+        Patient.objects.filter(pk=bill.patient_id).update(balance=F('balance') + balance_delta)
+
+    return bill
+
+
+def delete_bill_payments(bill):
+    """
+    Drop a bill's ledger entries with one DELETE and release its outstanding
+    amount from the patient balance with one UPDATE. Used when the bill itself
+    is being deleted. The days the entries were paid on are marked for the
+    daily report, which counts collections on the payment's own day.
+    """
+    entries = Payment.objects.filter(bill=bill)
+    for day in entries.values_list('date', flat=True):
+        mark_report_day(day)
+    entries.delete()
+    outstanding = (bill.total_amount or D0) - (bill.paid_amount or D0)
+    if outstanding:
+        Patient.objects.filter(pk=bill.patient_id).update(balance=F('balance') - outstanding)
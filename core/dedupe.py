@@ -0,0 +1,257 @@
+"""
+Duplicate patients.
+
+find_duplicates() reads the patients in pk chunks and files each one under a
+few blocking keys: its canonical phone number, a phonetic key of its name
+(Soundex of the words folded by core.search, in any order) and its date of
+birth with the name's initial. Only patients that share a block are compared,
+so the work grows with the block sizes instead of n². Blocks bigger than
+MAX_BLOCK_SIZE (a clinic landline, a very common name) say too little and are
+skipped. Pairs scoring MIN_SCORE or more are stored as open PatientDuplicate
+rows for review; pairs already stored keep their status.
+
+merge_patients() folds a duplicate into the patient kept: its bills,
+payments, appointments, consultations, follow-ups, photos and stock movements
+are re-pointed with one UPDATE per table, the balances are added up and the
+duplicate is deactivated with merged_into set, so its file number still leads
+to the kept record.
+"""
+from decimal import Decimal
+from difflib import SequenceMatcher
+from itertools import combinations
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .finance_facts import mark_patient_finance_days
+from .followups import refresh_followup_dates
+from .kpis import mark_changed
+from .models import (
+    Appointment, Bill, FollowUp, HairConsultation, Lead, Patient, PatientDuplicate, PatientMedicalHistory,
+    PatientSearchToken, Payment, ProgressPhoto, StockTransaction,
+)
+from .search import normalise_name
+
+D0 = Decimal('0.00')
+
+CHUNK_SIZE = 5000
+# A block with more patients than this is not specific enough to compare within
+MAX_BLOCK_SIZE = 50
+MIN_SCORE = Decimal('0.650')
+
+# Weights of the evidence; a differing date of birth or gender counts against a pair
+WEIGHTS = {
+    'name': 0.45,
+    'phone': 0.35,
+    'dob': 0.20,
+    'age': 0.10,
+    'dob_differs': -0.30,
+    'age_differs': -0.20,
+    'gender_differs': -0.30,
+}
+
+# Tables whose rows follow the patient on a merge
+MERGED_MODELS = (Bill, Payment, Appointment, HairConsultation, FollowUp, ProgressPhoto, StockTransaction)
+# Details the kept patient takes from the duplicate when it has none of its own
+MERGE_FILL_FIELDS = ('date_of_birth', 'email', 'address', 'pincode', 'occupation', 'referred_by',
+                     'referral_source', 'emergency_contact_name', 'emergency_contact_phone')
+
+SCORE_FIELDS = ('id', 'created_at', 'name', 'phone_digits', 'date_of_birth', 'age', 'gender')
+
+_SOUNDEX = {
+    **dict.fromkeys('bfpv', '1'), **dict.fromkeys('cgjkqsxz', '2'), **dict.fromkeys('dt', '3'),
+    'l': '4', **dict.fromkeys('mn', '5'), 'r': '6',
+}
+
+
+def soundex(word):
+    """American Soundex of a folded Latin word; words in other scripts are their own key."""
+    if not word.isascii():
+        return word
+    code = [word[0]]
+    last = _SOUNDEX.get(word[0], '')
+    for ch in word[1:]:
+        digit = _SOUNDEX.get(ch, '')
+        if digit and digit != last:
+            code.append(digit)
+        if ch not in 'hw':
+            last = digit
+    return (''.join(code) + '000')[:4]
+
+
+def name_key(name):
+    """Phonetic key of a name, the same for 'Sheeja K', 'K. Sija' and 'Shija K'."""
+    words = [word for word in normalise_name(name) if word]
+    # Initials are written in any order and often left out
+    full = [word for word in words if len(word) > 1] or words
+    return '-'.join(sorted({soundex(word) for word in full}))
+
+
+def blocking_keys(name, phone_digits, date_of_birth):
+    keys = []
+    if phone_digits:
+        keys.append(f'p:{phone_digits}')
+    key = name_key(name)
+    if key:
+        keys.append(f'n:{key}')
+    if date_of_birth:
+        # Digits are stripped from names, so a word can be empty
+        initial = next((word[0] for word in normalise_name(name) if word), '')
+        keys.append(f"d:{date_of_birth.isoformat()}:{initial}")
+    return keys
+
+
+def _comparable_name(name):
+    return ' '.join(sorted(word for word in normalise_name(name) if len(word) > 1))
+
+
+def score_pair(a, b):
+    """(score, reasons) for two patients; the score is between 0 and 1."""
+    score = 0.0
+    reasons = []
+
+    name_a, name_b = _comparable_name(a.name), _comparable_name(b.name)
+    similarity = SequenceMatcher(None, name_a, name_b).ratio() if name_a and name_b else 0.0
+    score += WEIGHTS['name'] * similarity
+    reasons.append(f'name {similarity:.2f}')
+
+    if a.phone_digits and a.phone_digits == b.phone_digits:
+        score += WEIGHTS['phone']
+        reasons.append('phone')
+
+    if a.date_of_birth and b.date_of_birth:
+        if a.date_of_birth == b.date_of_birth:
+            score += WEIGHTS['dob']
+            reasons.append('dob')
+        else:
+            score += WEIGHTS['dob_differs']
+            reasons.append('dob differs')
+    elif a.age is not None and b.age is not None:
+        # Ages are typed at registration, possibly years apart
+        if abs(a.age - b.age) <= 1:
+            score += WEIGHTS['age']
+            reasons.append('age')
+        elif abs(a.age - b.age) > 3:
+            score += WEIGHTS['age_differs']
+            reasons.append('age differs')
+
+    if a.gender and b.gender and a.gender != b.gender:
+        score += WEIGHTS['gender_differs']
+        reasons.append('gender differs')
+
+    score = min(max(score, 0.0), 1.0)
+    return Decimal(f'{score:.3f}'), ', '.join(reasons)
+
+
+def _candidate_patients():
+    return Patient.objects.filter(merged_into__isnull=True)
+
+
+def _blocks(chunk_size):
+    """{blocking key: [patient ids]}, reading the patients chunk by chunk."""
+    blocks = {}
+    last_pk = None
+    while True:
+        chunk = _candidate_patients().order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list('pk', 'name', 'phone_digits', 'date_of_birth')[:chunk_size])
+        if not rows:
+            return blocks
+        for pk, name, phone_digits, date_of_birth in rows:
+            for key in blocking_keys(name, phone_digits, date_of_birth):
+                blocks.setdefault(key, []).append(pk)
+        last_pk = rows[-1][0]
+
+
+def find_duplicates(chunk_size=CHUNK_SIZE, on_progress=None):
+    """
+    Store the likely duplicate pairs as open PatientDuplicate rows.
+    on_progress(done, total) is called after each chunk of pairs is scored.
+    Returns (pairs compared, new likely duplicates stored).
+    """
+    pairs = set()
+    for ids in _blocks(chunk_size).values():
+        if 1 < len(ids) <= MAX_BLOCK_SIZE:
+            pairs.update(tuple(sorted(pair)) for pair in combinations(ids, 2))
+    pairs = sorted(pairs)
+
+    stored = 0
+    for start in range(0, len(pairs), chunk_size):
+        chunk = pairs[start:start + chunk_size]
+        patients = _candidate_patients().only(*SCORE_FIELDS).in_bulk({pk for pair in chunk for pk in pair})
+        found = []
+        for a_id, b_id in chunk:
+            a, b = patients.get(a_id), patients.get(b_id)
+            if a is None or b is None:
+                continue  # merged while the job was running
+            score, reasons = score_pair(a, b)
+            if score < MIN_SCORE:
+                continue
+            keep, duplicate = sorted((a, b), key=lambda p: (p.created_at, str(p.pk)))
+            found.append(PatientDuplicate(patient=keep, duplicate=duplicate, score=score, reasons=reasons))
+        # Pairs stored by an earlier run keep their row (and status)
+        known = set(PatientDuplicate.objects
+                    .filter(patient_id__in={pair.patient_id for pair in found},
+                            duplicate_id__in={pair.duplicate_id for pair in found})
+                    .values_list('patient_id', 'duplicate_id'))
+        found = [pair for pair in found if (pair.patient_id, pair.duplicate_id) not in known]
+        PatientDuplicate.objects.bulk_create(found, batch_size=1000, ignore_conflicts=True)
+        stored += len(found)
+        if on_progress:
+            on_progress(start + len(chunk), len(pairs))
+    return len(pairs), stored
+
+
+def merge_patients(keep, duplicate, user=None):
+    """Fold `duplicate` into `keep`. Returns {table: rows re-pointed}."""
+    if keep.pk == duplicate.pk:
+        raise ValueError("A patient cannot be merged into itself.")
+
+    with transaction.atomic():
+        # Lock both rows, always in the same order
+        locked = {p.pk: p for p in Patient.objects.select_for_update().filter(pk__in=[keep.pk, duplicate.pk]).order_by('pk')}
+        keep, duplicate = locked[keep.pk], locked[duplicate.pk]
+        if duplicate.merged_into_id or keep.merged_into_id:
+            raise ValueError("One of these patients has already been merged.")
+
+        moved = {}
+        for model in MERGED_MODELS:
+            moved[model._meta.db_table] = model.objects.filter(patient_id=duplicate.pk).update(patient_id=keep.pk)
+        if not PatientMedicalHistory.objects.filter(patient_id=keep.pk).exists():
+            PatientMedicalHistory.objects.filter(patient_id=duplicate.pk).update(patient_id=keep.pk)
+        if not Lead.objects.filter(converted_patient_id=keep.pk).exists():
+            Lead.objects.filter(converted_patient_id=duplicate.pk).update(converted_patient_id=keep.pk)
+
+        filled = [field for field in MERGE_FILL_FIELDS
+                  if not getattr(keep, field) and getattr(duplicate, field)]
+        for field in filled:
+            setattr(keep, field, getattr(duplicate, field))
+        # Bills and payments moved, so the running balances move with them
+        keep.balance = (keep.balance or D0) + (duplicate.balance or D0)
+        keep.save(update_fields=[*filled, 'balance', 'updated_at'])
+
+        duplicate.balance = D0
+        duplicate.is_active = False
+        duplicate.merged_into = keep
+        duplicate.save(update_fields=['balance', 'is_active', 'merged_into', 'updated_at'])
+
+        now = timezone.now()
+        pair = Q(patient=keep, duplicate=duplicate) | Q(patient=duplicate, duplicate=keep)
+        PatientDuplicate.objects.filter(pair).update(status='merged', resolved_at=now, resolved_by=user)
+        # Other open pairs with the duplicate are found again against the kept patient
+        PatientDuplicate.objects.filter(Q(patient=duplicate) | Q(duplicate=duplicate), status='open').delete()
+
+        # The duplicate is found by neither searches nor the follow-up worklist any more
+        PatientSearchToken.objects.filter(patient_id=duplicate.pk).delete()
+        refresh_followup_dates([keep.pk, duplicate.pk], timezone.localdate())
+        if moved[Bill._meta.db_table] and duplicate.district != keep.district:
+            mark_patient_finance_days(keep.pk)  # facts are split by the patient's district
+        mark_changed('bills', 'payments', 'appointments')
+    return moved
+
+
+def dismiss_duplicates(queryset, user=None):
+    """Mark pairs as not duplicates; the job will not raise them again."""
+    return queryset.filter(status='open').update(status='dismissed', resolved_at=timezone.now(), resolved_by=user)
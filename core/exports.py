@@ -0,0 +1,67 @@
+"""
+Streaming spreadsheet exports.
+
+Rows come from a generator (normally a values_list(...).iterator() over the
+database), so memory use does not depend on the number of rows. CSV is written
+to the response as it is produced. XLSX is a zip archive and cannot be emitted
+incrementally, so it is built with openpyxl's write-only workbook in a
+temporary file (constant memory) and that file is streamed back.
+"""
+import csv
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+ITERATOR_CHUNK_SIZE = 2000
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class _Echo:
+    """File-like object whose write() just returns the value, for csv.writer."""
+    def write(self, value):
+        return value
+
+
+def _cell(value):
+    # Spreadsheets have no timezone-aware datetimes; exports are in local time
+    if hasattr(value, 'tzinfo') and value.tzinfo is not None:
+        return timezone.localtime(value).replace(tzinfo=None, microsecond=0)
+    return value
+
+
+def csv_response(filename, header, rows):
+    writer = csv.writer(_Echo())
+
+    def stream():
+        yield '\ufeff'  # BOM, so Excel opens UTF-8 (₹, Malayalam names) correctly
+        yield writer.writerow(header)
+        for row in rows:
+            yield writer.writerow([_cell(v) for v in row])
+
+    response = StreamingHttpResponse(stream(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+def xlsx_response(filename, header, rows, sheet_title='Export'):
+    """Raises ImportError when openpyxl is not installed."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_title[:31])
+    ws.append(header)
+    for row in rows:
+        ws.append([_cell(v) for v in row])
+
+    tmp = tempfile.TemporaryFile(suffix='.xlsx')
+    wb.save(tmp)
+    tmp.seek(0)
+    return FileResponse(tmp, as_attachment=True, filename=f'{filename}.xlsx',
+                        content_type=XLSX_CONTENT_TYPE)
+
+
+def spreadsheet_response(fmt, filename, header, rows, sheet_title='Export'):
+    if fmt == 'xlsx':
+        return xlsx_response(filename, header, rows, sheet_title)
+    return csv_response(filename, header, rows)
@@ -0,0 +1,189 @@
+"""
+Daily finance fact table (FinanceFact).
+
+rebuild_finance_facts(start, end) replaces the facts of every day in the range
+with three GROUP BY queries (bills, bill items, payments), bucketed on the
+local business day of the bill. Signals call mark_finance_day() when a bill or
+one of its payments changes; the touched days are rebuilt once per
+transaction, after it commits; a day's row in FinanceFactDay is locked while
+its facts are read and replaced. finance_summary() answers the finance report
+from the facts (plus expenses and leads), so its cost depends on the number
+of days, not bills.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Bill, BillItem, Expense, FinanceFact, FinanceFactDay, Lead, Payment
+from .rollups import local_day
+from .utils import CommitBatch
+
+D0 = Decimal('0.00')
+
+
+def day_bounds(start, end):
+    tz = timezone.get_current_timezone()
+    return (timezone.make_aware(datetime.combine(start, time.min), tz),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz))
+
+
+def _lock_days(start, end):
+    """Lock the FinanceFactDay rows of start..end (created if missing), in day order."""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    FinanceFactDay.objects.bulk_create([FinanceFactDay(day=day) for day in days], ignore_conflicts=True)
+    list(FinanceFactDay.objects.select_for_update().filter(day__gte=start, day__lte=end).order_by('day'))
+
+
+def rebuild_finance_facts(start, end):
+    """
+    Recompute the facts of start..end (inclusive). Returns the number of fact rows written.
+    The days are locked before the bills are read, so a concurrent rebuild of
+    the same day waits and then reads what this one has committed.
+    """
+    with transaction.atomic():
+        _lock_days(start, end)
+        facts = _read_facts(start, end)
+        FinanceFact.objects.filter(day__gte=start, day__lte=end).delete()
+        FinanceFact.objects.bulk_create(facts, batch_size=1000)
+    return len(facts)
+
+
+def _read_facts(start, end):
+    lo, hi = day_bounds(start, end)
+    facts = []
+
+    bills = (Bill.objects.filter(bill_date__gte=lo, bill_date__lt=hi)
+             .annotate(day=TruncDate('bill_date'))
+             .values('day', 'bill_type', 'patient__district')
+             .annotate(billed=Sum('total_amount'), count=Count('id'))
+             .order_by())
+    for row in bills:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill_type'], district=row['patient__district'] or '',
+            billed=row['billed'] or D0, count=row['count'],
+        ))
+
+    items = (BillItem.objects.filter(bill__bill_date__gte=lo, bill__bill_date__lt=hi)
+             .annotate(day=TruncDate('bill__bill_date'))
+             .values('day', 'bill__bill_type', 'kind', 'bill__patient__district')
+             .annotate(billed=Sum('total_price'), quantity=Sum('quantity'), count=Count('id'))
+             .order_by())
+    for row in items:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill__bill_type'], item_kind=row['kind'] or '',
+            district=row['bill__patient__district'] or '',
+            billed=row['billed'] or D0, quantity=row['quantity'] or 0, count=row['count'],
+        ))
+
+    # Collections count on the day of the bill they pay, as Bill.paid_amount does
+    payments = (Payment.objects.filter(bill__bill_date__gte=lo, bill__bill_date__lt=hi)
+                .annotate(day=TruncDate('bill__bill_date'))
+                .values('day', 'bill__bill_type', 'bill__patient__district', 'method')
+                .annotate(collected=Sum('amount'), count=Count('id'))
+                .order_by())
+    for row in payments:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill__bill_type'], district=row['bill__patient__district'] or '',
+            payment_method=row['method'] or '', collected=row['collected'] or D0, count=row['count'],
+        ))
+    return facts
+
+
+def finance_totals(start, end):
+    """Billed, collected, medicine and service sales for start..end, plus pharmacy sales by district."""
+    facts = FinanceFact.objects.filter(day__gte=start, day__lte=end)
+    bill_row = Q(item_kind='', payment_method='')
+    totals = facts.aggregate(
+        total_billed=Coalesce(Sum('billed', filter=bill_row), D0),
+        total_collection=Coalesce(Sum('collected'), D0),
+        total_medicine_sale=Coalesce(Sum('billed', filter=Q(item_kind='pharmacy')), D0),
+        total_service_sale=Coalesce(Sum('billed', filter=Q(item_kind='service')), D0),
+    )
+    by_area = list(
+        facts.filter(item_kind='pharmacy')
+        .values('district')
+        .annotate(qty=Coalesce(Sum('quantity'), 0), sale=Coalesce(Sum('billed'), D0))
+        .order_by('-sale')
+    )
+    return totals, by_area
+
+
+def finance_summary(start, end, chunk_days=None, on_progress=None):
+    """
+    (summary, by_area) as shown by reports/finance.html for start..end.
+    With chunk_days the facts are summed one window at a time and
+    on_progress(done_days, total_days) is called after each window.
+    """
+    total_days = (end - start).days + 1
+    window = timedelta(days=(chunk_days or total_days) - 1)
+    totals = dict.fromkeys(('total_billed', 'total_collection', 'total_medicine_sale', 'total_service_sale'), D0)
+    areas = {}
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(end, chunk_start + window)
+        chunk_totals, chunk_areas = finance_totals(chunk_start, chunk_end)
+        for key, value in chunk_totals.items():
+            totals[key] += value
+        for row in chunk_areas:
+            area = areas.setdefault(row['district'], {'district': row['district'], 'qty': 0, 'sale': D0})
+            area['qty'] += row['qty']
+            area['sale'] += row['sale']
+        if on_progress:
+            on_progress((chunk_end - start).days + 1, total_days)
+        chunk_start = chunk_end + timedelta(days=1)
+
+    total_expenses = Expense.objects.filter(
+        expense_date__gte=start, expense_date__lte=end, status='paid',
+    ).aggregate(s=Coalesce(Sum('amount'), D0))['s']
+
+    lo, hi = day_bounds(start, end)
+    leads = Lead.objects.filter(created_at__gte=lo, created_at__lt=hi).aggregate(
+        total=Count('id'), converted=Count('id', filter=Q(converted_patient__isnull=False)))
+    total_leads = leads['total']
+    leads_converted = leads['converted']
+
+    summary = {
+        'period': f"{start.strftime('%d-%b-%Y')} to {end.strftime('%d-%b-%Y')}",
+        'area': 'All',
+        **totals,
+        'total_expenses': total_expenses,
+        'net': totals['total_collection'] - total_expenses,
+
+        # Leads
+        'total_leads': total_leads,
+        'leads_converted': leads_converted,
+        'leads_open': total_leads - leads_converted,
+        'lead_conversion_rate': (Decimal(leads_converted) / total_leads * Decimal('100.0')) if total_leads else D0,  # percent
+    }
+    by_area = sorted(areas.values(), key=lambda row: row['sale'], reverse=True)
+    return summary, by_area
+
+
+# --- incremental refresh -------------------------------------------------
+
+def _rebuild_finance_days(days):
+    for day in sorted(days):
+        rebuild_finance_facts(day, day)
+
+
+_finance_days = CommitBatch(_rebuild_finance_days)
+
+
+def mark_finance_day(value):
+    """Rebuild the facts of this day once the current transaction commits."""
+    if value is None:
+        return
+    _finance_days.add(local_day(value))
+
+
+def mark_patient_finance_days(patient_id):
+    """A patient's district moved: rebuild every day the patient was billed."""
+    days = (Bill.objects.filter(patient_id=patient_id)
+            .annotate(day=TruncDate('bill_date'))
+            .values_list('day', flat=True).distinct())
+    for day in days:
+        mark_finance_day(day)
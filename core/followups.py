@@ -0,0 +1,99 @@
+"""
+Follow-up dates kept on Patient.
+
+Patient.next_followup_date is the date the patient lists show: the nearest
+scheduled follow-up (FollowUp.next_followup_date) on or after today, or the
+latest missed one when nothing is scheduled. Patient.last_followup_date is the
+latest scheduled date before today. Signals refresh both whenever a follow-up
+is saved or deleted, so "due today" and "overdue" are a range scan on an
+indexed column.
+
+The dates also move when a scheduled day passes without any write; run
+`manage.py refresh_followup_dates` daily after midnight to catch up the
+patients whose date went by.
+"""
+from datetime import timedelta
+
+from django.db.models import Exists, F, Max, Min, OuterRef, Q
+
+from .models import FollowUp, Patient
+
+REFRESH_CHUNK_SIZE = 1000
+
+# (value, label) for the worklist filter
+WORKLIST_WINDOWS = (
+    ('due', 'Today & overdue'),
+    ('today', 'Today'),
+    ('overdue', 'Overdue'),
+    ('upcoming', 'Next 7 days'),
+)
+
+
+def followup_dates(patient_ids, today):
+    """{patient_id: (next_followup_date, last_followup_date)} with one grouped query."""
+    rows = (FollowUp.objects
+            .filter(patient_id__in=patient_ids, next_followup_date__isnull=False)
+            .values('patient_id')
+            .annotate(
+                upcoming=Min('next_followup_date', filter=Q(next_followup_date__gte=today)),
+                latest_past=Max('next_followup_date', filter=Q(next_followup_date__lt=today)),
+            )
+            .order_by())
+    return {row['patient_id']: (row['upcoming'] or row['latest_past'], row['latest_past']) for row in rows}
+
+
+def refresh_followup_dates(patient_ids, today):
+    """Recompute the follow-up dates of these patients. Returns the number of rows changed."""
+    patient_ids = list(patient_ids)
+    changed = 0
+    for i in range(0, len(patient_ids), REFRESH_CHUNK_SIZE):
+        chunk = patient_ids[i:i + REFRESH_CHUNK_SIZE]
+        dates = followup_dates(chunk, today)
+        updates = []
+        for p in Patient.objects.filter(pk__in=chunk).only('id', 'next_followup_date', 'last_followup_date'):
+            next_date, last_date = dates.get(p.pk, (None, None))
+            if (p.next_followup_date, p.last_followup_date) != (next_date, last_date):
+                p.next_followup_date, p.last_followup_date = next_date, last_date
+                updates.append(p)
+        Patient.objects.bulk_update(updates, ['next_followup_date', 'last_followup_date'])
+        changed += len(updates)
+    return changed
+
+
+def passed_followup_patients(today):
+    """
+    Patients whose stored dates went stale because a scheduled day passed:
+    their next date is before today and is either not yet recorded as the
+    last one or has a later follow-up behind it.
+    """
+    later = FollowUp.objects.filter(patient=OuterRef('pk'), next_followup_date__gt=OuterRef('next_followup_date'))
+    return (Patient.objects
+            .filter(next_followup_date__lt=today)
+            .filter(Q(last_followup_date__isnull=True)
+                    | Q(last_followup_date__lt=F('next_followup_date'))
+                    | Exists(later)))
+
+
+def followup_status(day, today):
+    """Badge of a follow-up date: today, tomorrow, overdue, upcoming or none."""
+    if day is None:
+        return 'none'
+    if day == today:
+        return 'today'
+    if day == today + timedelta(days=1):
+        return 'tomorrow'
+    return 'overdue' if day < today else 'upcoming'
+
+
+def worklist_queryset(window, today):
+    """Patients whose next follow-up falls in `window` (see WORKLIST_WINDOWS) and the keyset ordering to page them."""
+    qs = Patient.objects.filter(next_followup_date__isnull=False)
+    if window == 'today':
+        return qs.filter(next_followup_date=today), ('next_followup_date', 'id')
+    if window == 'overdue':
+        return qs.filter(next_followup_date__lt=today), ('-next_followup_date', '-id')
+    if window == 'upcoming':
+        return (qs.filter(next_followup_date__gt=today, next_followup_date__lte=today + timedelta(days=7)),
+                ('next_followup_date', 'id'))
+    # Today first, then the most recently missed
+    return qs.filter(next_followup_date__lte=today), ('-next_followup_date', '-id')
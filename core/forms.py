@@ -1,7 +1,9 @@
 
 from django import forms
 from .models import *
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from decimal import Decimal
 from datetime import datetime, time, timedelta
 from .models import Appointment, Branch
 from django.db.models import Sum, F
@@ -47,7 +49,54 @@ class PatientForm(forms.ModelForm):
             else:
                 w.attrs['class'] = (w.attrs.get('class', '') + ' form-control').strip()
 
-                
+
+def patient_option_data(p):
+    """What the patient pickers know about a patient: autocomplete results and the widget's selected option."""
+    return {
+        'id': str(p.pk),
+        'text': f"{p.name} ({p.file_number})" if p.file_number else p.name,
+        'name': p.name,
+        'file': p.file_number or '',
+        'phone': p.phone_number or '',
+        'age': '' if p.age is None else p.age,
+        'gender': p.gender or '',
+        'address': p.address or '',
+        'city': p.city or '',
+        'balance': str(p.balance if p.balance is not None else Decimal('0.00')),
+    }
+
+
+class PatientAutocompleteWidget(forms.Select):
+    """
+    Patient <select> that only renders the selected patient (one pk lookup,
+    with its details as data-* attributes). The page looks other patients up
+    through the patient_autocomplete endpoint, see
+    templates/includes/patient_autocomplete.html.
+    """
+
+    def __init__(self, attrs=None, url=None):
+        attrs = {'data-autocomplete-url': url or reverse_lazy('patient_autocomplete'), **(attrs or {})}
+        super().__init__(attrs)
+
+    def optgroups(self, name, value, attrs=None):
+        field = self.choices.field
+        options = []
+        if field.empty_label is not None:
+            options.append(self.create_option(name, '', field.empty_label, False, 0, attrs=attrs))
+        picked = [v for v in value if v]
+        if picked:
+            try:
+                patients = list(self.choices.queryset.filter(pk__in=picked))
+            except (ValueError, forms.ValidationError):
+                patients = []  # a tampered value; the field reports it
+            for index, p in enumerate(patients, start=len(options)):
+                option = self.create_option(name, str(p.pk), field.label_from_instance(p), True, index, attrs=attrs)
+                data = patient_option_data(p)
+                option['attrs'].update({f'data-{key}': data[key] for key in data if key not in ('id', 'text')})
+                options.append(option)
+        return [(None, [option], option['index']) for option in options]
+
+
 class AppointmentBaseForm(forms.ModelForm):
     appointment_date = forms.DateTimeField(
         widget=forms.DateTimeInput(
@@ -67,7 +116,10 @@ class AppointmentBaseForm(forms.ModelForm):
 
         # Patient / Doctor dropdowns — only if those fields are present
         if 'patient' in self.fields:
-            self.fields['patient'].queryset = Patient.objects.filter(is_active=True).order_by('name')
+            # Only the chosen patient is rendered; others come from the autocomplete endpoint
+            self.fields['patient'].widget = PatientAutocompleteWidget(
+                url=reverse('patient_autocomplete') + '?active=1')
+            self.fields['patient'].queryset = Patient.objects.filter(is_active=True)
             self.fields['patient'].label_from_instance = (
                 lambda p: f"{p.name} ({p.file_number})" if p.file_number else p.name
             )
@@ -102,7 +154,7 @@ class AppointmentBaseForm(forms.ModelForm):
         # bootstrap classes
         for f in self.fields.values():
             w = f.widget
-            if w.__class__.__name__ in ('Select','SelectMultiple'):
+            if isinstance(w, (forms.Select, forms.SelectMultiple)):
                 w.attrs['class'] = (w.attrs.get('class','') + ' form-select').strip()
             elif getattr(w, 'input_type', '') not in ('checkbox','radio','submit'):
                 w.attrs['class'] = (w.attrs.get('class','') + ' form-control').strip()
@@ -215,11 +267,12 @@ class BillHeaderForm(forms.ModelForm):
 
     class Meta:
         model = Bill
-        fields = ['patient', 'remark', 'paid_amount', 'payment_method','tax_amount','discount_amount']
+        # paid_amount is a plain form field: Bill.paid_amount follows the payment ledger
+        fields = ['patient', 'remark', 'tax_amount', 'discount_amount']
         widgets = {
             'tax_amount': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}),
             'discount_amount': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}),
-            'patient': forms.Select(attrs={'class': 'form-select patient-select'}),
+            'patient': PatientAutocompleteWidget(attrs={'class': 'form-select patient-select'}),
             'remark': forms.Textarea(attrs={'class': 'form-control', 'rows': 2, 'placeholder': 'Any notes…'}),
         }
 
@@ -227,14 +280,13 @@ class BillHeaderForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields['payment_method'].initial = 'cash'
 
-        if self.instance.pk:
-            # Get total paid amount for this bill and the last payment method
-            total_paid = self.instance.payments.aggregate(total=Sum('amount'))['total'] or Decimal("0.00")
-            last_payment = self.instance.payments.last()
-            
-            self.fields['paid_amount'].initial = total_paid
-            if last_payment:
-                self.fields['payment_method'].initial = last_payment.method
+        if not self.is_bound and not self.instance._state.adding:
+            # Paid total is kept in step with the ledger; prefill the last method used
+            self.fields['paid_amount'].initial = self.instance.paid_amount
+            last_method = (self.instance.payments.filter(entry_type='payment')
+                           .order_by('-date').values_list('method', flat=True).first())
+            if last_method:
+                self.fields['payment_method'].initial = last_method
 
     def clean(self):
         cleaned = super().clean()
@@ -327,6 +379,9 @@ class PharmacyBillItemForm(forms.ModelForm):
         if med and qty > 0:
             # The annotation gives us this attribute for free
             available_stock = getattr(med, 'quantity_in_stock', 0)
+            # On edit, the quantity already sold on this line goes back to stock first
+            if not self.instance._state.adding and self.instance.medicine_id == med.pk:
+                available_stock += self.instance.quantity or 0
             if qty > available_stock:
                 self.add_error('quantity', f"Only {available_stock} in stock.")
 
@@ -755,3 +810,14 @@ class StaffEditForm(StaffBaseForm):
                 profile.save(update_fields=["employee_id"])
 
         return user
+
+
+class PatientImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV or XLSX with a header row: name, age, gender, phone_number, city, district, "
+                                     "and optionally the other patient fields.")
+
+    def clean_file(self):
+        f = self.cleaned_data['file']
+        if not f.name.lower().endswith(('.csv', '.xlsx')):
+            raise forms.ValidationError("Upload a .csv or .xlsx file.")
+        return f
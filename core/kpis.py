@@ -0,0 +1,174 @@
+"""
+Cached dashboard KPIs.
+
+Every KPI block is cached with Django's cache framework under a key built from
+its parameters (date range, branch, role) and the current "data generation" of
+each data set it reads: bills, payments, appointments, stock, expenses and
+leads. Signals call mark_changed() when one of those tables is written; the
+generation counters are bumped once the transaction commits, so cached blocks
+that read the data simply stop being looked up and expire on their own. A
+dashboard load with nothing changed costs a couple of cache reads and no
+KPI queries.
+
+The counters must live in a cache shared by all worker processes (CACHES,
+e.g. Redis or Memcached) for invalidation to reach every worker.
+"""
+import hashlib
+import time as _time
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Appointment, Bill, Expense, Lead, MedicineStock
+from .timeseries import bucketed_sum, series_for_chart
+from .utils import CommitBatch
+
+D0 = Decimal('0.00')
+
+SCOPES = ('bills', 'payments', 'appointments', 'stock', 'expenses', 'leads')
+
+KPI_CACHE_TIMEOUT = getattr(settings, 'KPI_CACHE_TIMEOUT', 300)
+
+
+# --- data generations ----------------------------------------------------
+
+def _generation_key(scope):
+    return f'kpi:gen:{scope}'
+
+
+def _fresh_generation():
+    # Start from the clock rather than 1, so a counter that was evicted never
+    # comes back with a value that old cache entries were stored under
+    return int(_time.time() * 1000)
+
+
+def generations(scopes):
+    """Current generation of each scope, as a tuple in the order given."""
+    keys = {scope: _generation_key(scope) for scope in scopes}
+    found = cache.get_many(keys.values())
+    result = []
+    for scope in scopes:
+        value = found.get(keys[scope])
+        if value is None:
+            cache.add(keys[scope], _fresh_generation(), timeout=None)
+            value = cache.get(keys[scope])
+        result.append(value)
+    return tuple(result)
+
+
+def bump_generations(scopes):
+    for scope in scopes:
+        key = _generation_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_generation(), timeout=None)
+
+
+_changed_scopes = CommitBatch(lambda scopes: bump_generations(sorted(scopes)))
+
+
+def mark_changed(*scopes):
+    """Invalidate the KPIs that read these data sets once the current transaction commits."""
+    _changed_scopes.add(*scopes)
+
+
+def cached_kpis(name, scopes, params, compute, timeout=None):
+    """
+    Return compute() from the cache, keyed by `name`, `params` and the current
+    generation of every scope it depends on.
+    """
+    raw = repr((name, params, generations(scopes)))
+    key = f'kpi:{name}:' + hashlib.md5(raw.encode()).hexdigest()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, KPI_CACHE_TIMEOUT if timeout is None else timeout)
+    return value
+
+
+# --- KPI blocks -----------------------------------------------------------
+
+def _in_range(queryset, field, start, end):
+    tz = timezone.get_current_timezone()
+    if start:
+        queryset = queryset.filter(**{f'{field}__gte': timezone.make_aware(datetime.combine(start, time.min), tz)})
+    if end:
+        queryset = queryset.filter(
+            **{f'{field}__lt': timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz)})
+    return queryset
+
+
+def _appointments(start, end, branch_id):
+    qs = _in_range(Appointment.objects.all(), 'appointment_date', start, end)
+    return qs.filter(branch_id=branch_id) if branch_id else qs
+
+
+def _summary(start, end, branch_id):
+    bills = _in_range(Bill.objects.all(), 'bill_date', start, end).aggregate(
+        collected=Coalesce(Sum('paid_amount'), D0),
+        billed=Coalesce(Sum('total_amount'), D0),
+    )
+    low_stock_count = MedicineStock.objects.filter(
+        current_quantity__lte=F('medicine__minimum_stock_level')).count()
+    expenses = Expense.objects.filter(status='pending').aggregate(
+        count=Count('id'), amount=Coalesce(Sum('amount'), D0))
+    leads = _in_range(Lead.objects.all(), 'created_at', start, end).aggregate(
+        total=Count('id'), converted=Count('id', filter=Q(converted_patient__isnull=False)))
+    open_leads_count = Lead.objects.filter(converted_patient__isnull=True).count()
+
+    total_leads = leads['total']
+    return {
+        'today_appts': _appointments(start, end, branch_id).count(),
+        'today_collection': bills['collected'],
+        'month_billed': bills['billed'],
+        'low_stock_count': low_stock_count,
+        'pending_exp_count': expenses['count'],
+        'pending_exp_amount': expenses['amount'],
+        'open_leads_count': open_leads_count,
+        'conversion_rate': round((leads['converted'] / total_leads) * 100, 1) if total_leads else 0.0,
+    }
+
+
+def summary_kpis(start, end, branch_id=None, role=''):
+    """The KPI cards of the dashboard for a date range (None = open ended)."""
+    return cached_kpis('summary', SCOPES, (start, end, branch_id, role),
+                       lambda: _summary(start, end, branch_id))
+
+
+def doctor_appointment_count(doctor_id, start, end, branch_id=None):
+    """Appointments assigned to one doctor in the range (the "My appointments" card)."""
+    return cached_kpis('my-appts', ('appointments',), (doctor_id, start, end, branch_id),
+                       lambda: _appointments(start, end, branch_id).filter(assigned_doctor_id=doctor_id).count())
+
+
+def outstanding_balance():
+    """What is still due on all bills. Reads the whole bills table, so it has a widget of its own."""
+    return cached_kpis(
+        'outstanding', ('bills', 'payments'), (),
+        lambda: Bill.objects.aggregate(s=Coalesce(Sum(F('total_amount') - F('paid_amount')), D0))['s'],
+    )
+
+
+def revenue_chart(start, end, granularity):
+    return cached_kpis(
+        'revenue', ('bills', 'payments'), (start, end, granularity),
+        lambda: series_for_chart(
+            bucketed_sum(Bill.objects.all(), 'bill_date', 'paid_amount', start, end, granularity),
+            granularity),
+    )
+
+
+def lead_chart():
+    def compute():
+        counts = Lead.objects.aggregate(
+            open=Count('id', filter=Q(converted_patient__isnull=True)),
+            converted=Count('id', filter=Q(converted_patient__isnull=False)),
+        )
+        return {'open': counts['open'], 'converted': counts['converted']}
+    return cached_kpis('leads', ('leads',), (), compute)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.dedupe import CHUNK_SIZE, find_duplicates
+
+
+class Command(BaseCommand):
+    help = "Find likely duplicate patients (shared phone, phonetic name or date of birth) for review in the admin."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                            help=f"Patients read and pairs scored per batch (default {CHUNK_SIZE}).")
+
+    def handle(self, *args, **opts):
+        self.stdout.write(self.style.MIGRATE_HEADING("Looking for duplicate patients..."))
+        compared, stored = find_duplicates(
+            chunk_size=opts["chunk_size"],
+            on_progress=lambda done, total: self.stdout.write(f"  {done}/{total} pair(s) scored"),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Done. {compared} pair(s) compared, {stored} new likely duplicate(s) recorded."))
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from core.patient_import import BATCH_SIZE, import_patients, read_spreadsheet, reject_writer
+
+
+class Command(BaseCommand):
+    help = "Import patients from a CSV or XLSX file; rows that fail validation are written to a reject file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or XLSX file with a header row (name, age, gender, phone_number, city, district, ...).")
+        parser.add_argument("--rejects", help="Where to write rejected rows (default: <file>.rejects.csv next to the input).")
+        parser.add_argument("--user", help="Username recorded as registered_by.")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                            help=f"Patients inserted per transaction (default {BATCH_SIZE}).")
+
+    def handle(self, *args, **opts):
+        path = Path(opts["path"])
+        if not path.exists():
+            raise CommandError(f"{path} does not exist.")
+        user = None
+        if opts["user"]:
+            try:
+                user = get_user_model().objects.get(username=opts["user"])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user named {opts['user']}.")
+        rejects_path = Path(opts["rejects"] or path.with_name(f"{path.stem}.rejects.csv"))
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Importing patients from {path}..."))
+        with path.open("rb") as f, rejects_path.open("w", newline="", encoding="utf-8") as out:
+            try:
+                header, rows = read_spreadsheet(f, path.name)
+                imported, rejected = import_patients(
+                    header, rows, user=user, on_reject=reject_writer(out, header), batch_size=opts["batch_size"],
+                    on_progress=lambda done, bad: self.stdout.write(f"  {done} imported, {bad} rejected"),
+                )
+            except ImportError:
+                raise CommandError("XLSX import needs openpyxl; save the sheet as CSV.")
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        if rejected:
+            self.stdout.write(self.style.WARNING(f"{rejected} row(s) rejected, see {rejects_path}."))
+        else:
+            rejects_path.unlink()
+        self.stdout.write(self.style.SUCCESS(f"Done. {imported} patient(s) imported."))
@@ -0,0 +1,45 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from core.finance_facts import rebuild_finance_facts
+from core.models import Bill
+from core.rollups import local_day
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily finance facts (finance_facts) from bills, bill items and payments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help="First day (YYYY-MM-DD). Default: first bill.")
+        parser.add_argument('--to', dest='end', help="Last day (YYYY-MM-DD). Default: today.")
+        parser.add_argument('--batch-days', type=int, default=31,
+                            help="Days rebuilt per batch of GROUP BY queries (default 31).")
+
+    def handle(self, *args, **opts):
+        try:
+            start = date.fromisoformat(opts['start']) if opts['start'] else None
+            end = date.fromisoformat(opts['end']) if opts['end'] else timezone.localdate()
+        except ValueError as e:
+            raise CommandError(f"Bad date: {e}")
+
+        if start is None:
+            first = Bill.objects.aggregate(d=Min('bill_date'))['d']
+            if first is None:
+                self.stdout.write(self.style.SUCCESS("No bills, nothing to rebuild."))
+                return
+            start = local_day(first)
+        if end < start:
+            raise CommandError("--to is before --from.")
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Rebuilding finance facts {start} .. {end}..."))
+        total = 0
+        batch_start = start
+        while batch_start <= end:
+            batch_end = min(end, batch_start + timedelta(days=opts['batch_days'] - 1))
+            total += rebuild_finance_facts(batch_start, batch_end)
+            self.stdout.write(f"  {batch_start} .. {batch_end}")
+            batch_start = batch_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f"Done. {total} fact row(s) written."))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the patient search index (trigram tokens of names, phones and file numbers)."
+
+    def handle(self, *args, **opts):
+        self.stdout.write(self.style.MIGRATE_HEADING("Indexing patients for search..."))
+        total = rebuild_search_index(on_progress=lambda done: self.stdout.write(f"  {done} patient(s)"))
+        self.stdout.write(self.style.SUCCESS(f"Done. {total} patient(s) indexed."))
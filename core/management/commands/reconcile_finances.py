@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from core.reconciliation import CHUNK_SIZE, reconcile_bills, reconcile_patient_balances
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute bill totals/paid amounts and patient balances from bill items "
+        "and payments, report every mismatch and optionally repair them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help="Write the recomputed values back (run outside busy hours).")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help=f"Rows per GROUP BY batch (default {CHUNK_SIZE}).")
+        parser.add_argument('--skip-bills', action='store_true', help="Only check patient balances.")
+        parser.add_argument('--skip-patients', action='store_true', help="Only check bills.")
+
+    def handle(self, *args, **opts):
+        fix, chunk_size = opts['fix'], opts['chunk_size']
+        checks = []
+        if not opts['skip_bills']:
+            checks.append(("bills", reconcile_bills))
+        if not opts['skip_patients']:
+            checks.append(("patient balances", reconcile_patient_balances))
+
+        for name, check in checks:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Reconciling {name}..."))
+            count = 0
+            for m in check(fix=fix, chunk_size=chunk_size):
+                count += 1
+                self.stdout.write(f"  {m.label or m.pk}  {m.field}: stored {m.stored}, expected {m.expected}")
+
+            if not count:
+                self.stdout.write(self.style.SUCCESS(f"No mismatches in {name}."))
+            elif fix:
+                self.stdout.write(self.style.SUCCESS(f"Repaired {count} mismatch(es) in {name}."))
+            else:
+                self.stdout.write(self.style.WARNING(
+                    f"{count} mismatch(es) in {name}. Re-run with --fix to repair."
+                ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.followups import passed_followup_patients, refresh_followup_dates
+from core.models import Patient
+
+
+class Command(BaseCommand):
+    help = "Move patients' next/last follow-up dates on after scheduled days pass (run daily after midnight)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Recompute every patient, not just those whose date passed.")
+
+    def handle(self, *args, **opts):
+        today = timezone.localdate()
+        if opts['all']:
+            self.stdout.write(self.style.MIGRATE_HEADING("Recomputing follow-up dates of all patients..."))
+            ids = Patient.objects.values_list('pk', flat=True)
+        else:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Refreshing follow-up dates passed before {today}..."))
+            ids = passed_followup_patients(today).values_list('pk', flat=True)
+        changed = refresh_followup_dates(ids.iterator(chunk_size=5000), today)
+        self.stdout.write(self.style.SUCCESS(f"Done. {changed} patient(s) updated."))
@@ -0,0 +1,50 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from core.models import Appointment, Bill, Patient, Payment
+from core.rollups import local_day, rollup_daily_reports
+
+
+class Command(BaseCommand):
+    help = "Backfill / rebuild DailyReport rows from bills, payments, appointments and sessions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help="First day (YYYY-MM-DD). Default: earliest data.")
+        parser.add_argument('--to', dest='end', help="Last day (YYYY-MM-DD). Default: today.")
+        parser.add_argument('--batch-days', type=int, default=31,
+                            help="Days recomputed per batch of GROUP BY queries (default 31).")
+
+    def handle(self, *args, **opts):
+        try:
+            start = date.fromisoformat(opts['start']) if opts['start'] else None
+            end = date.fromisoformat(opts['end']) if opts['end'] else timezone.localdate()
+        except ValueError as e:
+            raise CommandError(f"Bad date: {e}")
+
+        if start is None:
+            firsts = [
+                Patient.objects.aggregate(d=Min('created_at'))['d'],
+                Appointment.objects.aggregate(d=Min('appointment_date'))['d'],
+                Bill.objects.aggregate(d=Min('bill_date'))['d'],
+                Payment.objects.aggregate(d=Min('date'))['d'],
+            ]
+            firsts = [local_day(d) for d in firsts if d]
+            if not firsts:
+                self.stdout.write(self.style.SUCCESS("Nothing to roll up."))
+                return
+            start = min(firsts)
+        if end < start:
+            raise CommandError("--to is before --from.")
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Rolling up daily reports {start} .. {end}..."))
+        total = 0
+        batch_start = start
+        while batch_start <= end:
+            batch_end = min(end, batch_start + timedelta(days=opts['batch_days'] - 1))
+            total += rollup_daily_reports(batch_start, batch_end)
+            self.stdout.write(f"  {batch_start} .. {batch_end}")
+            batch_start = batch_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f"Done. {total} day(s) written."))
@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.report_jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued background reports (finance reports over long periods)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Run the jobs queued now and exit instead of waiting for more.")
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help="Seconds between polls of an empty queue (default 2).")
+        parser.add_argument('--stale-minutes', type=int, default=30,
+                            help="Requeue jobs left running this long by a dead worker (default 30).")
+        parser.add_argument('--sweep-minutes', type=float, default=10.0,
+                            help="Minutes between sweeps for stale and superseded jobs while idle (default 10).")
+
+    def sweep(self, opts):
+        requeued = requeue_stale_jobs(timedelta(minutes=opts['stale_minutes']))
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Requeued {requeued} stale job(s)."))
+        return time.monotonic()
+
+    def handle(self, *args, **opts):
+        last_sweep = self.sweep(opts)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Waiting for report jobs..."))
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if opts['once']:
+                    break
+                if time.monotonic() - last_sweep >= opts['sweep_minutes'] * 60:
+                    last_sweep = self.sweep(opts)
+                time.sleep(opts['interval'])
+                continue
+
+            self.stdout.write(f"  {job.report} {job.params} ({job.pk})")
+            try:
+                run_job(job)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"    failed: {type(e).__name__}: {e}"))
+            else:
+                self.stdout.write(self.style.SUCCESS("    done"))
+        self.stdout.write(self.style.SUCCESS("Queue empty."))
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.5 on 2026-10-16 19:20
+
+from django.db import migrations, models
+
+
+# (model, field, prefix, digits, yearly) for every existing number series
+SERIES = [
+    ('Patient', 'file_number', 'DLP', 5, True),
+    ('Bill', 'bill_number', 'INV', 6, True),
+    ('Expense', 'expense_number', 'EXP', 5, True),
+    ('Service', 'code', 'SRV', 4, False),
+]
+
+
+def seed_sequences(apps, schema_editor):
+    """Start every series after the highest number already issued."""
+    DocumentSequence = apps.get_model('core', 'DocumentSequence')
+    EmployeeIdSequence = apps.get_model('core', 'EmployeeIdSequence')
+
+    last = {}
+    for model_name, field, prefix, digits, yearly in SERIES:
+        model = apps.get_model('core', model_name)
+        values = (model.objects
+                  .filter(**{f"{field}__startswith": prefix})
+                  .values_list(field, flat=True)
+                  .iterator(chunk_size=5000))
+        for value in values:
+            rest = value[len(prefix):]
+            if yearly:
+                year, number = rest[:4], rest[4:]
+            else:
+                year, number = '0', rest
+            if not (year.isdigit() and number.isdigit()):
+                continue
+            key = (prefix, int(year))
+            last[key] = max(last.get(key, 0), int(number))
+
+    for seq in EmployeeIdSequence.objects.all():
+        last[('EMP', seq.year)] = seq.last_number
+
+    DocumentSequence.objects.bulk_create([
+        DocumentSequence(prefix=prefix, year=year, last_number=number)
+        for (prefix, year), number in last.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0046_alter_patient_date_of_birth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=10)),
+                ('year', models.PositiveIntegerField(default=0)),
+                ('last_number', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Document Sequences',
+                'db_table': 'document_sequences',
+                'unique_together': {('prefix', 'year')},
+            },
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='EmployeeIdSequence',
+        ),
+    ]
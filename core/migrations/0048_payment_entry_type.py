@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-16 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0047_documentsequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='entry_type',
+            field=models.CharField(choices=[('payment', 'Payment'), ('correction', 'Correction')], default='payment', max_length=15),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-16 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0048_payment_entry_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='payment_revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
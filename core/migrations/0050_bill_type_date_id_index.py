@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-16 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0049_bill_payment_revision'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['bill_type', '-bill_date', '-id'], name='bills_type_date_id'),
+        ),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 5.2.5 on 2026-10-16 21:45
+
+from datetime import datetime, time, timedelta
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def _read_facts(apps, lo, hi):
+    """The facts of the bills dated lo <= bill_date < hi, as core.finance_facts builds them."""
+    Bill = apps.get_model('core', 'Bill')
+    BillItem = apps.get_model('core', 'BillItem')
+    Payment = apps.get_model('core', 'Payment')
+    FinanceFact = apps.get_model('core', 'FinanceFact')
+    facts = []
+
+    bills = (Bill.objects.filter(bill_date__gte=lo, bill_date__lt=hi)
+             .annotate(day=TruncDate('bill_date'))
+             .values('day', 'bill_type', 'patient__district')
+             .annotate(billed=Sum('total_amount'), count=Count('id'))
+             .order_by())
+    for row in bills:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill_type'], district=row['patient__district'] or '',
+            billed=row['billed'] or 0, count=row['count'],
+        ))
+
+    items = (BillItem.objects.filter(bill__bill_date__gte=lo, bill__bill_date__lt=hi)
+             .annotate(day=TruncDate('bill__bill_date'))
+             .values('day', 'bill__bill_type', 'kind', 'bill__patient__district')
+             .annotate(billed=Sum('total_price'), quantity=Sum('quantity'), count=Count('id'))
+             .order_by())
+    for row in items:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill__bill_type'], item_kind=row['kind'] or '',
+            district=row['bill__patient__district'] or '',
+            billed=row['billed'] or 0, quantity=row['quantity'] or 0, count=row['count'],
+        ))
+
+    payments = (Payment.objects.filter(bill__bill_date__gte=lo, bill__bill_date__lt=hi)
+                .annotate(day=TruncDate('bill__bill_date'))
+                .values('day', 'bill__bill_type', 'bill__patient__district', 'method')
+                .annotate(collected=Sum('amount'), count=Count('id'))
+                .order_by())
+    for row in payments:
+        facts.append(FinanceFact(
+            day=row['day'], bill_type=row['bill__bill_type'], district=row['bill__patient__district'] or '',
+            payment_method=row['method'] or '', collected=row['collected'] or 0, count=row['count'],
+        ))
+    return facts
+
+
+def fill_finance_facts(apps, schema_editor):
+    """Build the facts of every billed day, one month of bills at a time."""
+    Bill = apps.get_model('core', 'Bill')
+    FinanceFact = apps.get_model('core', 'FinanceFact')
+
+    span = Bill.objects.aggregate(first=Min('bill_date'), last=Max('bill_date'))
+    if span['first'] is None:
+        return
+    tz = timezone.get_current_timezone()
+    month = timezone.localtime(span['first'], tz).date().replace(day=1)
+    last = timezone.localtime(span['last'], tz).date()
+    while month <= last:
+        next_month = (month + timedelta(days=31)).replace(day=1)
+        lo = timezone.make_aware(datetime.combine(month, time.min), tz)
+        hi = timezone.make_aware(datetime.combine(next_month, time.min), tz)
+        FinanceFact.objects.bulk_create(_read_facts(apps, lo, hi), batch_size=1000)
+        month = next_month
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0050_bill_type_date_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinanceFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('bill_type', models.CharField(max_length=10)),
+                ('item_kind', models.CharField(blank=True, default='', max_length=10)),
+                ('district', models.CharField(blank=True, default='', max_length=100)),
+                ('payment_method', models.CharField(blank=True, default='', max_length=50)),
+                ('billed', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('collected', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('quantity', models.IntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Finance Facts',
+                'db_table': 'finance_facts',
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'bill_type', 'item_kind', 'district', 'payment_method'), name='finance_facts_key')],
+            },
+        ),
+        migrations.RunPython(fill_finance_facts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-16 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0052_report_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='balance_status',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(balance__gt=0, then=models.Value('due')), models.When(balance__lt=0, then=models.Value('advance')), default=models.Value('settled')), output_field=models.CharField(max_length=8)),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['-created_at', '-id'], name='patients_created_id'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['balance_status', '-created_at', '-id'], name='patients_balance_created'),
+        ),
+    ]
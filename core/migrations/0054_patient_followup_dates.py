@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-16 23:05
+
+from django.db import migrations, models
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+
+def fill_followup_dates(apps, schema_editor):
+    """Set the follow-up dates of every patient that has a scheduled follow-up."""
+    FollowUp = apps.get_model('core', 'FollowUp')
+    Patient = apps.get_model('core', 'Patient')
+
+    today = timezone.localdate()
+    rows = (FollowUp.objects
+            .filter(next_followup_date__isnull=False)
+            .values('patient_id')
+            .annotate(
+                upcoming=Min('next_followup_date', filter=Q(next_followup_date__gte=today)),
+                latest_past=Max('next_followup_date', filter=Q(next_followup_date__lt=today)),
+            )
+            .order_by()
+            .iterator(chunk_size=5000))
+    batch = []
+    for row in rows:
+        batch.append(Patient(pk=row['patient_id'],
+                             next_followup_date=row['upcoming'] or row['latest_past'],
+                             last_followup_date=row['latest_past']))
+        if len(batch) >= 1000:
+            Patient.objects.bulk_update(batch, ['next_followup_date', 'last_followup_date'])
+            batch = []
+    Patient.objects.bulk_update(batch, ['next_followup_date', 'last_followup_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0053_patient_balance_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='last_followup_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='next_followup_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['next_followup_date', 'id'], name='patients_next_followup'),
+        ),
+        migrations.RunPython(fill_followup_dates, migrations.RunPython.noop),
+    ]
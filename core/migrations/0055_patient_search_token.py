@@ -0,0 +1,89 @@
+# Generated by Django 5.2.5 on 2026-10-16 23:30
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# The tokenizer of core/search.py as it was when this migration was written,
+# copied so later changes to it do not change what this migration does
+_FOLDS = (
+    ('zh', 'l'), ('th', 't'), ('dh', 'd'), ('kh', 'k'), ('gh', 'g'), ('bh', 'b'),
+    ('ph', 'f'), ('sh', 's'), ('ee', 'i'), ('oo', 'u'), ('w', 'v'), ('q', 'k'), ('z', 's'),
+)
+_DOUBLE = re.compile(r'(.)\1+')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def _fold_word(word):
+    if not word.isascii():
+        return word
+    for spelling, folded in _FOLDS:
+        word = word.replace(spelling, folded)
+    return _DOUBLE.sub(r'\1', word)
+
+
+def _normalise_name(value):
+    text = unicodedata.normalize('NFKD', value or '')
+    kept = []
+    for ch in text:
+        if unicodedata.combining(ch) and (not kept or kept[-1].isascii()):
+            continue
+        kept.append(ch)
+    words = _NON_WORD.sub(' ', ''.join(kept).lower()).split()
+    return [_fold_word(''.join(ch for ch in word if not ch.isdigit())) for word in words]
+
+
+def _trigrams(kind, word):
+    word = f'^{word}$'
+    return {f'{kind}:{word[i:i + 3]}' for i in range(len(word) - 2)}
+
+
+def patient_tokens(name, file_number):
+    tokens = set()
+    for word in _normalise_name(name):
+        if word:
+            tokens |= _trigrams('n', word)
+    file_number = re.sub(r'[\W_]', '', file_number or '').lower()
+    if file_number:
+        tokens |= _trigrams('f', file_number)
+    return tokens
+
+
+def index_patients(apps, schema_editor):
+    """Tokens for the existing patients, so searches work right after the migration."""
+    Patient = apps.get_model('core', 'Patient')
+    PatientSearchToken = apps.get_model('core', 'PatientSearchToken')
+    batch = []
+    for patient in Patient.objects.only('pk', 'name', 'file_number').iterator(chunk_size=5000):
+        batch.extend(PatientSearchToken(patient_id=patient.pk, token=token)
+                     for token in patient_tokens(patient.name, patient.file_number))
+        if len(batch) >= 5000:
+            PatientSearchToken.objects.bulk_create(batch)
+            batch = []
+    PatientSearchToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0054_patient_followup_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=8)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='core.patient')),
+            ],
+            options={
+                'verbose_name_plural': 'Patient Search Tokens',
+                'db_table': 'patient_search_tokens',
+                'constraints': [models.UniqueConstraint(fields=('token', 'patient'), name='patient_search_token_key')],
+            },
+        ),
+        migrations.RunPython(index_patients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.2.5 on 2026-10-16 23:55
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def canonical_phone(value):
+    """core.phones.canonical_phone as it was when this migration was written."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    if not digits:
+        return ''
+    if value.startswith('+'):
+        return digits
+    if digits.startswith('00'):
+        return digits[2:]
+    national = digits.lstrip('0')
+    if len(national) == 10:
+        return getattr(settings, 'PHONE_COUNTRY_CODE', '91') + national
+    return national
+
+
+def fill_phone_digits(apps, schema_editor):
+    for model_name in ('Patient', 'Lead', 'User'):
+        model = apps.get_model('core', model_name)
+        batch = []
+        for obj in model.objects.only('pk', 'phone_number').iterator(chunk_size=5000):
+            obj.phone_digits = canonical_phone(obj.phone_number)
+            obj.phone_digits_reversed = obj.phone_digits[::-1]
+            batch.append(obj)
+            if len(batch) >= 1000:
+                model.objects.bulk_update(batch, ['phone_digits', 'phone_digits_reversed'])
+                batch = []
+        model.objects.bulk_update(batch, ['phone_digits', 'phone_digits_reversed'])
+
+
+def drop_phone_search_tokens(apps, schema_editor):
+    """Phones are looked up on phone_digits now, not through search trigrams."""
+    apps.get_model('core', 'PatientSearchToken').objects.filter(token__startswith='p:').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0055_patient_search_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lead',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='phone_digits_reversed',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='phone_digits_reversed',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_digits_reversed',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=17),
+        ),
+        migrations.RunPython(fill_phone_digits, migrations.RunPython.noop),
+        migrations.RunPython(drop_phone_search_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0056_phone_digits'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['patient', '-appointment_date', '-id'], name='appointments_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['patient', '-bill_date', '-id'], name='bills_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='followup',
+            index=models.Index(fields=['patient', '-followup_date', '-id'], name='followups_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='hairconsultation',
+            index=models.Index(fields=['patient', '-consultation_date', '-id'], name='consultations_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='progressphoto',
+            index=models.Index(fields=['patient', '-taken_date', '-id'], name='progress_photos_patient_date'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0057_patient_section_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='followup',
+            index=models.Index(fields=['patient', '-created_at', '-id'], name='followups_patient_created'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['patient', '-date', '-id'], name='payments_patient_date'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0058_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='merged_into',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='merged_patients', to='core.patient'),
+        ),
+        migrations.CreateModel(
+            name='PatientDuplicate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.DecimalField(decimal_places=3, max_digits=4)),
+                ('reasons', models.CharField(blank=True, max_length=200)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('merged', 'Merged'), ('dismissed', 'Not a duplicate')], default='open', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('duplicate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.patient')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duplicate_candidates', to='core.patient')),
+                ('resolved_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Patient Duplicates',
+                'db_table': 'patient_duplicates',
+                'indexes': [models.Index(fields=['status', '-score'], name='patient_duplicates_queue')],
+                'constraints': [models.UniqueConstraint(fields=('patient', 'duplicate'), name='patient_duplicate_pair')],
+            },
+        ),
+    ]
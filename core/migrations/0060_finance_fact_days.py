@@ -0,0 +1,24 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0059_patient_duplicates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinanceFactDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Finance Fact Days',
+                'db_table': 'finance_fact_days',
+            },
+        ),
+    ]
@@ -7,6 +7,7 @@ from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.utils import timezone
 from django.db.models import F, Sum
+from .phones import set_phone_digits
 
 
 # ===============================
@@ -29,6 +30,9 @@ class User(AbstractUser):
     user_type = models.CharField(max_length=20, choices=USER_TYPE_CHOICES)
     phone_regex = RegexValidator(regex=r'^\+?1?\d{9,15}$')
     phone_number = models.CharField(validators=[phone_regex], max_length=17, blank=True)
+    # Canonical / reversed digits of phone_number for indexed lookups (see core/phones.py)
+    phone_digits = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
+    phone_digits_reversed = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
     address = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -40,6 +44,10 @@ class User(AbstractUser):
 
     def __str__(self):
         return self.get_full_name() or self.username
+
+    def save(self, *args, **kwargs):
+        kwargs['update_fields'] = set_phone_digits(self, kwargs.get('update_fields'))
+        super().save(*args, **kwargs)
     
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
@@ -55,13 +63,23 @@ class UserProfile(models.Model):
         db_table = 'user_profiles'
         verbose_name_plural = 'User Profiles'
 
-class EmployeeIdSequence(models.Model):
-    year = models.PositiveIntegerField(unique=True)
+class DocumentSequence(models.Model):
+    """
+    Last number handed out for a document series (patients, bills, expenses,
+    services, employees). `year` is 0 for series that never reset.
+    Numbers are reserved in blocks through utils.next_sequence_number().
+    """
+    prefix = models.CharField(max_length=10)
+    year = models.PositiveIntegerField(default=0)
     last_number = models.PositiveIntegerField(default=0)
 
     class Meta:
-        db_table = 'employee_id_sequences'
-        verbose_name_plural = 'Employee ID Sequences'
+        db_table = 'document_sequences'
+        unique_together = ['prefix', 'year']
+        verbose_name_plural = 'Document Sequences'
+
+    def __str__(self):
+        return f"{self.prefix}{self.year or ''} @ {self.last_number}"
 
 # ===============================
 # BRANCH MANAGEMENT MODELS
@@ -103,6 +121,8 @@ class Patient(models.Model):
     date_of_birth = models.DateField(blank=True, null=True)
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES)
     phone_number = models.CharField(max_length=17)
+    phone_digits = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
+    phone_digits_reversed = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
     email = models.EmailField(blank=True)
     address = models.TextField(blank=True)
     city = models.CharField(max_length=100)
@@ -119,20 +139,45 @@ class Patient(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # Set (with is_active off) when this record was merged into another by core.dedupe
+    merged_into = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+                                    related_name='merged_patients')
 
     # 👉 Persistent running balance
     balance = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal("0.00"))
     # > 0 = Due, < 0 = Advance
+    # Computed by the database from balance, so the list can filter on an index
+    balance_status = models.GeneratedField(
+        expression=models.Case(
+            models.When(balance__gt=0, then=models.Value('due')),
+            models.When(balance__lt=0, then=models.Value('advance')),
+            default=models.Value('settled'),
+        ),
+        output_field=models.CharField(max_length=8),
+        db_persist=True,
+    )
+
+    # Kept from FollowUp by core.followups: the nearest scheduled follow-up on or
+    # after today (else the latest missed one), and the latest one before today
+    next_followup_date = models.DateField(null=True, blank=True, editable=False)
+    last_followup_date = models.DateField(null=True, blank=True, editable=False)
 
     class Meta:
         db_table = 'patients'
         verbose_name_plural = 'Patients'
+        indexes = [
+            # The patient list pages on (created_at, id) newest first, optionally by balance status
+            models.Index(fields=['-created_at', '-id'], name='patients_created_id'),
+            models.Index(fields=['balance_status', '-created_at', '-id'], name='patients_balance_created'),
+            # Follow-up worklist: a range scan on the date, paged on (date, id)
+            models.Index(fields=['next_followup_date', 'id'], name='patients_next_followup'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.file_number:
-            year = timezone.now().year
-            count = Patient.objects.filter(created_at__year=year).count() + 1
-            self.file_number = f"DLP{year}{count:05d}"
+            from .utils import next_document_number
+            self.file_number = next_document_number('DLP', 5)
+        kwargs['update_fields'] = set_phone_digits(self, kwargs.get('update_fields'))
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -161,15 +206,8 @@ class Service(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.code:
-            prefix = "SRV"
-            n = 1
-            last = Service.objects.exclude(code="").order_by("-created_at").first()
-            if last and last.code.startswith(prefix) and last.code[len(prefix):].isdigit():
-                n = int(last.code[len(prefix):]) + 1
-            # ensure uniqueness even if race (simple loop)
-            while Service.objects.filter(code=f"{prefix}{n:04d}").exists():
-                n += 1
-            self.code = f"{prefix}{n:04d}"
+            from .utils import next_document_number
+            self.code = next_document_number('SRV', 4, yearly=False)
         super().save(*args, **kwargs)
 
 
@@ -249,6 +287,10 @@ class HairConsultation(models.Model):
     class Meta:
         db_table = 'hair_consultations'
         verbose_name_plural = 'Hair Consultations'
+        indexes = [
+            # patient_detail pages a patient's rows newest first
+            models.Index(fields=['patient', '-consultation_date', '-id'], name='consultations_patient_date'),
+        ]
     
     def __str__(self):
         return f"{self.patient.name} - {self.consultation_date.strftime('%Y-%m-%d')}"
@@ -352,6 +394,10 @@ class Appointment(models.Model):
         db_table = 'appointments'
         ordering = ['appointment_date']
         verbose_name_plural = 'Appointments'
+        indexes = [
+            # patient_detail pages a patient's rows newest first
+            models.Index(fields=['patient', '-appointment_date', '-id'], name='appointments_patient_date'),
+        ]
 
     def __str__(self):
         return f"Appointment for {self.patient.name} on {self.appointment_date.strftime('%Y-%m-%d %H:%M')}"
@@ -446,6 +492,12 @@ class FollowUp(models.Model):
     class Meta:
         db_table = 'followups'
         verbose_name_plural = 'Follow Ups'
+        indexes = [
+            # patient_detail pages a patient's rows newest first
+            models.Index(fields=['patient', '-followup_date', '-id'], name='followups_patient_date'),
+            # The patient timeline orders follow-ups by when they were recorded
+            models.Index(fields=['patient', '-created_at', '-id'], name='followups_patient_created'),
+        ]
 
 class ProgressPhoto(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
@@ -457,6 +509,10 @@ class ProgressPhoto(models.Model):
     class Meta:
         db_table = 'progress_photos'
         verbose_name_plural = 'Progress Photos'
+        indexes = [
+            # patient_detail pages a patient's rows newest first
+            models.Index(fields=['patient', '-taken_date', '-id'], name='progress_photos_patient_date'),
+        ]
 
 # ===============================
 # INVENTORY & PHARMACY MODELS
@@ -610,6 +666,8 @@ class Bill(models.Model):
 
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     paid_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
+    # Bumped by every payment ledger entry; with updated_at it versions cached receipts
+    payment_revision = models.PositiveIntegerField(default=0)
 
     remark = models.TextField(blank=True, default='')
     created_by = models.ForeignKey('User', on_delete=models.SET_NULL, null=True)
@@ -618,6 +676,12 @@ class Bill(models.Model):
         db_table = 'bills'
         ordering = ['-bill_date']
         verbose_name_plural = 'Bills'
+        indexes = [
+            # Bill lists filter on type and page on (bill_date, id) newest first
+            models.Index(fields=['bill_type', '-bill_date', '-id'], name='bills_type_date_id'),
+            # patient_detail pages a patient's rows newest first
+            models.Index(fields=['patient', '-bill_date', '-id'], name='bills_patient_date'),
+        ]
 
     def __str__(self):
         return self.bill_number or (f"Bill for {self.patient.name}" if self.patient_id else "Bill")
@@ -626,8 +690,8 @@ class Bill(models.Model):
         # CRITICAL: Only update patient balance when explicitly requested
         update_patient_balance = kwargs.pop('update_patient_balance', False)
         
-        # Correctly detect first save
-        creating = self._state.adding or not type(self).objects.filter(pk=self.pk).exists()
+        # UUID pks are set before the first save, so rely on _state rather than the pk
+        creating = self._state.adding
 
         # Calculate balance delta only if requested
         balance_delta = Decimal('0.00')
@@ -640,9 +704,8 @@ class Bill(models.Model):
 
         # Generate bill number on create
         if creating and not self.bill_number:
-            year = timezone.now().year
-            count = type(self).objects.filter(bill_date__year=year).count() + 1
-            self.bill_number = f"INV{year}{count:06d}"
+            from .utils import next_document_number
+            self.bill_number = next_document_number('INV', 6)
 
         super().save(*args, **kwargs)
 
@@ -708,7 +771,7 @@ class BillItem(models.Model):
         self.total_price = (self.unit_price or Decimal('0.00')) * (self.quantity or 0)
 
         # Compute delta vs previous value to update bill.total_amount
-        if self._state.adding or not type(self).objects.filter(pk=self.pk).exists():
+        if self._state.adding:
             delta = self.total_price
         else:
             old = type(self).objects.only('total_price').get(pk=self.pk)
@@ -728,44 +791,52 @@ class BillItem(models.Model):
 
 
 class Payment(models.Model):
+    """
+    Append-only payment ledger. Edits never rewrite an entry; they post a
+    correction for the difference. Bill.paid_amount and Patient.balance are
+    moved by each new entry, so they always equal the ledger sums.
+    """
     class Meta:
         verbose_name_plural = 'Payments'
+        indexes = [
+            # The patient timeline pages a patient's ledger newest first
+            models.Index(fields=['patient', '-date', '-id'], name='payments_patient_date'),
+        ]
     PAYMENT_METHOD_CHOICES = [('cash', 'Cash'), ('card', 'Card'), ('upi', 'UPI'), ('cheque', 'Cheque')]
+    ENTRY_TYPE_CHOICES = [('payment', 'Payment'), ('correction', 'Correction')]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     patient = models.ForeignKey('Patient', on_delete=models.CASCADE, related_name='payments')
     bill = models.ForeignKey('Bill', related_name='payments', on_delete=models.SET_NULL, null=True, blank=True)
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    entry_type = models.CharField(max_length=15, choices=ENTRY_TYPE_CHOICES, default='payment')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)  # negative for corrections
     method = models.CharField(max_length=50, choices=PAYMENT_METHOD_CHOICES)
     date = models.DateTimeField(auto_now_add=True)
     received_by = models.ForeignKey('User', on_delete=models.SET_NULL, null=True, blank=True)
 
     def save(self, *args, **kwargs):
-        D0 = Decimal('0.00')
-
-        creating = self._state.adding or not type(self).objects.filter(pk=self.pk).exists()
-        if creating:
-            old_amount = D0
-        else:
-            old_amount = type(self).objects.only('amount').get(pk=self.pk).amount or D0
+        # Callers that write bill.paid_amount and the balance themselves pass False
+        update_totals = kwargs.pop('update_totals', True)
 
-        delta = (self.amount or D0) - old_amount
+        if not self._state.adding:
+            raise ValueError("Payments are append-only; post a correction entry instead.")
 
         super().save(*args, **kwargs)
 
-        # Payment reduces patient balance (increases payment/advance)
-        if self.patient_id and delta != D0:
+        amount = self.amount or Decimal('0.00')
+        if update_totals and amount:
+            if self.bill_id:
+                Bill.objects.filter(pk=self.bill_id).update(
+                    paid_amount=F('paid_amount') + amount,
+                    payment_revision=F('payment_revision') + 1,
+                )
+            # Payment reduces patient balance (increases payment/advance)
             type(self.patient).objects.filter(pk=self.patient_id).update(
-                balance=F('balance') - delta
+                balance=F('balance') - amount
             )
 
     def delete(self, *args, **kwargs):
-        # When payment is deleted, add the amount back to patient balance
-        if self.patient_id and self.amount:
-            type(self.patient).objects.filter(pk=self.patient_id).update(
-                balance=F('balance') + self.amount
-            )
-        super().delete(*args, **kwargs)
+        raise ValueError("Payments are append-only; post a correction entry instead.")
 
     def __str__(self):
         return f"{self.amount} ({self.method}) for {self.patient.name}"
@@ -808,6 +879,8 @@ class Lead(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=200)
     phone_number = models.CharField(max_length=17)
+    phone_digits = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
+    phone_digits_reversed = models.CharField(max_length=17, blank=True, editable=False, db_index=True)
     email = models.EmailField(blank=True)
     age = models.PositiveIntegerField(null=True, blank=True)
     location = models.CharField(max_length=200, blank=True)
@@ -835,6 +908,10 @@ class Lead(models.Model):
     
     def __str__(self):
         return f"{self.name} - {self.phone_number}"
+
+    def save(self, *args, **kwargs):
+        kwargs['update_fields'] = set_phone_digits(self, kwargs.get('update_fields'))
+        super().save(*args, **kwargs)
     
     def convert_to_patient(self, registered_by=None):
         from .models import Patient  # local import to avoid circular
@@ -915,10 +992,8 @@ class Expense(models.Model):
     
     def save(self, *args, **kwargs):
         if not self.expense_number:
-            from django.utils import timezone
-            year = timezone.now().year
-            count = Expense.objects.filter(created_at__year=year).count() + 1
-            self.expense_number = f"EXP{year}{count:05d}"
+            from .utils import next_document_number
+            self.expense_number = next_document_number('EXP', 5)
         super().save(*args, **kwargs)
 
 # ===============================
@@ -957,3 +1032,149 @@ class DailyReport(models.Model):
         ordering = ['-report_date']
         verbose_name_plural = 'Daily Reports'
 
+
+
+class FinanceFact(models.Model):
+    """
+    Daily finance totals by bill type, item kind, patient district and payment
+    method, maintained by core/finance_facts.py. Bill rows have an empty
+    item_kind and payment_method (billed = bill totals), item rows carry the
+    kind (billed = line totals, quantity) and collection rows carry the
+    payment method (collected = payments on bills of that day).
+    """
+    day = models.DateField()
+    bill_type = models.CharField(max_length=10)
+    item_kind = models.CharField(max_length=10, blank=True, default='')
+    district = models.CharField(max_length=100, blank=True, default='')
+    payment_method = models.CharField(max_length=50, blank=True, default='')
+
+    billed = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    collected = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    quantity = models.IntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'finance_facts'
+        ordering = ['-day']
+        verbose_name_plural = 'Finance Facts'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'bill_type', 'item_kind', 'district', 'payment_method'],
+                name='finance_facts_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.bill_type} {self.item_kind or 'bill'} {self.district} {self.payment_method}".strip()
+
+
+class FinanceFactDay(models.Model):
+    """
+    One row per day rebuilt by core/finance_facts.py, locked while the day's
+    facts are read and replaced so two rebuilds of a day run one after the other.
+    """
+    day = models.DateField(unique=True)
+
+    class Meta:
+        db_table = 'finance_fact_days'
+        verbose_name_plural = 'Finance Fact Days'
+
+    def __str__(self):
+        return str(self.day)
+
+
+class PatientSearchToken(models.Model):
+    """
+    One trigram of a patient's normalised name or file number, maintained by
+    core/search.py. The (token, patient) key is what patient
+    search scans.
+    """
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=8)
+
+    class Meta:
+        db_table = 'patient_search_tokens'
+        verbose_name_plural = 'Patient Search Tokens'
+        constraints = [
+            models.UniqueConstraint(fields=['token', 'patient'], name='patient_search_token_key'),
+        ]
+
+    def __str__(self):
+        return self.token
+
+
+class PatientDuplicate(models.Model):
+    """
+    Two patients that core/dedupe.py thinks are the same person. `patient` is
+    the older record, kept when the pair is merged; `duplicate` is folded into it.
+    """
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('merged', 'Merged'),
+        ('dismissed', 'Not a duplicate'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='duplicate_candidates')
+    duplicate = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    score = models.DecimalField(max_digits=4, decimal_places=3)
+    reasons = models.CharField(max_length=200, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+    created_at = models.DateTimeField(auto_now_add=True)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+    resolved_by = models.ForeignKey('User', on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        db_table = 'patient_duplicates'
+        verbose_name_plural = 'Patient Duplicates'
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'duplicate'], name='patient_duplicate_pair'),
+        ]
+        indexes = [
+            # Review queue: open pairs, most likely first
+            models.Index(fields=['status', '-score'], name='patient_duplicates_queue'),
+        ]
+
+    def __str__(self):
+        return f"{self.duplicate} → {self.patient}"
+
+
+class ReportJob(models.Model):
+    """
+    A report run in the background by `manage.py run_report_worker`. Jobs are
+    keyed by report parameters and the data version they were built from, so a
+    repeated request for unchanged data reuses the finished job and its files
+    (see core/report_jobs.py).
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    report = models.CharField(max_length=30)
+    params = models.JSONField(default=dict)
+    params_key = models.CharField(max_length=64)
+    data_version = models.CharField(max_length=64)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    progress = models.PositiveSmallIntegerField(default=0)  # percent
+    error = models.TextField(blank=True)
+
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'report_jobs'
+        ordering = ['-created_at']
+        verbose_name_plural = 'Report Jobs'
+        indexes = [
+            models.Index(fields=['params_key', 'data_version'], name='report_jobs_key'),
+            models.Index(fields=['status', 'created_at'], name='report_jobs_queue'),
+        ]
+
+    def __str__(self):
+        return f"{self.report} {self.params} ({self.get_status_display()})"
@@ -0,0 +1,106 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are selected with a WHERE on the ordering columns instead of OFFSET, so
+every page costs the same index range scan however deep the user goes. The
+ordering must end in a unique column (normally the pk). Cursors are opaque,
+URL-safe strings holding the ordering values of the first/last row of a page.
+Grouped values() querysets work too: ordering on an aggregate annotation
+turns the cursor condition into a HAVING clause.
+"""
+import base64
+import json
+from dataclasses import dataclass, field
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+@dataclass
+class KeysetPage:
+    items: list = field(default_factory=list)
+    has_next: bool = False
+    has_previous: bool = False
+    next_cursor: str = ''
+    previous_cursor: str = ''
+
+
+def _split(order):
+    return (order[1:], True) if order.startswith('-') else (order, False)
+
+
+def encode_cursor(obj, ordering):
+    values = []
+    for order in ordering:
+        name, _ = _split(order)
+        value = obj[name] if isinstance(obj, dict) else getattr(obj, name)
+        values.append(value.isoformat() if hasattr(value, 'isoformat') else str(value))
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def _ordering_field(queryset, name):
+    annotation = queryset.query.annotations.get(name)
+    if annotation is not None:
+        return annotation.output_field
+    model = queryset.model
+    return model._meta.pk if name in ('pk', 'id') else model._meta.get_field(name)
+
+
+def decode_cursor(cursor, queryset, ordering):
+    """Ordering values from a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if len(raw) != len(ordering):
+            return None
+        values = []
+        for order, value in zip(ordering, raw):
+            name, _ = _split(order)
+            values.append(_ordering_field(queryset, name).to_python(value))
+        return values
+    except (ValueError, TypeError, ValidationError, LookupError):
+        return None
+
+
+def _after(ordering, values, backwards=False):
+    """Q selecting rows strictly after `values` in `ordering` (or before, if backwards)."""
+    q = Q()
+    equal = {}
+    for order, value in zip(ordering, values):
+        name, desc = _split(order)
+        lookup = 'lt' if desc != backwards else 'gt'
+        q |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return q
+
+
+def keyset_page(queryset, ordering, after=None, before=None, per_page=50):
+    """
+    Return one KeysetPage of `queryset` in `ordering` (e.g. ('-bill_date', '-id')),
+    starting after the `after` cursor or ending before the `before` cursor.
+    """
+    after_values = decode_cursor(after, queryset, ordering)
+    before_values = None if after_values else decode_cursor(before, queryset, ordering)
+
+    if before_values:
+        reverse = [order[1:] if order.startswith('-') else f'-{order}' for order in ordering]
+        rows = list(queryset.filter(_after(ordering, before_values, backwards=True))
+                    .order_by(*reverse)[:per_page + 1])
+        has_previous = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_next = True
+    else:
+        qs = queryset.order_by(*ordering)
+        if after_values:
+            qs = qs.filter(_after(ordering, after_values))
+        rows = list(qs[:per_page + 1])
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_previous = after_values is not None
+
+    page = KeysetPage(items=items, has_next=has_next and bool(items), has_previous=has_previous and bool(items))
+    if items:
+        page.next_cursor = encode_cursor(items[-1], ordering)
+        page.previous_cursor = encode_cursor(items[0], ordering)
+    return page
@@ -0,0 +1,171 @@
+"""
+Bulk patient import.
+
+Rows are streamed from a CSV or XLSX file (first row = column names, as in
+PatientForm: name, age, gender, phone_number, city, district, ...) and checked
+with the clean() of PatientForm's own form fields, so an imported patient
+passes the same rules as one typed into patient_create. Valid rows are
+inserted BATCH_SIZE at a time, each batch in one transaction: one locked
+DocumentSequence update reserves the batch's file numbers, one bulk_create
+writes the patients and one more their search tokens. bulk_create skips
+Patient.save() and its signals, so what they would fill in (file number,
+phone digits, search tokens) is done here per batch, and today's report is
+refreshed once at the end. Rejected rows are handed to
+on_reject(line, values, errors) with the line number of the file and the raw
+values, in the file's column order.
+"""
+import codecs
+import copy
+import csv
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .forms import PatientForm
+from .models import Patient
+from .phones import set_phone_digits
+from .rollups import mark_report_day
+from .search import index_new_patients
+from .utils import reserve_document_numbers
+
+BATCH_SIZE = 2000
+
+IMPORT_FIELDS = PatientForm._meta.fields
+REQUIRED_COLUMNS = [name for name in IMPORT_FIELDS if PatientForm.base_fields[name].required]
+# Other names the column may have in an export of the old software
+COLUMN_ALIASES = {
+    'patient_name': 'name',
+    'dob': 'date_of_birth',
+    'sex': 'gender',
+    'phone': 'phone_number',
+    'mobile': 'phone_number',
+    'mobile_number': 'phone_number',
+    'pin': 'pincode',
+    'pin_code': 'pincode',
+    'referred': 'referred_by',
+    'source': 'referral_source',
+}
+DATE_INPUT_FORMATS = ['%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y', '%d.%m.%Y']
+GENDER_VALUES = {
+    **{value: value for value, _ in Patient.GENDER_CHOICES},
+    **{label.lower(): value for value, label in Patient.GENDER_CHOICES},
+    'm': 'male', 'f': 'female', 'other': 'others',
+}
+
+
+def read_spreadsheet(fileobj, filename):
+    """
+    (header, rows) of an uploaded or opened .csv/.xlsx file; rows is an
+    iterator of value lists. Raises ImportError for XLSX without openpyxl.
+    """
+    if filename.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+    else:
+        # utf-8-sig: Excel saves CSV with a BOM
+        rows = csv.reader(codecs.iterdecode(fileobj, 'utf-8-sig'))
+    header = next(rows, None) or []
+    return ['' if name is None else str(name) for name in header], rows
+
+
+def column_name(name):
+    name = '_'.join(str(name).strip().lower().replace('-', ' ').split())
+    return COLUMN_ALIASES.get(name, name)
+
+
+def _import_fields():
+    fields = {name: copy.deepcopy(PatientForm.base_fields[name]) for name in IMPORT_FIELDS}
+    fields['date_of_birth'].input_formats = DATE_INPUT_FORMATS
+    return fields
+
+
+def clean_row(fields, raw, today):
+    """(data, errors) for one row given as {field: raw value}."""
+    data, errors = {}, []
+    for name, field in fields.items():
+        value = raw.get(name)
+        if value is None:
+            value = ''
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)  # XLSX numbers: ages, phone numbers, pin codes
+        if isinstance(field, forms.CharField) and not isinstance(value, str):
+            value = str(value)
+        if name == 'gender' and isinstance(value, str):
+            value = GENDER_VALUES.get(value.strip().lower(), value)
+        try:
+            data[name] = field.clean(value)
+        except ValidationError as e:
+            errors.append(f"{name}: {' '.join(e.messages)}")
+    if data.get('date_of_birth') and data['date_of_birth'] > today:
+        errors.append("date_of_birth: Date of birth cannot be in the future.")
+    return data, errors
+
+
+def _insert(batch, user):
+    with transaction.atomic():
+        numbers = reserve_document_numbers('DLP', 5, len(batch))
+        patients = []
+        for data, file_number in zip(batch, numbers):
+            patient = Patient(**data, file_number=file_number, registered_by=user)
+            set_phone_digits(patient)
+            patients.append(patient)
+        Patient.objects.bulk_create(patients, batch_size=BATCH_SIZE)
+        index_new_patients(patients)
+
+
+def import_patients(header, rows, user=None, on_reject=None, on_progress=None, batch_size=BATCH_SIZE):
+    """
+    Import the rows of read_spreadsheet(). on_progress(imported, rejected) is
+    called after each batch. Returns (imported, rejected).
+    Raises ValueError when a required column is missing.
+    """
+    columns = [column_name(name) for name in header]
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    used = [(i, name) for i, name in enumerate(columns) if name in IMPORT_FIELDS]
+
+    fields = _import_fields()
+    today = timezone.localdate()
+    imported = rejected = 0
+    batch = []
+    for line, values in enumerate(rows, start=2):
+        values = list(values)
+        if not any(value not in (None, '') for value in values):
+            continue  # blank line
+        raw = {name: values[i] if i < len(values) else None for i, name in used}
+        data, errors = clean_row(fields, raw, today)
+        if errors:
+            rejected += 1
+            if on_reject:
+                on_reject(line, values, errors)
+            continue
+        batch.append(data)
+        if len(batch) >= batch_size:
+            _insert(batch, user)
+            imported += len(batch)
+            batch = []
+            if on_progress:
+                on_progress(imported, rejected)
+    if batch:
+        _insert(batch, user)
+        imported += len(batch)
+        if on_progress:
+            on_progress(imported, rejected)
+    if imported:
+        mark_report_day(timezone.now())  # once for the whole file, not per batch
+    return imported, rejected
+
+
+def reject_writer(out, header):
+    """on_reject callback writing rejected rows as CSV to `out`: the row, then its line and errors."""
+    writer = csv.writer(out)
+    writer.writerow([*header, 'line', 'errors'])
+
+    def on_reject(line, values, errors):
+        writer.writerow([*values, line, '; '.join(errors)])
+    return on_reject
@@ -0,0 +1,66 @@
+"""
+Canonical phone numbers.
+
+Patient, Lead and User keep two indexed copies of phone_number next to it:
+phone_digits, the number as E.164 digits without the '+' (country code plus
+national number, e.g. 919847012345), and phone_digits_reversed, the same
+digits backwards. An exact number, a number prefix (phone_digits LIKE
+'9198470%') and the last digits a caller reads out (phone_digits_reversed
+LIKE '54321%') are then all index range scans, and records can be joined on
+phone_digits.
+"""
+import re
+
+from django.conf import settings
+from django.db.models import Q
+
+DEFAULT_COUNTRY_CODE = getattr(settings, 'PHONE_COUNTRY_CODE', '91')
+NATIONAL_NUMBER_LENGTH = 10
+
+
+def canonical_phone(value):
+    """E.164 digits of a phone number as typed ('+91 98470 12345', '098470 12345', ...); '' if none."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    if not digits:
+        return ''
+    if value.startswith('+'):
+        return digits
+    if digits.startswith('00'):
+        return digits[2:]
+    national = digits.lstrip('0')
+    if len(national) == NATIONAL_NUMBER_LENGTH:
+        return DEFAULT_COUNTRY_CODE + national
+    return national
+
+
+def set_phone_digits(obj, update_fields=None):
+    """
+    Fill obj.phone_digits / phone_digits_reversed from obj.phone_number before
+    a save; returns update_fields with the derived columns added when needed.
+    """
+    obj.phone_digits = canonical_phone(obj.phone_number)
+    obj.phone_digits_reversed = obj.phone_digits[::-1]
+    if update_fields is not None and 'phone_number' in update_fields:
+        update_fields = {*update_fields, 'phone_digits', 'phone_digits_reversed'}
+    return update_fields
+
+
+def phone_q(query, path=''):
+    """
+    Q matching phone numbers by what was typed: a full number exactly,
+    otherwise numbers ending in or starting with the digits. None when the
+    query has no digits. `path` leads to the phone owner, e.g. 'patient__'.
+    """
+    digits = re.sub(r'\D', '', query or '')
+    if not digits:
+        return None
+    # istartswith on digits means the same and compiles to a plain LIKE 'x%' on
+    # MySQL (startswith uses LIKE BINARY, which cannot range-scan the index)
+    canonical = canonical_phone(query)
+    if len(canonical) > NATIONAL_NUMBER_LENGTH:
+        return Q(**{f'{path}phone_digits': canonical})
+    if query.strip().startswith('+'):
+        return Q(**{f'{path}phone_digits__istartswith': digits})
+    return (Q(**{f'{path}phone_digits_reversed__istartswith': digits[::-1]})
+            | Q(**{f'{path}phone_digits__istartswith': DEFAULT_COUNTRY_CODE + digits}))
@@ -0,0 +1,136 @@
+"""
+Print-ready receipt cache.
+
+A receipt is rendered once per bill version from bills/public_receipt.html and
+kept on disk under RECEIPT_CACHE_DIR/<bill id>/<version>.html. The version is
+built from Bill.updated_at (header and item edits), Bill.payment_revision
+(every payment ledger entry) and the patient's updated_at (name and contact on
+the receipt), so any change produces a new file and repeat views only need
+one small lookup to find it.
+
+Because the version changes with every edit, a (bill id, version) pair is an
+immutable snapshot: public links carry it and can be answered from the file on
+disk, or with 304 Not Modified, without touching the database.
+"""
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from .models import Bill, Payment
+
+D0 = Decimal('0.00')
+
+
+def _cache_root():
+    return Path(getattr(settings, 'RECEIPT_CACHE_DIR', Path(settings.BASE_DIR) / 'receipt_cache'))
+
+
+def receipt_version(updated_at, payment_revision, patient_updated_at):
+    return "{}-{}-{}".format(
+        int(updated_at.timestamp() * 1_000_000),
+        payment_revision,
+        int(patient_updated_at.timestamp() * 1_000_000) if patient_updated_at else 0,
+    )
+
+
+VERSION_RE = re.compile(r'^(\d{1,20})-(\d{1,10})-(\d{1,20})$')
+
+
+def version_last_modified(version):
+    """
+    Last-Modified time encoded in a version string (the later of the bill and
+    patient timestamps), or None if the string is not a receipt version.
+    """
+    m = VERSION_RE.match(version or '')
+    if not m:
+        return None
+    micros = max(int(m.group(1)), int(m.group(3)))
+    return datetime.fromtimestamp(micros / 1_000_000, tz=dt_timezone.utc)
+
+
+def bill_receipt_version(bill_id):
+    """Current receipt version of a bill (one indexed lookup), or None if it does not exist."""
+    row = (Bill.objects.filter(pk=bill_id)
+           .values_list('updated_at', 'payment_revision', 'patient__updated_at')
+           .first())
+    return receipt_version(*row) if row else None
+
+
+def receipt_context(bill):
+    """Everything public_receipt.html needs, from one items query and one payment lookup."""
+    items = list(bill.items.all())
+    subtotal = sum((it.total_price or D0 for it in items), D0)
+    total = bill.total_amount or D0
+    paid = bill.paid_amount or D0  # kept in step with the payment ledger
+    balance_for_this_bill = max(D0, total - paid)
+
+    last_method = (bill.payments.filter(entry_type='payment')
+                   .order_by('-date').values_list('method', flat=True).first())
+    method_display = dict(Payment.PAYMENT_METHOD_CHOICES).get(last_method, '')
+
+    if balance_for_this_bill <= 0 and total > 0:
+        bill_status = "Paid in full"
+    elif paid > 0:
+        bill_status = "Partially paid"
+    else:
+        bill_status = "Unpaid"
+
+    return {
+        'bill': bill,
+        'items': items,
+        'subtotal': subtotal,
+        'paid': paid,
+        'balance_for_this_bill': balance_for_this_bill,
+        'method_display': method_display,
+        'bill_status': bill_status,
+    }
+
+
+def snapshot_path(bill_id, version):
+    """Path of an already rendered snapshot, or None. Never queries the database."""
+    if not VERSION_RE.match(version or ''):
+        return None
+    path = _cache_root() / str(bill_id) / f"{version}.html"
+    return path if path.exists() else None
+
+
+def cached_receipt_path(bill_id, version=None):
+    """
+    Return the path of the rendered receipt for the bill's current version,
+    rendering and storing it first if needed. Returns None for unknown bills.
+    Older versions of the same bill are removed when a new one is written.
+    """
+    version = version or bill_receipt_version(bill_id)
+    if version is None:
+        return None
+
+    bill_dir = _cache_root() / str(bill_id)
+    path = bill_dir / f"{version}.html"
+    if path.exists():
+        return path
+
+    bill = Bill.objects.select_related('patient').get(pk=bill_id)
+    html = render_to_string('bills/public_receipt.html', receipt_context(bill))
+
+    bill_dir.mkdir(parents=True, exist_ok=True)
+    # Write to a temp file and rename, so a concurrent reader never sees half a file
+    fd, tmp = tempfile.mkstemp(dir=bill_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+        fh.write(html)
+    os.replace(tmp, path)
+
+    for old in bill_dir.glob('*.html'):
+        if old.name != path.name:
+            old.unlink(missing_ok=True)
+    return path
+
+
+def discard_cached_receipts(bill_id):
+    shutil.rmtree(_cache_root() / str(bill_id), ignore_errors=True)
@@ -0,0 +1,89 @@
+"""
+Receivables aging.
+
+What is still due on each bill (total_amount - paid_amount, where paid_amount
+is the sum of the payments allocated to the bill) is bucketed by the bill's
+age in local days and summed per patient with conditional aggregation, in a
+single GROUP BY over the unpaid bills. Advances (bills paid over their total)
+are not netted against other bills.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Min, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Bill
+from .search import patient_search_q
+
+D0 = Decimal('0.00')
+
+# (column, label, oldest age in days or None for open ended); each bucket
+# starts the day after the previous one ends
+AGING_BUCKETS = (
+    ('d0_30', '0–30 days', 30),
+    ('d31_60', '31–60 days', 60),
+    ('d61_90', '61–90 days', 90),
+    ('d90_plus', '90+ days', None),
+)
+
+AGING_ORDERING = ('-total', 'patient_id')
+
+
+def _due():
+    return ExpressionWrapper(F('total_amount') - F('paid_amount'),
+                             output_field=DecimalField(max_digits=12, decimal_places=2))
+
+
+def _bucket_filters(today):
+    """{column: Q on bill_date} for every aging bucket, relative to the local day `today`."""
+    tz = timezone.get_current_timezone()
+
+    def cutoff(days):
+        return timezone.make_aware(datetime.combine(today - timedelta(days=days), time.min), tz)
+
+    filters = {}
+    newer_than = None
+    for column, _, oldest in AGING_BUCKETS:
+        q = Q()
+        if oldest is not None:
+            q &= Q(bill_date__gte=cutoff(oldest))
+        if newer_than is not None:
+            q &= Q(bill_date__lt=cutoff(newer_than))
+        filters[column] = q
+        newer_than = oldest
+    return filters
+
+
+def unpaid_bills(search=''):
+    qs = Bill.objects.filter(total_amount__gt=F('paid_amount'))
+    if search:
+        qs = qs.filter(patient_search_q(search, 'patient__'))
+    return qs
+
+
+def aging_by_patient(today=None, search='', bucket=None):
+    """
+    One row per patient with dues: patient_id, file number, name, phone, the
+    amount in each aging bucket, total, number of unpaid bills and the oldest
+    unpaid bill date. With `bucket` only patients with dues in it are kept.
+    """
+    today = today or timezone.localdate()
+    due = _due()
+    buckets = {column: Coalesce(Sum(due, filter=q), D0) for column, q in _bucket_filters(today).items()}
+    qs = (unpaid_bills(search)
+          .values('patient_id', 'patient__file_number', 'patient__name', 'patient__phone_number')
+          .annotate(**buckets, total=Sum(due), bills=Count('id'), oldest=Min('bill_date')))
+    if bucket in buckets:
+        qs = qs.filter(**{f'{bucket}__gt': 0})
+    return qs
+
+
+def aging_totals(rows):
+    """Grand totals of aging_by_patient() rows (same filters) in one query over the grouped rows."""
+    columns = [column for column, _, _ in AGING_BUCKETS] + ['total']
+    return rows.aggregate(
+        **{f'sum_{column}': Coalesce(Sum(column), D0) for column in columns},
+        patients=Count('patient_id'),
+    )
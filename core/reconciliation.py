@@ -0,0 +1,144 @@
+"""
+Reconciliation of denormalised money columns.
+
+Bill.total_amount and Bill.paid_amount, and Patient.balance, are kept up to
+date incrementally from many code paths and can drift. The functions here
+recompute them from their sources with set-based GROUP BY queries, one chunk
+of rows at a time (walking the primary key), so they run on large tables
+without loading them:
+
+    bill total      = sum(bill_items.total_price) + tax - discount
+    bill paid       = sum(payments.amount) for the bill
+    patient balance = sum(bills.total_amount) - sum(payments.amount)
+
+Each function yields a Mismatch for every row that is off and, with fix=True,
+writes the expected values back with one bulk UPDATE per chunk. A repaired
+chunk is locked (SELECT ... FOR UPDATE) and re-read inside its transaction
+before the sums are taken, so an incremental F() update racing the repair
+either lands first and is counted, or waits and applies on top of it.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .finance_facts import mark_finance_day
+from .kpis import mark_changed
+from .models import Bill, BillItem, Patient, Payment
+from .rollups import mark_report_day
+
+D0 = Decimal('0.00')
+CHUNK_SIZE = 5000
+
+Mismatch = namedtuple('Mismatch', 'pk label field stored expected')
+
+
+def _chunks(queryset, fields, chunk_size):
+    """Yield lists of value tuples (pk first) walking the queryset by pk."""
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(qs.values_list('pk', *fields)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def _sums(queryset, key, field):
+    """{key: sum(field)} for the queryset, rounded to paise."""
+    return {
+        k: (s or D0).quantize(D0)
+        for k, s in queryset.values(key).annotate(s=Sum(field)).values_list(key, 's')
+    }
+
+
+def _locked(queryset, ids, fields):
+    """Lock the chunk's rows in pk order and re-read them, so a concurrent update waits for the repair."""
+    return list(queryset.model.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', *fields))
+
+
+def _check_bills(rows):
+    """(mismatches, repairs, bill days) for a chunk of bill rows."""
+    ids = [row[0] for row in rows]
+    item_sums = _sums(BillItem.objects.filter(bill_id__in=ids), 'bill_id', 'total_price')
+    paid_sums = _sums(Payment.objects.filter(bill_id__in=ids), 'bill_id', 'amount')
+
+    found, repairs, days = [], [], set()
+    for pk, number, total, paid, tax, discount, bill_date in rows:
+        expected_total = (item_sums.get(pk) or D0) + (tax or D0) - (discount or D0)
+        expected_paid = paid_sums.get(pk) or D0
+        off = False
+        if (total or D0) != expected_total:
+            off = True
+            found.append(Mismatch(pk, number, 'total_amount', total, expected_total))
+        if (paid or D0) != expected_paid:
+            off = True
+            found.append(Mismatch(pk, number, 'paid_amount', paid, expected_paid))
+        if off:
+            repairs.append(Bill(pk=pk, total_amount=expected_total, paid_amount=expected_paid))
+            days.add(bill_date)
+    return found, repairs, days
+
+
+def reconcile_bills(queryset=None, fix=False, chunk_size=CHUNK_SIZE):
+    """Check (and optionally repair) Bill.total_amount and Bill.paid_amount."""
+    queryset = Bill.objects.all() if queryset is None else queryset
+    fields = ('bill_number', 'total_amount', 'paid_amount', 'tax_amount', 'discount_amount', 'bill_date')
+
+    for rows in _chunks(queryset, fields, chunk_size):
+        if not fix:
+            yield from _check_bills(rows)[0]
+            continue
+        with transaction.atomic():
+            found, repairs, days = _check_bills(_locked(queryset, [row[0] for row in rows], fields))
+            if repairs:
+                # Bump updated_at so anything keyed on it (cached receipts) is refreshed
+                now = timezone.now()
+                for bill in repairs:
+                    bill.updated_at = now
+                Bill.objects.bulk_update(repairs, ['total_amount', 'paid_amount', 'updated_at'])
+                mark_changed('bills', 'payments')
+                # bulk_update sends no post_save: refresh the facts and reports of the repaired days
+                for day in days:
+                    mark_finance_day(day)
+                    mark_report_day(day)
+        yield from found
+
+
+def _check_balances(rows):
+    """(mismatches, repairs) for a chunk of patient rows."""
+    ids = [row[0] for row in rows]
+    billed = _sums(Bill.objects.filter(patient_id__in=ids), 'patient_id', 'total_amount')
+    paid = _sums(Payment.objects.filter(patient_id__in=ids), 'patient_id', 'amount')
+
+    found, repairs = [], []
+    for pk, file_number, balance in rows:
+        expected = (billed.get(pk) or D0) - (paid.get(pk) or D0)
+        if (balance or D0) != expected:
+            found.append(Mismatch(pk, file_number, 'balance', balance, expected))
+            repairs.append(Patient(pk=pk, balance=expected))
+    return found, repairs
+
+
+def reconcile_patient_balances(queryset=None, fix=False, chunk_size=CHUNK_SIZE):
+    """
+    Check (and optionally repair) Patient.balance against bills and payments.
+    Run reconcile_bills first so the balance is built on corrected bill totals.
+    """
+    queryset = Patient.objects.all() if queryset is None else queryset
+    fields = ('file_number', 'balance')
+
+    for rows in _chunks(queryset, fields, chunk_size):
+        if not fix:
+            yield from _check_balances(rows)[0]
+            continue
+        with transaction.atomic():
+            found, repairs = _check_balances(_locked(queryset, [row[0] for row in rows], fields))
+            if repairs:
+                Patient.objects.bulk_update(repairs, ['balance'])
+                mark_changed('bills', 'payments')
+        yield from found
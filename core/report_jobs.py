@@ -0,0 +1,192 @@
+"""
+Background report jobs.
+
+Long finance reports are not computed in the web request. submit_finance_report()
+returns the ReportJob for (parameters, data version): a finished one is reused
+as is, otherwise a job is queued and `manage.py run_report_worker` picks it up,
+reports progress on the row and writes the result to
+REPORT_CACHE_DIR/<job id>/report.html and report.csv.
+
+The data version is a fingerprint of what the report reads: the finance facts
+of the range (every rebuild of a day inserts rows with new ids) and the paid
+expenses and lead counts of the range. Any change gives a new version and so a
+new job. A finished job superseded by a newer result for the same parameters
+stays downloadable for SUPERSEDED_JOB_GRACE (someone may have the page open),
+then the worker's sweep deletes it and its files.
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Sum
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .finance_facts import day_bounds, finance_summary
+from .models import Expense, FinanceFact, Lead, ReportJob
+
+ARTIFACTS = {
+    'html': ('report.html', 'text/html; charset=utf-8'),
+    'csv': ('report.csv', 'text/csv; charset=utf-8'),
+}
+
+# Facts are summed one month at a time so the job can report progress
+FINANCE_CHUNK_DAYS = 31
+# How long an out-of-date result stays downloadable after a newer one is done
+SUPERSEDED_JOB_GRACE = timedelta(hours=1)
+
+
+def _cache_root():
+    return Path(getattr(settings, 'REPORT_CACHE_DIR', Path(settings.BASE_DIR) / 'report_cache'))
+
+
+def artifact_path(job, fmt):
+    return _cache_root() / str(job.pk) / ARTIFACTS[fmt][0]
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def finance_data_version(start, end):
+    facts = FinanceFact.objects.filter(day__gte=start, day__lte=end).aggregate(n=Count('id'), last=Max('id'))
+    expenses = Expense.objects.filter(expense_date__gte=start, expense_date__lte=end, status='paid').aggregate(
+        n=Count('id'), s=Sum('amount'))
+    lo, hi = day_bounds(start, end)
+    leads = Lead.objects.filter(created_at__gte=lo, created_at__lt=hi).aggregate(
+        n=Count('id'), converted=Count('id', filter=Q(converted_patient__isnull=False)))
+    return _digest([facts, expenses, leads])
+
+
+def submit_finance_report(start, end, user=None):
+    """The job for this period and the current data: finished, running or newly queued."""
+    params = {'start': start.isoformat(), 'end': end.isoformat()}
+    params_key = _digest(['finance', params])
+    data_version = finance_data_version(start, end)
+
+    job = (ReportJob.objects
+           .filter(params_key=params_key, data_version=data_version)
+           .exclude(status='failed')
+           .first())
+    if job is None:
+        job = ReportJob.objects.create(
+            report='finance', params=params, params_key=params_key,
+            data_version=data_version, requested_by=user,
+        )
+    return job
+
+
+# --- worker side ------------------------------------------------------------
+
+def claim_next_job():
+    """Mark the oldest queued job as running and return it (None if the queue is empty)."""
+    with transaction.atomic():
+        job = (ReportJob.objects
+               .select_for_update(skip_locked=True)
+               .filter(status='queued')
+               .order_by('created_at')
+               .first())
+        if job is None:
+            return None
+        job.status = 'running'
+        job.progress = 0
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'progress', 'started_at'])
+    return job
+
+
+def requeue_stale_jobs(older_than=timedelta(minutes=30), grace=SUPERSEDED_JOB_GRACE):
+    """
+    Put back jobs left 'running' by a worker that died, and delete the
+    finished jobs superseded more than `grace` ago. Returns the number requeued.
+    """
+    requeued = (ReportJob.objects
+                .filter(status='running', started_at__lt=timezone.now() - older_than)
+                .update(status='queued', progress=0))
+    prune_superseded_jobs(grace)
+    return requeued
+
+
+def prune_superseded_jobs(grace=SUPERSEDED_JOB_GRACE):
+    """Delete finished jobs (and their files) with a newer result for the same parameters done before now - grace."""
+    newer = ReportJob.objects.filter(
+        params_key=OuterRef('params_key'), status='done',
+        finished_at__gt=OuterRef('finished_at'), finished_at__lt=timezone.now() - grace,
+    )
+    superseded = ReportJob.objects.filter(Exists(newer), status__in=('done', 'failed'))
+    old_ids = list(superseded.values_list('pk', flat=True))
+    for old_id in old_ids:
+        shutil.rmtree(_cache_root() / str(old_id), ignore_errors=True)
+    ReportJob.objects.filter(pk__in=old_ids).delete()
+    return len(old_ids)
+
+
+def _write(path, write):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temp file and rename, so a download never sees half a file
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8', newline='') as fh:
+        write(fh)
+    os.replace(tmp, path)
+
+
+def _run_finance(job):
+    start = date.fromisoformat(job.params['start'])
+    end = date.fromisoformat(job.params['end'])
+
+    def on_progress(done, total):
+        # Leave the last 10% for expenses, leads and writing the files
+        ReportJob.objects.filter(pk=job.pk).update(progress=int(done * 90 / total))
+
+    summary, by_area = finance_summary(start, end, chunk_days=FINANCE_CHUNK_DAYS, on_progress=on_progress)
+
+    html = render_to_string('reports/finance_job.html', {
+        'summary': summary,
+        'by_area': by_area,
+        'job': job,
+        'generated_at': timezone.localtime(),
+    })
+    _write(artifact_path(job, 'html'), lambda fh: fh.write(html))
+
+    def write_csv(fh):
+        fh.write('\ufeff')  # BOM, so Excel opens ₹ and Malayalam district names correctly
+        writer = csv.writer(fh)
+        writer.writerow(['Metric', 'Value'])
+        for label, key in (
+            ('Period', 'period'), ('Total Billed', 'total_billed'), ('Total Collection', 'total_collection'),
+            ('Expenses (Paid)', 'total_expenses'), ('Net', 'net'),
+            ('Medicine Sale Value', 'total_medicine_sale'), ('Service Sale Value', 'total_service_sale'),
+            ('New Leads', 'total_leads'), ('Converted Leads', 'leads_converted'), ('Open Leads', 'leads_open'),
+        ):
+            writer.writerow([label, summary[key]])
+        writer.writerow(['Lead Conversion %', round(summary['lead_conversion_rate'], 1)])
+        writer.writerow([])
+        writer.writerow(['District', 'Medicine Qty', 'Medicine Sale'])
+        for row in by_area:
+            writer.writerow([row['district'] or '-', row['qty'], row['sale']])
+    _write(artifact_path(job, 'csv'), write_csv)
+
+
+RUNNERS = {
+    'finance': _run_finance,
+}
+
+
+def run_job(job):
+    """Run a claimed job to completion, recording the outcome on the row."""
+    try:
+        RUNNERS[job.report](job)
+    except Exception as e:
+        ReportJob.objects.filter(pk=job.pk).update(
+            status='failed', error=f"{type(e).__name__}: {e}", finished_at=timezone.now())
+        raise
+
+    # Older results for the same parameters are pruned by requeue_stale_jobs() once the grace period is over
+    ReportJob.objects.filter(pk=job.pk).update(status='done', progress=100, finished_at=timezone.now())
@@ -0,0 +1,135 @@
+"""
+Daily roll-up of clinic activity into DailyReport (one row per local day).
+
+rollup_daily_reports(start, end) recomputes every day in the range with one
+GROUP BY per source table (bucketed on the local business day, TIME_ZONE) and
+upserts the rows in bulk, so a backfill over years and a refresh of a single
+day go through the same code. Signals call mark_report_day() when bills,
+payments, appointments, sessions or patients change; the touched days are
+refreshed once per transaction, after it commits.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Appointment, Bill, BillItem, DailyReport, Patient, Payment, TreatmentSession
+from .utils import CommitBatch
+
+D0 = Decimal('0.00')
+
+# DailyReport session columns and the procedure (service) names they count
+SESSION_COLUMNS = {
+    'prp_sessions': ('prp',),
+    'mesotherapy_sessions': ('meso',),
+    'lllt_sessions': ('lllt', 'laser'),
+}
+
+
+def local_day(value):
+    """Local business day of an aware datetime (or a date, unchanged)."""
+    if isinstance(value, datetime):
+        return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    return value
+
+
+def _bounds(start, end):
+    tz = timezone.get_current_timezone()
+    return (timezone.make_aware(datetime.combine(start, time.min), tz),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz))
+
+
+def _by_day(queryset, field, **aggregates):
+    """{day: {name: value}} for the queryset grouped on the local day of `field`."""
+    rows = (queryset.annotate(day=TruncDate(field))
+            .values('day')
+            .annotate(**aggregates)
+            .order_by())
+    return {row.pop('day'): row for row in rows}
+
+
+def rollup_daily_reports(start, end, user=None):
+    """Recompute DailyReport rows for start..end (inclusive). Returns the number of days written."""
+    lo, hi = _bounds(start, end)
+
+    patients = _by_day(Patient.objects.filter(created_at__gte=lo, created_at__lt=hi), 'created_at',
+                       new_patients=Count('id'))
+    appointments = _by_day(
+        Appointment.objects.filter(appointment_date__gte=lo, appointment_date__lt=hi), 'appointment_date',
+        total_appointments=Count('id'),
+        completed_appointments=Count('id', filter=Q(status='completed')),
+        cancelled_appointments=Count('id', filter=Q(status='cancelled')),
+    )
+    bills = _by_day(
+        Bill.objects.filter(bill_date__gte=lo, bill_date__lt=hi), 'bill_date',
+        total_revenue=Sum('total_amount'),
+        outstanding_amount=Sum(F('total_amount') - F('paid_amount')),
+    )
+    payments = _by_day(
+        Payment.objects.filter(date__gte=lo, date__lt=hi), 'date',
+        cash_collection=Sum('amount', filter=Q(method='cash')),
+        card_collection=Sum('amount', filter=Q(method='card')),
+    )
+    medicines = _by_day(
+        BillItem.objects.filter(kind='pharmacy', bill__bill_date__gte=lo, bill__bill_date__lt=hi),
+        'bill__bill_date',
+        medicine_sales_value=Sum('total_price'),
+    )
+
+    procedure = 'treatment_plan__procedure__name'
+    session_counts = {}
+    for column, words in SESSION_COLUMNS.items():
+        match = Q()
+        for word in words:
+            match |= Q(**{f'{procedure}__icontains': word})
+        session_counts[column] = Count('id', filter=match)
+    sessions = _by_day(
+        TreatmentSession.objects.filter(appointment__appointment_date__gte=lo,
+                                        appointment__appointment_date__lt=hi),
+        'appointment__appointment_date',
+        total_sessions=Count('id'),
+        **session_counts,
+    )
+
+    now = timezone.now()
+    reports = []
+    day = start
+    while day <= end:
+        row = {}
+        for source in (patients, appointments, bills, payments, medicines, sessions):
+            row.update(source.get(day, {}))
+        named = sum(row.get(column, 0) for column in SESSION_COLUMNS)
+        row['other_treatments'] = max(0, row.pop('total_sessions', 0) - named)
+        reports.append(DailyReport(
+            report_date=day,
+            generated_at=now,
+            generated_by=user,
+            **{k: (v if v is not None else D0) for k, v in row.items()},
+        ))
+        day += timedelta(days=1)
+
+    fields = [f.name for f in DailyReport._meta.concrete_fields if f.name not in ('id', 'report_date')]
+    DailyReport.objects.bulk_create(
+        reports, batch_size=500,
+        update_conflicts=True, unique_fields=['report_date'], update_fields=fields,
+    )
+    return len(reports)
+
+
+# --- incremental refresh -------------------------------------------------
+
+def _rebuild_report_days(days):
+    for day in sorted(days):
+        rollup_daily_reports(day, day)
+
+
+_report_days = CommitBatch(_rebuild_report_days)
+
+
+def mark_report_day(value):
+    """Refresh the DailyReport of this day once the current transaction commits."""
+    if value is None:
+        return
+    _report_days.add(local_day(value))
@@ -0,0 +1,208 @@
+"""
+Patient search.
+
+Each patient has one PatientSearchToken row per distinct trigram of its
+normalised name and file number. A query is turned into the same trigrams, and
+patients are ranked by how many they share, in one GROUP BY over the
+(token, patient) index. This replaces LIKE '%x%' scans. Partial text, typos
+and the common Malayalam-English spelling variants (Sheeja / Sija,
+Thomas / Tomas, Azhar / Alar) still match, because names are folded before
+they are cut into trigrams. Queries made of digits are also looked up on the
+indexed phone columns (core/phones.py), e.g. the last digits of a number.
+
+Signals re-index a patient when it is saved; migration 0055 indexed the
+patients that existed then, and `manage.py rebuild_patient_search`
+re-indexes everyone.
+"""
+import math
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import Patient, PatientSearchToken
+from .phones import phone_q
+
+# Share of the query's trigrams a patient must have to match, by token kind:
+# names (n) are fuzzy, file numbers (f) must contain what was typed
+MIN_SIMILARITY = {'n': 0.5, 'f': 1.0}
+# Fewer digits than this match too many phone numbers to be useful
+MIN_PHONE_DIGITS = 4
+# Ranked searches (the patient pickers) return at most this many matches per call
+SEARCH_LIMIT = 200
+REBUILD_CHUNK_SIZE = 1000
+
+# Romanised spellings of the same sound, folded to one form (order matters)
+_FOLDS = (
+    ('zh', 'l'), ('th', 't'), ('dh', 'd'), ('kh', 'k'), ('gh', 'g'), ('bh', 'b'),
+    ('ph', 'f'), ('sh', 's'), ('ee', 'i'), ('oo', 'u'), ('w', 'v'), ('q', 'k'), ('z', 's'),
+)
+_DOUBLE = re.compile(r'(.)\1+')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def _fold_word(word):
+    if not word.isascii():
+        return word  # Malayalam script is matched as written
+    for spelling, folded in _FOLDS:
+        word = word.replace(spelling, folded)
+    return _DOUBLE.sub(r'\1', word)
+
+
+def normalise_name(value):
+    """Lower-case words without accents or punctuation, with spelling variants folded."""
+    text = unicodedata.normalize('NFKD', value or '')
+    # Drop the accents of Latin letters but keep the vowel signs of Indic scripts
+    kept = []
+    for ch in text:
+        if unicodedata.combining(ch) and (not kept or kept[-1].isascii()):
+            continue
+        kept.append(ch)
+    words = _NON_WORD.sub(' ', ''.join(kept).lower()).split()
+    return [_fold_word(''.join(ch for ch in word if not ch.isdigit())) for word in words]
+
+
+def normalise_file_number(value):
+    return re.sub(r'[\W_]', '', value or '').lower()
+
+
+def _trigrams(kind, word, padded=True):
+    if padded:
+        word = f'^{word}$'
+    return {f'{kind}:{word[i:i + 3]}' for i in range(len(word) - 2)}
+
+
+def patient_tokens(name, file_number):
+    tokens = set()
+    for word in normalise_name(name):
+        if word:
+            tokens |= _trigrams('n', word)
+    file_number = normalise_file_number(file_number)
+    if file_number:
+        tokens |= _trigrams('f', file_number)
+    return tokens
+
+
+def query_tokens(query):
+    """Trigrams of a search box query, read as a name and (if it has digits) a file number."""
+    tokens = set()
+    for word in normalise_name(query):
+        if word:
+            tokens |= _trigrams('n', word)
+    if any(ch.isdigit() for ch in query):
+        # Numbers are often typed in part, so no end markers
+        tokens |= _trigrams('f', normalise_file_number(query), padded=False)
+    return tokens
+
+
+def _is_phone_query(query):
+    digits = sum(ch.isdigit() for ch in query)
+    return digits >= MIN_PHONE_DIGITS and not any(ch.isalpha() for ch in query)
+
+
+# --- index maintenance ------------------------------------------------------
+
+def _token_rows(patient):
+    if patient.merged_into_id:
+        return []  # merged records are reached through the patient they were merged into
+    return [PatientSearchToken(patient_id=patient.pk, token=token)
+            for token in patient_tokens(patient.name, patient.file_number)]
+
+
+def index_patient(patient):
+    with transaction.atomic():
+        PatientSearchToken.objects.filter(patient_id=patient.pk).delete()
+        PatientSearchToken.objects.bulk_create(_token_rows(patient))
+
+
+def index_new_patients(patients):
+    """Index patients inserted with bulk_create(), which sends no post_save."""
+    PatientSearchToken.objects.bulk_create([row for p in patients for row in _token_rows(p)], batch_size=5000)
+
+
+def rebuild_search_index(on_progress=None):
+    """Re-index every patient in chunks. Returns the number of patients indexed."""
+    done = 0
+    last_pk = None
+    while True:
+        chunk = Patient.objects.order_by('pk').only('id', 'name', 'file_number', 'merged_into')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:REBUILD_CHUNK_SIZE])
+        if not chunk:
+            return done
+        with transaction.atomic():
+            PatientSearchToken.objects.filter(patient_id__in=[p.pk for p in chunk]).delete()
+            PatientSearchToken.objects.bulk_create(
+                [row for p in chunk for row in _token_rows(p)], batch_size=5000)
+        done += len(chunk)
+        last_pk = chunk[-1].pk
+        if on_progress:
+            on_progress(done)
+
+
+# --- search -----------------------------------------------------------------
+
+def _token_matches(query, patients=None):
+    """
+    (by_kind, rows): the query's trigrams by kind, and the grouped token rows
+    (patient_id, hits per kind, hits) of every patient having enough of them,
+    unordered and unlimited. rows is None when the query has no trigrams.
+    `patients` restricts the match to a Patient queryset.
+    """
+    by_kind = {}
+    for token in query_tokens(query):
+        by_kind.setdefault(token[0], set()).add(token)
+    if not by_kind:
+        return by_kind, None
+
+    hits = {f'{kind}_hits': Count('id', filter=Q(token__in=tokens)) for kind, tokens in by_kind.items()}
+    enough = Q()
+    for kind, tokens in by_kind.items():
+        enough |= Q(**{f'{kind}_hits__gte': max(1, math.ceil(len(tokens) * MIN_SIMILARITY[kind]))})
+    rows = PatientSearchToken.objects.filter(token__in=set().union(*by_kind.values()))
+    if patients is not None:
+        rows = rows.filter(patient__in=patients)
+    return by_kind, rows.values('patient_id').annotate(**hits, hits=Count('id')).filter(enough)
+
+
+def search_patients(query, limit=SEARCH_LIMIT, offset=0, patients=None):
+    """
+    [(patient_id, score)] best first, `limit` of them from `offset`. Phone
+    matches score 1; otherwise a patient matches when it has enough of the
+    query's name or file number trigrams, and the score is the best share of
+    one kind's trigrams it has. `patients` (a Patient queryset, e.g. the
+    active ones) is applied inside the ranking queries.
+    """
+    query = (query or '').strip()
+    wanted = offset + limit
+    matches = {}
+    if _is_phone_query(query):
+        phones = (Patient.objects.all() if patients is None else patients).filter(phone_q(query))
+        for patient_id in phones.order_by('pk').values_list('pk', flat=True)[:wanted]:
+            matches[patient_id] = 1.0
+    by_kind, rows = _token_matches(query, patients)
+    if rows is not None:
+        for row in rows.order_by('-hits', 'patient_id')[:wanted]:
+            score = max(row[f'{kind}_hits'] / len(tokens) for kind, tokens in by_kind.items())
+            matches.setdefault(row['patient_id'], score)
+    return sorted(matches.items(), key=lambda match: -match[1])[offset:wanted]
+
+
+def patient_search_q(query, path=''):
+    """
+    Q restricting a queryset to the patients matching `query`. `path` leads to
+    the patient from the queryset's model, e.g. 'patient__' for bills.
+    """
+    query = (query or '').strip()
+    if len(query) < 3:
+        # Too short for trigrams: fall back to prefix matches
+        return (Q(**{f'{path}file_number__istartswith': query})
+                | Q(**{f'{path}name__istartswith': query}))
+    _, rows = _token_matches(query)
+    # A subquery over every match, so the caller's other filters see them all
+    match = Q(**{f'{path}pk__in': rows.values('patient_id') if rows is not None else []})
+    if _is_phone_query(query):
+        match |= phone_q(query, path)
+    return match
@@ -1,14 +1,26 @@
 # signals.py
+import threading
+from contextlib import contextmanager
+
 from django.db import transaction
 from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import Group
+from django.utils import timezone
 
 from .models import (
     User, UserProfile,
     Medicine, MedicineStock, StockTransaction,
-    BillItem
+    Bill, BillItem, Payment,
+    Patient, Appointment, TreatmentSession, FollowUp,
+    Expense, Lead,
 )
+from .finance_facts import mark_finance_day, mark_patient_finance_days
+from .followups import refresh_followup_dates
+from .kpis import mark_changed
+from .receipts import discard_cached_receipts
+from .search import index_patient
+from .rollups import mark_report_day
 from .utils import next_employee_id
 
 
@@ -76,12 +88,34 @@ def infer_billitem_defaults(sender, instance, **kwargs):
         if not instance.unit_price or instance.unit_price == 0:
             instance.unit_price = instance.medicine.selling_price or 0
 
+_bill_recalc = threading.local()
+
+@contextmanager
+def bill_recalc_suspended():
+    """
+    Skip the per-item recalculation below while a caller that already knows
+    the new bill total deletes items in bulk (see billing.update_bill).
+    """
+    _bill_recalc.suspended = True
+    try:
+        yield
+    finally:
+        _bill_recalc.suspended = False
+
 @receiver(post_delete, sender=BillItem)
 def billitem_deleted(sender, instance, **kwargs):
     """Recompute bill totals when an item is removed."""
+    if getattr(_bill_recalc, 'suspended', False):
+        return
     if instance.bill_id:
         instance.bill.recalculate(save=True)
 
+@receiver(post_delete, sender=Bill)
+def bill_deleted(sender, instance, **kwargs):
+    """Drop rendered receipts of a deleted bill once the delete is committed."""
+    bill_id = instance.pk
+    transaction.on_commit(lambda: discard_cached_receipts(bill_id))
+
 # NOTE: We intentionally do NOT recalc on Bill.post_save to avoid recursion.
 # If tax/discount change, call bill.recalculate(save=True) in your view after saving the header.
 
@@ -165,3 +199,158 @@ def revert_stock_on_delete(sender, instance, **kwargs):
         _apply_stock_delta(instance.medicine, -instance.quantity, user=instance.created_by)
 
 
+# -----------------------------
+# Daily report roll-up
+# -----------------------------
+
+@receiver(post_save, sender=Bill)
+@receiver(post_delete, sender=Bill)
+def bill_report_day(sender, instance, **kwargs):
+    mark_report_day(instance.bill_date)
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_report_day(sender, instance, **kwargs):
+    """A payment counts on its own day and moves the outstanding amount of its bill's day."""
+    mark_report_day(instance.date)
+    if instance.bill_id:
+        # Looked up, not instance.bill: the bill may be being deleted too
+        bill_date = Bill.objects.filter(pk=instance.bill_id).values_list('bill_date', flat=True).first()
+        mark_report_day(bill_date)
+
+@receiver(post_save, sender=Patient)
+def patient_report_day(sender, instance, created, **kwargs):
+    if created:
+        mark_report_day(instance.created_at)
+
+@receiver(pre_save, sender=Appointment)
+def appointment_previous_day(sender, instance, **kwargs):
+    """Remember the old day of a rescheduled appointment so both days are refreshed."""
+    instance._previous_report_day = None
+    if not instance._state.adding:
+        instance._previous_report_day = (
+            Appointment.objects.filter(pk=instance.pk).values_list('appointment_date', flat=True).first()
+        )
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_report_day(sender, instance, **kwargs):
+    mark_report_day(instance.appointment_date)
+    previous = getattr(instance, '_previous_report_day', None)
+    if previous and previous != instance.appointment_date:
+        mark_report_day(previous)
+
+@receiver(post_save, sender=TreatmentSession)
+@receiver(post_delete, sender=TreatmentSession)
+def session_report_day(sender, instance, **kwargs):
+    appointment_date = (Appointment.objects.filter(pk=instance.appointment_id)
+                        .values_list('appointment_date', flat=True).first())
+    mark_report_day(appointment_date)
+
+
+# -----------------------------
+# Finance facts
+# -----------------------------
+
+@receiver(post_save, sender=Bill)
+@receiver(post_delete, sender=Bill)
+def bill_finance_day(sender, instance, **kwargs):
+    mark_finance_day(instance.bill_date)
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_finance_day(sender, instance, **kwargs):
+    """Collections are booked on the day of the bill they pay."""
+    if instance.bill_id:
+        bill_date = Bill.objects.filter(pk=instance.bill_id).values_list('bill_date', flat=True).first()
+        mark_finance_day(bill_date)
+
+@receiver(pre_save, sender=Patient)
+def patient_previous_district(sender, instance, update_fields=None, **kwargs):
+    instance._previous_district = None
+    if not instance._state.adding and (update_fields is None or 'district' in update_fields):
+        instance._previous_district = (
+            Patient.objects.filter(pk=instance.pk).values_list('district', flat=True).first()
+        )
+
+@receiver(post_save, sender=Patient)
+def patient_finance_days(sender, instance, created, **kwargs):
+    """Facts are split by district, so moving a patient moves their bills' facts."""
+    previous = getattr(instance, '_previous_district', None)
+    if not created and previous is not None and previous != instance.district:
+        mark_patient_finance_days(instance.pk)
+
+
+# -----------------------------
+# Dashboard KPI invalidation
+# -----------------------------
+
+@receiver(post_save, sender=Bill)
+@receiver(post_delete, sender=Bill)
+def bill_kpis_changed(sender, instance, **kwargs):
+    mark_changed('bills')
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_kpis_changed(sender, instance, **kwargs):
+    """Payments also move the paid amount of their bill."""
+    mark_changed('payments', 'bills')
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_kpis_changed(sender, instance, **kwargs):
+    mark_changed('appointments')
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_save, sender=MedicineStock)
+@receiver(post_delete, sender=MedicineStock)
+@receiver(post_save, sender=StockTransaction)
+@receiver(post_delete, sender=StockTransaction)
+def stock_kpis_changed(sender, instance, **kwargs):
+    mark_changed('stock')
+
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Expense)
+def expense_kpis_changed(sender, instance, **kwargs):
+    mark_changed('expenses')
+
+@receiver(post_save, sender=Lead)
+@receiver(post_delete, sender=Lead)
+def lead_kpis_changed(sender, instance, **kwargs):
+    mark_changed('leads')
+
+
+# -----------------------------
+# Patient follow-up dates
+# -----------------------------
+
+@receiver(pre_save, sender=FollowUp)
+def followup_previous_patient(sender, instance, **kwargs):
+    """Remember the old patient of a follow-up moved to another one, so both are refreshed."""
+    instance._previous_patient_id = None
+    if not instance._state.adding:
+        instance._previous_patient_id = (
+            FollowUp.objects.filter(pk=instance.pk).values_list('patient_id', flat=True).first()
+        )
+
+@receiver(post_save, sender=FollowUp)
+@receiver(post_delete, sender=FollowUp)
+def followup_patient_dates(sender, instance, **kwargs):
+    patient_ids = {instance.patient_id}
+    previous = getattr(instance, '_previous_patient_id', None)
+    if previous:
+        patient_ids.add(previous)
+    refresh_followup_dates(patient_ids, timezone.localdate())
+
+
+# -----------------------------
+# Patient search index
+# -----------------------------
+
+SEARCHED_PATIENT_FIELDS = {'name', 'file_number'}
+
+@receiver(post_save, sender=Patient)
+def patient_search_tokens(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCHED_PATIENT_FIELDS & set(update_fields):
+        return
+    index_patient(instance)
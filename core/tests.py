@@ -1,3 +1,143 @@
+from decimal import Decimal
+
 from django.test import TestCase
+from django.urls import reverse
+
+from .models import Bill, BillItem, Patient, Payment, Service, User
+from .reconciliation import reconcile_bills, reconcile_patient_balances
+
+
+def _formset(prefix, rows, initial=0):
+    data = {
+        f'{prefix}-TOTAL_FORMS': str(len(rows)),
+        f'{prefix}-INITIAL_FORMS': str(initial),
+        f'{prefix}-MIN_NUM_FORMS': '0',
+        f'{prefix}-MAX_NUM_FORMS': '1000',
+    }
+    for i, row in enumerate(rows):
+        for key, value in row.items():
+            data[f'{prefix}-{i}-{key}'] = value
+    return data
+
+
+class ServiceBillTests(TestCase):
+    """Service bills written through the views: totals, ledger entries, patient balances."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'pw', user_type='super_user')
+        cls.service = Service.objects.create(name='PRP', default_price=Decimal('1000'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.patient = self._patient('Asha Menon')
+
+    def _patient(self, name):
+        return Patient.objects.create(name=name, age=30, gender='female', phone_number='9847012345',
+                                      city='Kochi', district='Ernakulam')
+
+    def _post(self, url, patient, paid, quantity, item=None):
+        data = {
+            'patient': str(patient.pk), 'remark': '', 'paid_amount': paid, 'payment_method': 'upi',
+            'tax_amount': '0', 'discount_amount': '0',
+        }
+        row = {'service': str(self.service.pk), 'quantity': str(quantity), 'unit_price': '1000'}
+        if item:
+            row.update(id=str(item.pk), bill=str(item.bill_id))
+        data.update(_formset('items', [row], initial=1 if item else 0))
+        return self.client.post(url, data)
+
+    def _create(self, paid='400', quantity=1):
+        self._post(reverse('service_bill_create'), self.patient, paid, quantity)
+        return Bill.objects.filter(patient=self.patient).latest('bill_date')
+
+    def _edit(self, bill, patient, paid, quantity=1):
+        response = self._post(reverse('service_bill_edit', args=[bill.pk]), patient, paid, quantity,
+                              item=bill.items.get())
+        self.assertEqual(response.status_code, 302)
+        bill.refresh_from_db()
+        return bill
+
+    def _balance(self, patient):
+        patient.refresh_from_db()
+        return patient.balance
+
+    def assertReconciled(self):
+        self.assertEqual(list(reconcile_bills()), [])
+        self.assertEqual(list(reconcile_patient_balances()), [])
+
+    def test_create(self):
+        bill = self._create(paid='400', quantity=2)
+        self.assertEqual(bill.total_amount, Decimal('2000.00'))
+        self.assertEqual(bill.paid_amount, Decimal('400.00'))
+        self.assertEqual(self._balance(self.patient), Decimal('1600.00'))
+        self.assertEqual(list(bill.payments.values_list('entry_type', 'amount')), [('payment', Decimal('400.00'))])
+        self.assertReconciled()
+
+    def test_edit_total_and_payment_increase(self):
+        bill = self._edit(self._create(paid='400'), self.patient, paid='900', quantity=2)
+        self.assertEqual(bill.total_amount, Decimal('2000.00'))
+        self.assertEqual(bill.paid_amount, Decimal('900.00'))
+        self.assertEqual(self._balance(self.patient), Decimal('1100.00'))
+        self.assertEqual(sorted(bill.payments.values_list('entry_type', 'amount')),
+                         [('payment', Decimal('400.00')), ('payment', Decimal('500.00'))])
+        self.assertReconciled()
+
+    def test_edit_payment_decrease_posts_correction(self):
+        bill = self._edit(self._create(paid='400'), self.patient, paid='150')
+        self.assertEqual(bill.paid_amount, Decimal('150.00'))
+        self.assertEqual(self._balance(self.patient), Decimal('850.00'))
+        self.assertEqual(sorted(bill.payments.values_list('entry_type', 'amount')),
+                         [('correction', Decimal('-250.00')), ('payment', Decimal('400.00'))])
+        self.assertReconciled()
+
+    def test_edit_patient_change_moves_balance_and_ledger(self):
+        other = self._patient('Bindu Thomas')
+        bill = self._edit(self._create(paid='400'), other, paid='300')
+        self.assertEqual(bill.patient_id, other.pk)
+        self.assertEqual(self._balance(self.patient), Decimal('0.00'))
+        self.assertEqual(self._balance(other), Decimal('700.00'))
+        self.assertEqual(set(Payment.objects.filter(bill=bill).values_list('patient_id', flat=True)), {other.pk})
+        self.assertReconciled()
+
+    def test_delete(self):
+        bill = self._create(paid='400')
+        response = self.client.post(reverse('service_bill_delete', args=[bill.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Bill.objects.filter(pk=bill.pk).exists())
+        self.assertFalse(Payment.objects.filter(patient=self.patient).exists())
+        self.assertEqual(self._balance(self.patient), Decimal('0.00'))
+        self.assertReconciled()
+
+
+class ReconciliationTests(TestCase):
+    """reconcile_bills / reconcile_patient_balances report drifted columns and repair them."""
+
+    def setUp(self):
+        self.patient = Patient.objects.create(name='Asha Menon', age=30, gender='female',
+                                              phone_number='9847012345', city='Kochi', district='Ernakulam')
+        self.bill = Bill.objects.create(patient=self.patient, bill_type='service', total_amount=Decimal('1000'))
+        service = Service.objects.create(name='PRP', default_price=Decimal('1000'))
+        BillItem.objects.create(bill=self.bill, kind='service', service=service, quantity=1,
+                                unit_price=Decimal('1000'), total_price=Decimal('1000'))
+        Payment(patient=self.patient, bill=self.bill, amount=Decimal('400'), method='cash').save(update_totals=False)
+        Bill.objects.filter(pk=self.bill.pk).update(total_amount=Decimal('1000'), paid_amount=Decimal('0'))
+        Patient.objects.filter(pk=self.patient.pk).update(balance=Decimal('50'))
+
+    def test_reports_without_fixing(self):
+        bill_fields = [(m.pk, m.field, m.expected) for m in reconcile_bills()]
+        self.assertIn((self.bill.pk, 'paid_amount', Decimal('400.00')), bill_fields)
+        balance = [(m.pk, m.stored, m.expected) for m in reconcile_patient_balances()]
+        self.assertEqual(balance, [(self.patient.pk, Decimal('50.00'), Decimal('600.00'))])
+        self.patient.refresh_from_db()
+        self.assertEqual(self.patient.balance, Decimal('50.00'))
 
-# Create your tests here.
+    def test_fix(self):
+        list(reconcile_bills(fix=True))
+        list(reconcile_patient_balances(fix=True))
+        self.bill.refresh_from_db()
+        self.patient.refresh_from_db()
+        self.assertEqual(self.bill.paid_amount, Decimal('400.00'))
+        self.assertEqual(self.patient.balance, Decimal('600.00'))
+        self.assertEqual(list(reconcile_bills()), [])
+        self.assertEqual(list(reconcile_patient_balances()), [])
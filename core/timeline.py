@@ -0,0 +1,161 @@
+"""
+Patient timeline.
+
+One chronological feed (newest first) of everything recorded for a patient:
+appointments and their logs, consultations, treatment sessions, follow-ups,
+progress photos, bills and payments. Each table contributes a three-column
+projection (kind, at, ref) and the projections are combined with a single
+UNION ... ORDER BY at DESC, kind DESC, ref DESC LIMIT n. The cursor is the
+(at, kind, ref) of the last event of a page; every branch of the UNION gets
+the matching "strictly after" condition, so it is an index range scan on the
+branch's (patient, date) index (appointment logs and treatment sessions are
+reached through the patient's appointments). The rows of a page are then loaded with one
+pk__in query per kind present, so a page costs at most 1 + len(SOURCES)
+queries whatever the length of the patient's history.
+"""
+import base64
+import json
+
+from django.db import connection
+from django.db.models import CharField, DateTimeField, F, Q, Value
+from django.db.models.functions import Cast
+from django.urls import reverse
+
+from .models import (
+    Appointment, AppointmentLog, Bill, FollowUp, HairConsultation, Payment, ProgressPhoto, TreatmentSession,
+)
+
+TIMELINE_PAGE_SIZE = 50
+
+# kind: (model, timestamp field, lookup from the model to the patient id, select_related for the page rows)
+SOURCES = {
+    'appointment': (Appointment, 'appointment_date', 'patient_id', ('assigned_doctor', 'branch')),
+    'appointment_log': (AppointmentLog, 'at', 'appointment__patient_id', ('appointment', 'by')),
+    'bill': (Bill, 'bill_date', 'patient_id', ()),
+    'consultation': (HairConsultation, 'consultation_date', 'patient_id', ('doctor',)),
+    'followup': (FollowUp, 'created_at', 'patient_id', ()),
+    'payment': (Payment, 'date', 'patient_id', ('bill', 'received_by')),
+    'photo': (ProgressPhoto, 'taken_date', 'patient_id', ()),
+    'session': (TreatmentSession, 'created_at', 'appointment__patient_id', ('performed_by',)),
+}
+
+
+def encode_cursor(event):
+    raw = [event['at'].isoformat(), event['kind'], event['ref']]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(at, kind, ref) from a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        at, kind, ref = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        at = DateTimeField().to_python(at)
+    except (ValueError, TypeError, LookupError):
+        return None
+    if at is None or kind not in SOURCES or not isinstance(ref, str):
+        return None
+    return at, kind, ref
+
+
+def _branch(kind, patient_id, after, limit):
+    model, at_field, patient_lookup, _ = SOURCES[kind]
+    qs = (model.objects
+          .filter(**{patient_lookup: patient_id})
+          .annotate(event_at=F(at_field),
+                    event_kind=Value(kind, output_field=CharField()),
+                    event_ref=Cast('pk', output_field=CharField(max_length=36)))
+          .values('event_at', 'event_kind', 'event_ref'))
+    if after:
+        at, after_kind, ref = after
+        # Rows sort by (at, kind, ref) descending: later kinds only come after on an older `at`
+        older = Q(**{f'{at_field}__lt': at})
+        if kind < after_kind:
+            older |= Q(**{at_field: at})
+        elif kind == after_kind:
+            older |= Q(**{at_field: at}, event_ref__lt=ref)
+        qs = qs.filter(older)
+    if connection.features.supports_slicing_ordering_in_compound:
+        # No branch can contribute more than a page
+        qs = qs.order_by('-event_at', '-event_ref')[:limit]
+    else:
+        qs = qs.order_by()
+    return qs
+
+
+def timeline_page(patient_id, cursor=None, per_page=TIMELINE_PAGE_SIZE):
+    """
+    (events, next_cursor): up to per_page events after `cursor`, newest first.
+    Each event is {'kind', 'at', 'ref', 'obj'}; next_cursor is None on the last page.
+    """
+    after = decode_cursor(cursor)
+    branches = [_branch(kind, patient_id, after, per_page + 1) for kind in SOURCES]
+    union = branches[0].union(*branches[1:], all=True).order_by('-event_at', '-event_kind', '-event_ref')
+    rows = [{'at': row['event_at'], 'kind': row['event_kind'], 'ref': row['event_ref']}
+            for row in union[:per_page + 1]]
+    more = len(rows) > per_page
+    events = rows[:per_page]
+
+    by_kind = {}
+    for event in events:
+        by_kind.setdefault(event['kind'], []).append(event)
+    for kind, kind_events in by_kind.items():
+        model, _, _, related = SOURCES[kind]
+        pk = model._meta.pk
+        objs = model.objects.select_related(*related).in_bulk([pk.to_python(e['ref']) for e in kind_events])
+        for event in kind_events:
+            event['obj'] = objs.get(pk.to_python(event['ref']))
+    # Rows deleted between the two queries are dropped
+    events = [event for event in events if event['obj'] is not None]
+
+    return events, (encode_cursor(rows[per_page - 1]) if more else None)
+
+
+def _person(user):
+    return (user.get_full_name() or user.username) if user else ''
+
+
+def _describe(kind, obj):
+    """(title, detail, url) shown for one event."""
+    if kind == 'appointment':
+        return (f"Appointment · {obj.get_sittings_display()}",
+                f"{obj.get_status_display()}{' · Dr ' + _person(obj.assigned_doctor) if obj.assigned_doctor else ''}",
+                reverse('appointment_detail', args=[obj.pk]))
+    if kind == 'appointment_log':
+        return (f"Appointment {obj.get_action_display().lower()}",
+                obj.note or ' → '.join(s for s in (obj.from_status, obj.to_status) if s),
+                reverse('appointment_detail', args=[obj.appointment_id]))
+    if kind == 'bill':
+        return (f"{obj.get_bill_type_display()} bill {obj.bill_number}",
+                f"Total ₹ {obj.total_amount} · Paid ₹ {obj.paid_amount}",
+                reverse('bill_receipt', args=[obj.pk]))
+    if kind == 'consultation':
+        return ("Consultation",
+                f"Dr {_person(obj.doctor)}" if obj.doctor else '',
+                reverse('consultation_detail', args=[obj.pk]))
+    if kind == 'followup':
+        return (f"Follow-up on {obj.followup_date:%d %b %Y}",
+                f"Response {obj.overall_response_percentage}% · Satisfaction {obj.patient_satisfaction}/10",
+                reverse('followup_update', args=[obj.pk]))
+    if kind == 'payment':
+        return (f"{obj.get_entry_type_display()} ₹ {obj.amount}",
+                f"{obj.get_method_display()}{' · ' + obj.bill.bill_number if obj.bill else ''}",
+                reverse('bill_receipt', args=[obj.bill_id]) if obj.bill_id else '')
+    if kind == 'photo':
+        return (f"Progress photo · {obj.photo_type}", obj.notes, obj.image.url if obj.image else '')
+    return (f"Treatment session {obj.session_number}",
+            f"{obj.procedure_performed}{' · ' + _person(obj.performed_by) if obj.performed_by else ''}",
+            reverse('appointment_detail', args=[obj.appointment_id]))
+
+
+def serialize_event(event):
+    title, detail, url = _describe(event['kind'], event['obj'])
+    return {
+        'kind': event['kind'],
+        'at': event['at'].isoformat(),
+        'id': event['ref'],
+        'title': title,
+        'detail': detail,
+        'url': url,
+    }
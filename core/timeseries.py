@@ -0,0 +1,94 @@
+"""
+Time series over local business days.
+
+bucketed_sum() sums a value per day, ISO week or month in a single GROUP BY,
+truncating timestamps in the current time zone (TIME_ZONE, Asia/Kolkata), and
+zero-fills the buckets that have no rows in Python.
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import DateField, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+from django.utils import timezone
+
+D0 = Decimal('0.00')
+
+GRANULARITIES = ('day', 'week', 'month')
+
+LABEL_FORMATS = {
+    'day': '%d %b',
+    'week': 'Wk %d %b',
+    'month': '%b %Y',
+}
+
+
+def auto_granularity(start, end):
+    """Days up to two months, weeks up to half a year, months beyond that."""
+    span = (end - start).days + 1
+    if span <= 62:
+        return 'day'
+    if span <= 183:
+        return 'week'
+    return 'month'
+
+
+def bucket_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(day, granularity):
+    if granularity == 'week':
+        return day + timedelta(days=7)
+    if granularity == 'month':
+        return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+    return day + timedelta(days=1)
+
+
+def _trunc(field, granularity):
+    tz = timezone.get_current_timezone()
+    if granularity == 'week':
+        return TruncWeek(field, output_field=DateField(), tzinfo=tz)
+    if granularity == 'month':
+        return TruncMonth(field, output_field=DateField(), tzinfo=tz)
+    return TruncDate(field, tzinfo=tz)
+
+
+def bucketed_sum(queryset, date_field, value_field, start, end, granularity='day'):
+    """
+    [(bucket start date, Decimal sum)] covering start..end (local dates,
+    inclusive), one entry per bucket, zeros where there were no rows.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+    tz = timezone.get_current_timezone()
+    lo = timezone.make_aware(datetime.combine(start, time.min), tz)
+    hi = timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz)
+
+    rows = (queryset
+            .filter(**{f'{date_field}__gte': lo, f'{date_field}__lt': hi})
+            .annotate(bucket=_trunc(date_field, granularity))
+            .values('bucket')
+            .annotate(total=Sum(value_field))
+            .order_by())
+    sums = {row['bucket']: row['total'] or D0 for row in rows}
+
+    series = []
+    bucket = bucket_start(start, granularity)
+    while bucket <= end:
+        series.append((bucket, sums.get(bucket, D0)))
+        bucket = next_bucket(bucket, granularity)
+    return series
+
+
+def series_for_chart(series, granularity):
+    """{'labels': [...], 'values': [...]} as used by the Chart.js widgets."""
+    fmt = LABEL_FORMATS[granularity]
+    return {
+        'labels': [bucket.strftime(fmt) for bucket, _ in series],
+        'values': [float(value) for _, value in series],
+    }
@@ -1,12 +1,124 @@
+import threading
+
 from django.db import transaction
 from django.utils import timezone
-from .models import EmployeeIdSequence
+from .models import DocumentSequence
 
-def next_employee_id():
-    year = timezone.now().year
+# How many numbers a process reserves per locked row update. Busy series
+# (bills at the front desk) take bigger blocks; employee ids and service
+# codes stay gap-free.
+SEQUENCE_BLOCK_SIZES = {
+    'INV': 50,
+    'DLP': 20,
+    'EXP': 20,
+    'EMP': 1,
+    'SRV': 1,
+}
+
+_reserved_blocks = {}   # (prefix, year) -> list of [next, last] ranges
+_reserved_lock = threading.Lock()
+
+
+def _take_reserved(key):
+    with _reserved_lock:
+        blocks = _reserved_blocks.get(key) or []
+        while blocks:
+            block = blocks[0]
+            if block[0] <= block[1]:
+                number = block[0]
+                block[0] += 1
+                return number
+            blocks.pop(0)
+    return None
+
+
+def _publish_block(key, first, last):
+    with _reserved_lock:
+        _reserved_blocks.setdefault(key, []).append([first, last])
+
+
+def next_sequence_number(prefix, year=0):
+    """
+    Return the next number of the (prefix, year) series.
+
+    Numbers are reserved from DocumentSequence in blocks of
+    SEQUENCE_BLOCK_SIZES[prefix], so a burst of inserts costs one locked row
+    update per block instead of a table scan per insert. The rest of a block is
+    only shared with other callers once the reserving transaction commits; if it
+    rolls back, the row update is undone and the block is forgotten, so a number
+    is never handed out twice. Numbers stay unique but may leave gaps and are
+    not strictly ordered across worker processes.
+    """
+    key = (prefix, year)
+    number = _take_reserved(key)
+    if number is not None:
+        return number
+
+    size = SEQUENCE_BLOCK_SIZES.get(prefix, 1)
+    first = reserve_sequence_block(prefix, size, year)
+    if size > 1:
+        last = first + size - 1
+        transaction.on_commit(lambda: _publish_block(key, first + 1, last))
+    return first
+
+
+def reserve_sequence_block(prefix, count, year=0):
+    """Reserve `count` consecutive numbers of the series with one locked row update; returns the first."""
     with transaction.atomic():
-        seq, _ = EmployeeIdSequence.objects.select_for_update().get_or_create(year=year)
-        seq.last_number += 1
+        seq, _ = DocumentSequence.objects.select_for_update().get_or_create(prefix=prefix, year=year)
+        first = seq.last_number + 1
+        seq.last_number += count
         seq.save(update_fields=["last_number"])
-        return f"EMP{year}-{seq.last_number:04d}"
+    return first
+
+
+def next_document_number(prefix, width, yearly=True):
+    """Format the next number of a series, e.g. INV2025000123 or SRV0042."""
+    if yearly:
+        year = timezone.localdate().year
+        return f"{prefix}{year}{next_sequence_number(prefix, year):0{width}d}"
+    return f"{prefix}{next_sequence_number(prefix):0{width}d}"
+
+
+def reserve_document_numbers(prefix, width, count, yearly=True):
+    """`count` numbers of a series formatted like next_document_number(), for bulk inserts."""
+    if yearly:
+        year = timezone.localdate().year
+        first = reserve_sequence_block(prefix, count, year)
+        return [f"{prefix}{year}{number:0{width}d}" for number in range(first, first + count)]
+    first = reserve_sequence_block(prefix, count)
+    return [f"{prefix}{number:0{width}d}" for number in range(first, first + count)]
+
 
+class CommitBatch:
+    """
+    Keys collected during a transaction and handed to handler(keys) once it
+    commits (at once outside a transaction), e.g. the days whose report must
+    be rebuilt. Every add() registers a callback and the first one to run
+    takes the whole set, so a rolled-back transaction cannot leave keys
+    without a callback: they go with the next commit. Callbacks are robust:
+    a failing handler is logged instead of failing a request whose data has
+    already been committed.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._local = threading.local()
+
+    def add(self, *keys):
+        pending = getattr(self._local, 'keys', None)
+        if pending is None:
+            pending = self._local.keys = set()
+        pending.update(keys)
+        transaction.on_commit(self.flush, robust=True)
+
+    def flush(self):
+        keys = getattr(self._local, 'keys', None)
+        self._local.keys = None
+        if keys:
+            self.handler(keys)
+
+
+def next_employee_id():
+    year = timezone.localdate().year
+    return f"EMP{year}-{next_sequence_number('EMP', year):04d}"
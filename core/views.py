@@ -1,27 +1,47 @@
 ﻿import logging
 from datetime import datetime, date, time, timedelta
-from uuid import uuid4
+from uuid import UUID, uuid4
 from django.forms import ValidationError
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.db.models import Q, Sum, OuterRef, Subquery, DateField, CharField, Value, Case, When
+from django.db.models import Q, Sum, Count, Exists, OuterRef, Subquery, DateField, CharField, Value, Case, When
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
 from django.db.models import Sum, F
-from django.http import HttpResponseBadRequest, JsonResponse
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, Http404, HttpResponseBadRequest, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from decimal import Decimal
 from contextlib import contextmanager
 from django.db.models.signals import post_save, post_delete
 from core.signals import billitem_deleted, apply_stock_on_save, revert_stock_on_delete
 
+from .billing import collect_bill_lines, create_bill, delete_bill_payments, update_bill
 from .decorators import group_required
+from .pagination import keyset_page
+from .kpis import (
+    cached_kpis, doctor_appointment_count, lead_chart, outstanding_balance, revenue_chart, summary_kpis,
+)
+from .timeseries import GRANULARITIES, auto_granularity
+from .exports import spreadsheet_response
+from .finance_facts import finance_summary
+from .followups import WORKLIST_WINDOWS, followup_status, worklist_queryset
+from .receivables import AGING_BUCKETS, AGING_ORDERING, aging_by_patient, aging_totals
+from .report_jobs import ARTIFACTS, artifact_path, submit_finance_report
+from .phones import phone_q
+from .search import patient_search_q, search_patients
+from .timeline import serialize_event, timeline_page
+from .receipts import (
+    bill_receipt_version, cached_receipt_path, snapshot_path, version_last_modified,
+)
 from .models import (
     AppointmentLog, MedicineCategory, Patient, PatientMedicalHistory, HairConsultation, Payment, TreatmentPlan,
     FollowUp, ProgressPhoto, Appointment, Bill, Branch,
     Medicine, MedicineStock, StockTransaction,
-    Lead, LeadSource, Expense, BillItem, User
+    Lead, LeadSource, Expense, BillItem, ReportJob, User
 )
 from .forms import (
     STAFFABLE_USER_TYPES, AppointmentCreateForm, AppointmentEditForm, AppointmentRescheduleForm, BillHeaderForm, PatientForm,
@@ -29,7 +49,7 @@ from .forms import (
     FollowUpForm, ProgressPhotoForm,
     MedicineForm, StockTransactionForm,
     LeadForm, LeadConvertForm,
-    ExpenseForm, ConsultationPhotoForm, PharmacyBillItemFormSet, user_can_edit_status
+    ExpenseForm, ConsultationPhotoForm, PharmacyBillItemFormSet, patient_option_data, user_can_edit_status
 )
 
 from django.views.decorators.http import require_POST, require_GET
@@ -131,8 +151,8 @@ def my_profile_password(request):
 
 
 # ---------------- Dashboard ----------------
-@group_required('PharmacyManager','OperationsManager','Doctor','ConsultingDoctor','Receptionist','Staff','CRO')
-def dashboard(request):
+def _dashboard_filters(request):
+    """Date range, branch and chart settings of a dashboard request (shared by the shell and the widgets)."""
     today = timezone.localdate()
     range_param = (request.GET.get('range') or '').strip()
     start_str = request.GET.get('from') or request.GET.get('start') or request.GET.get('date')
@@ -217,75 +237,12 @@ def dashboard(request):
             return "This Month Billed"
         return f"Billed - {base}"
 
-    kpi_range_label = _format_range_label(range_param, start, end)
-    kpi_day_label = _kpi_day_label(range_param, start, end)
-    kpi_billed_lbl = _kpi_billed_label(range_param, start, end)
-
-    appointments_in_range = apply_date_range(Appointment.objects.all(), 'appointment_date', start, end)
-    today_appts = appointments_in_range.count()
-
-    bills_in_range = apply_date_range(Bill.objects.all(), 'bill_date', start, end)
-    today_collection = bills_in_range.aggregate(s=Coalesce(Sum('paid_amount'), Decimal('0.00')))['s']
-    month_billed = bills_in_range.aggregate(s=Coalesce(Sum('total_amount'), Decimal('0.00')))['s']
-
-    outstanding_balance = Bill.objects.aggregate(
-        s=Coalesce(Sum(F('total_amount') - F('paid_amount')), Decimal('0.00'))
-    )['s']
-
-    is_doctor = request.user.groups.filter(name__in=["Doctor", "ConsultingDoctor"]).exists()
-    my_appts_count = 0
-    if is_doctor:
-        my_appts_count = apply_date_range(
-            Appointment.objects.filter(assigned_doctor_id=request.user.id),
-            'appointment_date',
-            start,
-            end,
-        ).count()
-
-    low_stock_qs = (
-        MedicineStock.objects
-        .select_related('medicine')
-        .filter(current_quantity__lte=F('medicine__minimum_stock_level'))
-    )
-    low_stock_count = low_stock_qs.count()
-
-    pending_exp_qs = Expense.objects.filter(status='pending')
-    pending_exp_count = pending_exp_qs.count()
-    pending_exp_amount = pending_exp_qs.aggregate(
-        s=Coalesce(Sum('amount'), Decimal('0.00'))
-    )['s']
-
-    leads_in_range = apply_date_range(Lead.objects.all(), 'created_at', start, end)
-    total_leads = leads_in_range.count()
-    converted_count = leads_in_range.filter(converted_patient__isnull=False).count()
-    conversion_rate = round((converted_count / total_leads) * 100, 1) if total_leads else 0.0
-
-    now_dt = timezone.now()
-
-    upcoming = (
-        apply_date_range(
-            Appointment.objects.select_related('patient', 'assigned_doctor', 'branch'),
-            'appointment_date',
-            today,
-            today,
-        )
-        .filter(appointment_date__gte=now_dt)
-        .order_by('appointment_date')[:8]
-    )
-
-    recent_bills = (
-        Bill.objects
-        .select_related('patient')
-        .order_by('-bill_date')[:8]
-    )
-
-    low_stock = low_stock_qs.order_by('current_quantity')[:8]
-
-    recent_leads = (
-        Lead.objects
-        .select_related('lead_source')
-        .order_by('-created_at')[:8]
-    )
+    # Selected branch (appointments only; bills and leads are not per branch)
+    branch_id = None
+    try:
+        branch_id = UUID(request.GET['branch']) if request.GET.get('branch') else None
+    except ValueError:
+        pass
 
     if not range_param and not start_str and not end_str:
         chart_start = today - timedelta(days=9)
@@ -305,65 +262,171 @@ def dashboard(request):
     if chart_end < chart_start:
         chart_start, chart_end = chart_end, chart_start
 
-    max_days = 31
-    span = (chart_end - chart_start).days
-    if span > max_days - 1:
-        start_for_chart = chart_end - timedelta(days=max_days - 1)
-    else:
-        start_for_chart = chart_start
-
-    day_count = (chart_end - start_for_chart).days + 1
-    days = [start_for_chart + timedelta(days=i) for i in range(day_count)]
-    rev_labels = [d.strftime('%d %b') for d in days]
-    rev_values = []
-    for d in days:
-        v = apply_date_range(Bill.objects.all(), 'bill_date', d, d).aggregate(
-            s=Coalesce(Sum('paid_amount'), Decimal('0.00'))
-        )['s']
-        rev_values.append(float(v))
-
-    chart_revenue = {'labels': rev_labels, 'values': rev_values}
-    chart_leads = {
-        'open': Lead.objects.filter(converted_patient__isnull=True).count(),
-        'converted': Lead.objects.filter(converted_patient__isnull=False).count()
+    granularity = request.GET.get('granularity')
+    if granularity not in GRANULARITIES:
+        granularity = auto_granularity(chart_start, chart_end)
+
+    return {
+        'today': today,
+        'start': start,
+        'end': end,
+        'range': range_param,
+        'branch_id': branch_id,
+        'chart_start': chart_start,
+        'chart_end': chart_end,
+        'granularity': granularity,
+        'kpi_range_label': _format_range_label(range_param, start, end),
+        'kpi_day_label': _kpi_day_label(range_param, start, end),
+        'kpi_billed_label': _kpi_billed_label(range_param, start, end),
     }
 
+
+def _dashboard_role(user):
+    """Cache key part for role-dependent widgets: the user's groups (superusers see everything)."""
+    if user.is_superuser:
+        return ('superuser',)
+    return tuple(sorted(user.groups.values_list('name', flat=True)))
+
+
+@group_required('PharmacyManager','OperationsManager','Doctor','ConsultingDoctor','Receptionist','Staff','CRO')
+def dashboard(request):
+    """
+    Page shell: filters and empty widget frames only. Each widget is fetched
+    in parallel from dashboard_widget once the page has loaded.
+    """
+    f = _dashboard_filters(request)
+    chart_params = request.GET.copy()
+    chart_params.pop('granularity', None)
+    widget_params = request.GET.copy()
+    widget_params['granularity'] = f['granularity']
+
     ctx = {
-        'summary': {
-            'today_appts': today_appts,
-            'today_collection': today_collection,
-            'month_billed': month_billed,
-            'outstanding_balance': outstanding_balance,
-            'low_stock_count': low_stock_count,
-            'pending_exp_count': pending_exp_count,
-            'pending_exp_amount': pending_exp_amount,
-            'open_leads_count': Lead.objects.filter(converted_patient__isnull=True).count(),
-            'conversion_rate': conversion_rate,
-            'my_appts_count': my_appts_count,
-        },
-        'upcoming': upcoming,
-        'recent_bills': recent_bills,
-        'low_stock': low_stock,
-        'recent_leads': recent_leads,
-        'chart_revenue': chart_revenue,
-        'chart_leads': chart_leads,
+        'branches': Branch.objects.filter(is_active=True).order_by('name').only('id', 'name'),
+        'chart_query': chart_params.urlencode(),
+        'widget_query': widget_params.urlencode(),
+        'granularities': GRANULARITIES,
         'selected': {
-            'from': start,
-            'to': end,
-            'range': range_param,
+            'from': f['start'],
+            'to': f['end'],
+            'range': f['range'],
+            'granularity': f['granularity'],
+            'branch': f['branch_id'],
         },
-        'kpi_range_label': kpi_range_label,
-        'kpi_day_label': kpi_day_label,
-        'kpi_billed_label': kpi_billed_lbl,
+        'kpi_range_label': f['kpi_range_label'],
     }
     return render(request, 'dashboard.html', ctx)
 
+
+def _widget_kpis(request, f, role):
+    is_doctor = 'superuser' in role or 'Doctor' in role or 'ConsultingDoctor' in role
+    # Cached per (range, branch, role); see core/kpis.py for invalidation
+    summary = dict(summary_kpis(f['start'], f['end'], f['branch_id'], role))
+    summary['my_appts_count'] = (
+        doctor_appointment_count(request.user.id, f['start'], f['end'], f['branch_id']) if is_doctor else 0
+    )
+    return render(request, 'dashboard/_kpis.html', {
+        'summary': summary,
+        'kpi_day_label': f['kpi_day_label'],
+        'kpi_billed_label': f['kpi_billed_label'],
+    })
+
+
+def _widget_outstanding(request, f, role):
+    return render(request, 'dashboard/_outstanding.html', {'outstanding_balance': outstanding_balance()})
+
+
+def _widget_upcoming(request, f, role):
+    now_dt = timezone.now().replace(second=0, microsecond=0)
+
+    def compute():
+        qs = (apply_date_range(
+                  Appointment.objects.select_related('patient', 'assigned_doctor', 'branch'),
+                  'appointment_date', f['today'], f['today'])
+              .filter(appointment_date__gte=now_dt)
+              .order_by('appointment_date'))
+        if f['branch_id']:
+            qs = qs.filter(branch_id=f['branch_id'])
+        return list(qs[:8])
+
+    upcoming = cached_kpis('upcoming', ('appointments',), (now_dt, f['branch_id']), compute)
+    return render(request, 'dashboard/_upcoming.html', {'upcoming': upcoming})
+
+
+def _widget_recent_bills(request, f, role):
+    recent_bills = cached_kpis(
+        'recent-bills', ('bills',), (),
+        lambda: list(Bill.objects.select_related('patient').order_by('-bill_date')[:8]),
+    )
+    return render(request, 'dashboard/_recent_bills.html', {'recent_bills': recent_bills})
+
+
+def _widget_low_stock(request, f, role):
+    low_stock = cached_kpis(
+        'low-stock', ('stock',), (),
+        lambda: list(MedicineStock.objects
+                     .select_related('medicine')
+                     .filter(current_quantity__lte=F('medicine__minimum_stock_level'))
+                     .order_by('current_quantity')[:8]),
+    )
+    return render(request, 'dashboard/_low_stock.html', {'low_stock': low_stock})
+
+
+def _widget_recent_leads(request, f, role):
+    recent_leads = cached_kpis(
+        'recent-leads', ('leads',), (),
+        lambda: list(Lead.objects.select_related('lead_source').order_by('-created_at')[:8]),
+    )
+    return render(request, 'dashboard/_recent_leads.html', {'recent_leads': recent_leads})
+
+
+def _widget_revenue_chart(request, f, role):
+    return JsonResponse(revenue_chart(f['chart_start'], f['chart_end'], f['granularity']))
+
+
+def _widget_leads_chart(request, f, role):
+    return JsonResponse(lead_chart())
+
+
+DASHBOARD_WIDGETS = {
+    'kpis': _widget_kpis,
+    'outstanding': _widget_outstanding,
+    'upcoming': _widget_upcoming,
+    'recent-bills': _widget_recent_bills,
+    'low-stock': _widget_low_stock,
+    'recent-leads': _widget_recent_leads,
+    'revenue-chart': _widget_revenue_chart,
+    'leads-chart': _widget_leads_chart,
+}
+
+
+@require_GET
+@group_required('PharmacyManager','OperationsManager','Doctor','ConsultingDoctor','Receptionist','Staff','CRO')
+def dashboard_widget(request, name):
+    """One dashboard widget as an HTML fragment (tables, KPI cards) or JSON (charts)."""
+    widget = DASHBOARD_WIDGETS.get(name)
+    if widget is None:
+        raise Http404("Unknown dashboard widget")
+    response = widget(request, _dashboard_filters(request), _dashboard_role(request.user))
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
 # ---------------- Patients ----------------
+PATIENT_LIST_ORDERING = ('-created_at', '-id')  # backed by the patients_created_id / patients_balance_created indexes
+PATIENT_LIST_PAGE_SIZE = 50
+PATIENT_LIST_FIELDS = ('id', 'file_number', 'name', 'age', 'phone_number', 'balance', 'city', 'district', 'created_at',
+                       'next_followup_date')
+PATIENT_BALANCE_STATUSES = ('due', 'advance', 'settled')
+
+
+def _attach_followup_status(patients, today):
+    for p in patients:
+        p.next_fu = p.next_followup_date
+        p.status = followup_status(p.next_followup_date, today)
+
+
 @group_required('Receptionist','CRO','OperationsManager','Doctor','ConsultingDoctor','PharmacyManager','Staff')
 def patient_list(request):
     # ---- Parse date filters (registered date) ----
-    today = timezone.localdate()
-
     def parse_iso(d, default=None):
         if isinstance(d, date):
             return d
@@ -371,9 +434,8 @@ def patient_list(request):
             return date.fromisoformat(d) if d else default
         except (TypeError, ValueError):
             return default
-            
+
     today_date = timezone.localdate()
-    tomorrow_date = today_date + timedelta(days=1)
 
     start_raw = request.GET.get('from')
     end_raw = request.GET.get('to')
@@ -383,85 +445,35 @@ def patient_list(request):
     if end and start and end < start:
         start, end = end, start
 
-    qs = Patient.objects.all()
+    qs = Patient.objects.only(*PATIENT_LIST_FIELDS)
     qs = apply_date_range(qs, 'created_at', start, end)
 
-    # ---- Annotate next follow-up per patient (DateField-aware) ----
-    upcoming_sub = (FollowUp.objects
-        .filter(
-            patient=OuterRef('pk'),
-            next_followup_date__isnull=False,
-            next_followup_date__gte=today_date,
-        )
-        .order_by('next_followup_date')
-        .values('next_followup_date')[:1])
-
-    latest_past_sub = (FollowUp.objects
-        .filter(
-            patient=OuterRef('pk'),
-            next_followup_date__lt=today_date,
-            next_followup_date__isnull=False,
-        )
-        .order_by('-next_followup_date')
-        .values('next_followup_date')[:1])
-    
-    # Annotate 'next_fu' and then determine its status
-    qs = (qs
-        .annotate(upcoming_fu=Subquery(upcoming_sub, output_field=DateField()))
-        .annotate(latest_past_fu=Subquery(latest_past_sub, output_field=DateField()))
-        .annotate(next_fu=Coalesce('upcoming_fu', 'latest_past_fu'))
-        .annotate(
-            status=Case(
-                When(next_fu__isnull=False, then=Case(
-                    When(next_fu=today_date, then=Value('today')),
-                    When(next_fu=tomorrow_date, then=Value('tomorrow')),
-                    When(next_fu__lt=today_date, then=Value('overdue')),
-                    default=Value('upcoming'),
-                )),
-                default=Value('none'),
-                output_field=CharField()
-            )
-        ))
+    q = (request.GET.get('q') or '').strip()
+    if q:
+        qs = qs.filter(patient_search_q(q))
 
-    # ---- Filter by balance status (CORRECTED LOGIC) ----
+    # ---- Filter by balance status: the sign of the running Patient.balance ----
     balance_status = request.GET.get('balance_status')
+    if balance_status in PATIENT_BALANCE_STATUSES:
+        qs = qs.filter(balance_status=balance_status)
 
-    # Sum up all 'due' and 'advance' amounts for a patient across all bills
-    # Uses Case, When, and F expressions to calculate dynamically
-    bill_subquery = Bill.objects.filter(patient=OuterRef('pk')).values('patient').annotate(
-        total_due_calc=Sum(Case(
-            When(total_amount__gt=F('paid_amount'), then=F('total_amount') - F('paid_amount')),
-            default=Value(0),
-            output_field=DecimalField()
-        )),
-        total_advance_calc=Sum(Case(
-            When(paid_amount__gt=F('total_amount'), then=F('paid_amount') - F('total_amount')),
-            default=Value(0),
-            output_field=DecimalField()
-        ))
-    )
+    page = keyset_page(qs, PATIENT_LIST_ORDERING,
+                       after=request.GET.get('after'), before=request.GET.get('before'),
+                       per_page=PATIENT_LIST_PAGE_SIZE)
+    _attach_followup_status(page.items, today_date)
 
-    qs = qs.annotate(
-        total_due=Coalesce(Subquery(bill_subquery.values('total_due_calc'), output_field=DecimalField()), Decimal('0.00')),
-        total_advance=Coalesce(Subquery(bill_subquery.values('total_advance_calc'), output_field=DecimalField()), Decimal('0.00'))
-    )
-
-    if balance_status == 'due':
-        qs = qs.filter(total_due__gt=0)
-    elif balance_status == 'advance':
-        qs = qs.filter(total_advance__gt=0)
-    elif balance_status == 'settled':
-        # Settled means no due and no advance
-        qs = qs.filter(total_due=0, total_advance=0)
-
-    # Order by creation date
-    qs = qs.order_by('-created_at')
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
 
     ctx = {
-        'patients': qs,
+        'patients': page.items,
+        'page': page,
+        'page_query': params.urlencode(),
         'selected': {
             'from': start, 
             'to': end,
+            'q': q,
             'balance_status': balance_status, # Pass the selected status to the template
         },
         'today_date': today_date,
@@ -497,21 +509,73 @@ def patient_update(request, pk):
     # re-use your patient form template, just tell it we’re editing
     return render(request, 'patients/form.html', {'form': form, 'is_edit': True, 'patient': patient})
 
+# Tabs of patient_detail loaded as separate fragments: (keyset ordering, template).
+# Each ordering is backed by a (patient, date, id) index on the section's table.
+PATIENT_SECTIONS = {
+    'appointments': (('-appointment_date', '-id'), 'patients/_appointments.html'),
+    'consultations': (('-consultation_date', '-id'), 'patients/_consultations.html'),
+    'followups': (('-followup_date', '-id'), 'patients/_followups.html'),
+    'billing': (('-bill_date', '-id'), 'patients/_billing.html'),
+    'photos': (('-taken_date', '-id'), 'patients/_photos.html'),
+}
+PATIENT_SECTION_PAGE_SIZE = 20
+
+
+def _patient_section_queryset(section, patient_id):
+    if section == 'appointments':
+        return Appointment.objects.filter(patient_id=patient_id).select_related('assigned_doctor')
+    if section == 'consultations':
+        return HairConsultation.objects.filter(patient_id=patient_id).select_related('doctor', 'treatment_plan')
+    if section == 'followups':
+        return FollowUp.objects.filter(patient_id=patient_id)
+    if section == 'billing':
+        return Bill.objects.filter(patient_id=patient_id)
+    return ProgressPhoto.objects.filter(patient_id=patient_id)
+
+
+def _per_patient(queryset, aggregate, default=0):
+    """Scalar subquery of `aggregate` over this patient's rows of `queryset`, for annotating patients."""
+    rows = queryset.filter(patient=OuterRef('pk')).order_by().values('patient').annotate(v=aggregate).values('v')
+    return Coalesce(Subquery(rows), Value(default))
+
+
 @group_required('Receptionist','Doctor','ConsultingDoctor','OperationsManager','PharmacyManager','CRO','Staff')
 def patient_detail(request, pk):
-    patient = get_object_or_404(Patient, pk=pk)
+    """Patient header and tab counts in one query; each tab's rows are loaded by patient_detail_section."""
+    patient = get_object_or_404(
+        Patient.objects.select_related('medical_history', 'merged_into').annotate(
+            appointment_count=_per_patient(Appointment.objects, Count('pk')),
+            consultation_count=_per_patient(HairConsultation.objects, Count('pk')),
+            followup_count=_per_patient(FollowUp.objects, Count('pk')),
+            bill_count=_per_patient(Bill.objects, Count('pk')),
+            photo_count=_per_patient(ProgressPhoto.objects, Count('pk')),
+            total_billed=_per_patient(Bill.objects, Sum('total_amount'), Decimal('0.00')),
+        ),
+        pk=pk,
+    )
     ctx = {
         'patient': patient,
         'history': getattr(patient, 'medical_history', None),
-        'consultations': patient.consultations.select_related('doctor').order_by('-consultation_date'),
-        'followups': patient.followups.select_related('treatment_plan').order_by('-followup_date'),
-        'photos': ProgressPhoto.objects.filter(patient=patient).order_by('-taken_date'),
-        'appointments': patient.appointments.select_related('assigned_doctor').order_by('-appointment_date'),
-        'bills': patient.bills.order_by('-bill_date'),
-        'billing_summary': {'total_billed': patient.bills.aggregate(s=Sum('total_amount'))['s'] or 0},
+        'billing_summary': {'total_billed': patient.total_billed},
     }
     return render(request, 'patients/detail.html', ctx)
 
+
+@require_GET
+@group_required('Receptionist','Doctor','ConsultingDoctor','OperationsManager','PharmacyManager','CRO','Staff')
+def patient_detail_section(request, pk, section):
+    """One page of a patient_detail tab as an HTML fragment, newest first."""
+    if section not in PATIENT_SECTIONS:
+        raise Http404("Unknown patient section")
+    ordering, template = PATIENT_SECTIONS[section]
+    patient = get_object_or_404(Patient.objects.only('id'), pk=pk)
+    page = keyset_page(_patient_section_queryset(section, patient.pk), ordering,
+                       after=request.GET.get('after'), before=request.GET.get('before'),
+                       per_page=PATIENT_SECTION_PAGE_SIZE)
+    response = render(request, template, {'patient': patient, 'page': page, 'items': page.items})
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
 # ---------------- Medical History ----------------
 @group_required('Doctor','ConsultingDoctor','Receptionist','OperationsManager')
 def medical_history_create(request, patient_id):
@@ -716,6 +780,36 @@ def followup_update(request, pk):
         'is_edit': True,
     })
 
+FOLLOWUP_WORKLIST_PAGE_SIZE = 50
+
+
+@group_required('Receptionist','CRO','OperationsManager','Doctor','ConsultingDoctor')
+def followup_worklist(request):
+    """Patients due for a follow-up (today / overdue / next 7 days), from the indexed Patient.next_followup_date."""
+    today = timezone.localdate()
+    window = request.GET.get('window') or 'due'
+    if window not in dict(WORKLIST_WINDOWS):
+        window = 'due'
+
+    qs, ordering = worklist_queryset(window, today)
+    page = keyset_page(qs.only(*PATIENT_LIST_FIELDS, 'last_followup_date'), ordering,
+                       after=request.GET.get('after'), before=request.GET.get('before'),
+                       per_page=FOLLOWUP_WORKLIST_PAGE_SIZE)
+    _attach_followup_status(page.items, today)
+
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+    return render(request, 'followups/worklist.html', {
+        'patients': page.items,
+        'page': page,
+        'page_query': params.urlencode(),
+        'total': qs.count(),
+        'windows': WORKLIST_WINDOWS,
+        'selected': {'window': window},
+        'today_date': today,
+    })
+
 @group_required('Doctor','ConsultingDoctor','OperationsManager','PharmacyManager','Receptionist')
 def progress_photo_create(request, patient_id):
     patient = get_object_or_404(Patient, pk=patient_id)
@@ -786,11 +880,7 @@ def appointment_list(request):
     qs = apply_date_range(qs, 'appointment_date', start, end)
 
     if q:
-        qs = qs.filter(
-            Q(patient__name__icontains=q) |
-            Q(patient__phone_number__icontains=q) |
-            Q(patient__file_number__icontains=q)
-        )
+        qs = qs.filter(patient_search_q(q, 'patient__'))
 
     if doctor_id and doctor_id != 'all':
         qs = qs.filter(assigned_doctor_id=doctor_id)
@@ -882,11 +972,7 @@ def my_appointment_list(request):
 
     # --- search ---
     if q:
-        qs = qs.filter(
-            Q(patient__name__icontains=q) |
-            Q(patient__phone_number__icontains=q) |
-            Q(patient__file_number__icontains=q)
-        )
+        qs = qs.filter(patient_search_q(q, 'patient__'))
 
     # --- status ---
     if status and status != 'all':
@@ -1161,9 +1247,16 @@ PAYMENT_METHOD_CHOICES = [
     ('upi', 'UPI'),
     ('cheque', 'Cheque'),
 ]
+BILL_LIST_ORDERING = ('-bill_date', '-id')  # backed by the bills_type_date_id index
+BILL_LIST_PAGE_SIZE = 50
+BILL_EXPORT_LEVELS = [
+    ('bills', 'Bills'),
+    ('items', 'Line items'),
+    ('payments', 'Payments'),
+]
 
 
-def _bill_queryset_with_filters(request, bill_type):
+def _bill_queryset_with_filters(request, bill_type, with_totals=True):
     q = (request.GET.get('q') or '').strip()
     payment_method = (request.GET.get('method') or '').strip()
     balance_status = (request.GET.get('balance_status') or '').strip()
@@ -1211,20 +1304,15 @@ def _bill_queryset_with_filters(request, bill_type):
 
     qs = (Bill.objects
           .select_related('patient')
-          .prefetch_related('payments')
           .filter(bill_type=bill_type))
     qs = apply_date_range(qs, 'bill_date', start, end)
 
     if q:
-        qs = qs.filter(
-            Q(bill_number__icontains=q) |
-            Q(patient__name__icontains=q) |
-            Q(patient__phone_number__icontains=q) |
-            Q(patient__file_number__icontains=q)
-        )
+        qs = qs.filter(Q(bill_number__istartswith=q) | patient_search_q(q, 'patient__'))
 
     if payment_method and payment_method != 'all':
-        qs = qs.filter(payments__method=payment_method).distinct()
+        # EXISTS keeps one row per bill without a JOIN + DISTINCT
+        qs = qs.filter(Exists(Payment.objects.filter(bill=OuterRef('pk'), method=payment_method)))
 
     if balance_status:
         if balance_status == 'due':
@@ -1248,14 +1336,17 @@ def _bill_queryset_with_filters(request, bill_type):
             default=Value(0),
             output_field=DecimalField(max_digits=10, decimal_places=2)
         )
-    ).order_by('-bill_date')
-
-    # --- ✅ Add totals here ---
-    totals = qs.aggregate(
-        total_amount=Sum('total_amount') or 0,
-        paid_amount=Sum('paid_amount') or 0,
-    )
-    totals['balance'] = (totals['total_amount'] or 0) - (totals['paid_amount'] or 0)
+    ).order_by(*BILL_LIST_ORDERING)
+
+    # --- ✅ Add totals here (one aggregate for sums and row count) ---
+    totals = None
+    if with_totals:
+        totals = qs.aggregate(
+            total_amount=Sum('total_amount'),
+            paid_amount=Sum('paid_amount'),
+            count=Count('id'),
+        )
+        totals['balance'] = (totals['total_amount'] or 0) - (totals['paid_amount'] or 0)
 
     selected = {
         'from': start,
@@ -1268,145 +1359,178 @@ def _bill_queryset_with_filters(request, bill_type):
     return qs, selected, totals
 
 
+def _bill_list_page(request, qs):
+    """
+    One keyset page of the filtered bills plus the query string (filters
+    without cursors) for the Newer/Older links. The last payment method of the
+    page's bills is attached as last_method_display with a single query.
+    """
+    page = keyset_page(qs, BILL_LIST_ORDERING,
+                       after=request.GET.get('after'), before=request.GET.get('before'),
+                       per_page=BILL_LIST_PAGE_SIZE)
+
+    methods = dict(Payment.PAYMENT_METHOD_CHOICES)
+    last_method = dict(
+        Payment.objects
+        .filter(bill_id__in=[b.pk for b in page.items], entry_type='payment')
+        .order_by('bill_id', 'date')
+        .values_list('bill_id', 'method')
+    ) if page.items else {}
+    for b in page.items:
+        b.last_method_display = methods.get(last_method.get(b.pk), '')
+
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+    return page, params.urlencode()
+
+
 @group_required('Receptionist', 'CRO', 'OperationsManager', 'Doctor', 'PharmacyManager', 'Staff')
 def service_bill_list(request):
     qs, selected, totals = _bill_queryset_with_filters(request, bill_type='service')
+    page, page_query = _bill_list_page(request, qs)
     ctx = {
         'title': 'Service Bills',
-        'bills': qs,
+        'bills': page.items,
+        'page': page,
+        'page_query': page_query,
         'status_choices': [('all', 'All')] + BILL_STATUS_CHOICES_UI,
         'method_choices': [('all', 'All')] + PAYMENT_METHOD_CHOICES,
         'selected': selected,
         'totals': totals,
         'page_kind': 'service',
         'create_url_name': 'service_bill_create',
+        'export_url_name': 'service_bill_export',
+        'export_levels': BILL_EXPORT_LEVELS,
     }
     return render(request, 'bills/service_list.html', ctx)
 
 @group_required('Receptionist', 'CRO', 'OperationsManager', 'Doctor', 'PharmacyManager', 'Staff')
 def pharmacy_bill_list(request):
     qs, selected, totals = _bill_queryset_with_filters(request, bill_type='pharmacy')
+    page, page_query = _bill_list_page(request, qs)
     ctx = {
         'title': 'Pharmacy Bills',
-        'bills': qs,
+        'bills': page.items,
+        'page': page,
+        'page_query': page_query,
         'status_choices': [('all', 'All')] + BILL_STATUS_CHOICES_UI,
         'method_choices': [('all', 'All')] + PAYMENT_METHOD_CHOICES,
         'selected': selected,
         'totals': totals,
         'page_kind': 'pharmacy',
         'create_url_name': 'pharmacy_sale_create',
+        'export_url_name': 'pharmacy_bill_export',
+        'export_levels': BILL_EXPORT_LEVELS,
     }
     return render(request, 'bills/pharmacy_list.html', ctx)
 
-# ---------- SERVICE BILL ----------
 
-def finalize_bill_totals(bill):
-    """Calculate final bill totals including tax and discount"""
-    D0 = Decimal('0.00')
-    
-    # Calculate subtotal from items
-    subtotal = bill.items.aggregate(s=Sum('total_price'))['s'] or D0
-    
-    # Apply tax and discount
-    tax = bill.tax_amount or D0
-    discount = bill.discount_amount or D0
-    final_total = subtotal + tax - discount
-    
-    # Update bill total (no balance update yet)
-    bill.total_amount = final_total
-    bill.save(update_fields=['total_amount'])
+# ---------- BILL EXPORTS ----------
+
+EXPORT_PAGE_SIZE = 1000
+
+BILL_EXPORT_COLUMNS = {
+    'bills': (
+        ['Bill #', 'Date', 'File #', 'Patient', 'Phone', 'Tax', 'Discount', 'Total', 'Paid', 'Balance', 'Created by'],
+        None,
+    ),
+    'items': (
+        ['Bill #', 'Bill date', 'File #', 'Patient', 'Kind', 'Description', 'Qty', 'Unit price', 'Line total'],
+        ('bill__bill_number', 'bill__bill_date', 'bill__patient__file_number', 'bill__patient__name',
+         'kind', 'description', 'quantity', 'unit_price', 'total_price'),
+    ),
+    'payments': (
+        ['Bill #', 'Paid on', 'File #', 'Patient', 'Entry', 'Method', 'Amount', 'Received by'],
+        ('bill__bill_number', 'date', 'bill__patient__file_number', 'bill__patient__name',
+         'entry_type', 'method', 'amount', 'received_by__username'),
+    ),
+}
 
 
-def update_patient_balance_for_bill(bill, is_new=False):
-    """Update patient balance for bill changes"""
-    if not bill.patient_id:
-        return
-    
-    D0 = Decimal('0.00')
-    current_total = bill.total_amount or D0
-    
-    if is_new:
-        # New bill - add total to patient balance
-        if current_total > 0:
-            type(bill.patient).objects.filter(pk=bill.patient_id).update(
-                balance=F('balance') + current_total
-            )
-    else:
-        # Bill update - we'll handle this in the view by calculating the delta
-        pass
+def _bill_export_pages(qs):
+    """
+    Walk the filtered bills newest first in keyset pages on (bill_date, id), so
+    memory stays flat on every database backend (MySQLdb buffers whole result
+    sets, even under .iterator()).
+    """
+    qs = qs.prefetch_related(None).order_by('-bill_date', '-id')
+    fields = ('bill_number', 'bill_date', 'patient__file_number', 'patient__name', 'patient__phone_number',
+              'tax_amount', 'discount_amount', 'total_amount', 'paid_amount', 'raw_balance',
+              'created_by__username')
+    last = None
+    while True:
+        page_qs = qs
+        if last:
+            page_qs = qs.filter(Q(bill_date__lt=last[0]) | Q(bill_date=last[0], id__lt=last[1]))
+        page = list(page_qs.values_list('bill_date', 'id', *fields)[:EXPORT_PAGE_SIZE])
+        if not page:
+            return
+        yield page
+        last = page[-1][:2]
+
+
+def _bill_export_rows(qs, level):
+    for page in _bill_export_pages(qs):
+        if level == 'bills':
+            for row in page:
+                yield row[2:]
+            continue
+
+        ids = [row[1] for row in page]
+        if level == 'items':
+            children = BillItem.objects.filter(bill_id__in=ids).order_by('-bill__bill_date', '-bill_id', 'id')
+        else:
+            children = Payment.objects.filter(bill_id__in=ids).order_by('-bill__bill_date', '-bill_id', 'date')
+        children = children.values_list(*BILL_EXPORT_COLUMNS[level][1])
+        yield from children.iterator(chunk_size=EXPORT_PAGE_SIZE)
+
+
+@group_required('Receptionist', 'CRO', 'OperationsManager', 'Doctor', 'PharmacyManager', 'Staff')
+def bill_export(request, bill_type):
+    """
+    Download the filtered bill register (same filters as the list page) as CSV
+    or XLSX, one row per bill, line item or payment (?level=bills|items|payments).
+    """
+    level = request.GET.get('level') or 'bills'
+    fmt = request.GET.get('format') or 'csv'
+    if level not in BILL_EXPORT_COLUMNS or fmt not in ('csv', 'xlsx'):
+        return HttpResponseBadRequest("Unknown export level or format.")
+
+    qs, selected, _ = _bill_queryset_with_filters(request, bill_type=bill_type, with_totals=False)
+    period = '_'.join(d.isoformat() for d in (selected['from'], selected['to']) if d) or 'all'
+    filename = f"{bill_type}-{level}-{period}"
+    header = BILL_EXPORT_COLUMNS[level][0]
+    rows = _bill_export_rows(qs, level)
+
+    try:
+        return spreadsheet_response(fmt, filename, header, rows, sheet_title=f"{bill_type} {level}")
+    except ImportError:
+        return HttpResponseBadRequest("XLSX export needs openpyxl; use format=csv.")
+
+# ---------- SERVICE BILL ----------
 
 @group_required('Receptionist','OperationsManager','Doctor','PharmacyManager')
 @transaction.atomic
 def service_bill_create(request):
     if request.method == 'POST':
         header_form = BillHeaderForm(request.POST)
+        # Validate against an unsaved bill; nothing is written until everything is valid
+        formset = ServiceBillItemFormSet(request.POST, instance=Bill(bill_type='service'))
 
-        if header_form.is_valid():
-            # Create bill without updating patient balance yet
-            bill = header_form.save(commit=False)
-            bill.bill_type = 'service'
-            bill.created_by = request.user
-            bill.save()  # Save without balance update
-
-            formset = ServiceBillItemFormSet(request.POST, instance=bill)
-            if formset.is_valid():
-                # Save non-empty items
-                saved_any = False
-                for f in formset.forms:
-                    if getattr(f, '_empty_row_skip', False) or f.cleaned_data.get('DELETE'):
-                        continue
-                    it = f.save(commit=False)
-                    it.bill = bill
-                    it.kind = 'service'
-                    it.save()  # This updates bill.total_amount but not patient balance
-                    saved_any = True
-
-                if not saved_any:
-                    transaction.set_rollback(True)
-                    messages.error(request, "Add at least one service item.")
-                    return render(request, 'bills/service_bill_create.html', {
-                        'header_form': header_form,
-                        'formset': ServiceBillItemFormSet(),
-                        'is_edit': False,
-                    })
-
-                finalize_bill_totals(bill)
-                
-                # NOW update patient balance for the complete bill
-                update_patient_balance_for_bill(bill, is_new=True)
-
-                # Handle payment
-                paid = header_form.cleaned_data.get('paid_amount') or Decimal('0.00')
-                method = header_form.cleaned_data.get('payment_method')
-                bill.paid_amount = paid
-                bill.save(update_fields=['paid_amount'])
-                
-                if paid > 0 and method:
-                    Payment.objects.create(
-                        patient=bill.patient, 
-                        bill=bill, 
-                        amount=paid, 
-                        method=method,
-                        received_by=request.user,
-                    )
-
+        if header_form.is_valid() and formset.is_valid():
+            lines = collect_bill_lines(formset, 'service')
+            if lines:
+                bill = create_bill(header_form, lines, 'service', request.user)
                 messages.success(request, f"Service bill #{bill.bill_number} created successfully.")
                 return redirect('bill_receipt', pk=bill.pk)
-
-            # Invalid items
-            transaction.set_rollback(True)
+            messages.error(request, "Add at least one service item.")
+        else:
             messages.error(request, "Please fix the errors below.")
-            return render(request, 'bills/service_bill_create.html', {
-                'header_form': header_form,
-                'formset': ServiceBillItemFormSet(),
-                'is_edit': False,
-            })
 
-        # Invalid header
-        messages.error(request, "Please fix the errors below.")
         return render(request, 'bills/service_bill_create.html', {
             'header_form': header_form,
-            'formset': ServiceBillItemFormSet(),
+            'formset': formset,
             'is_edit': False,
         })
 
@@ -1421,59 +1545,14 @@ def service_bill_create(request):
 @transaction.atomic
 def service_bill_edit(request, pk):
     bill = get_object_or_404(Bill, pk=pk, bill_type='service')
-    D0 = Decimal('0.00')
 
     if request.method == 'POST':
         header_form = BillHeaderForm(request.POST, instance=bill)
         formset = ServiceBillItemFormSet(request.POST, instance=bill)
 
         if header_form.is_valid() and formset.is_valid():
-            old_total = bill.total_amount or D0
-            old_paid_total = bill.payments.aggregate(s=Sum('amount'))['s'] or D0
-
-            # Save header (no balance update)
-            bill = header_form.save(commit=False)
-            if not bill.created_by:
-                bill.created_by = request.user
-            bill.save()
-
-            # Save items → updates bill.total_amount
-            formset.save()
-
-            # Finalize totals
-            finalize_bill_totals(bill)
-
-            # Adjust balance for bill total delta
-            new_total = bill.total_amount or D0
-            total_delta = new_total - old_total
-            if total_delta != 0:
-                type(bill.patient).objects.filter(pk=bill.patient_id).update(
-                    balance=F('balance') + total_delta
-                )
-
-            # --- Payment delta handling ---
-            new_paid_total = header_form.cleaned_data.get('paid_amount') or D0
-            new_method     = header_form.cleaned_data.get('payment_method')
-
-            # 1) Remove old payments *one by one* so Payment.delete() runs
-            for p in bill.payments.all():
-                p.delete()
-
-            # 2) Persist the bill's paid_amount field
-            bill.paid_amount = new_paid_total
-            bill.save(update_fields=['paid_amount'])
-
-            # 3) Recreate a single payment that matches the form total & method
-            #    (Payment.save() will correctly adjust patient balance)
-            if new_paid_total > D0 and new_method:
-                Payment.objects.create(
-                    patient=bill.patient,
-                    bill=bill,
-                    amount=new_paid_total,
-                    method=new_method,            # <-- this is now always written
-                    received_by=request.user,
-                )
-            # --- end payments ---
+            # Writes only the lines that changed and moves the balance by the total delta
+            bill = update_bill(header_form, formset, 'service', request.user)
 
             messages.success(request, f"Service bill #{bill.bill_number} updated successfully.")
             return redirect('bill_receipt', pk=bill.pk)
@@ -1498,19 +1577,10 @@ def service_bill_delete(request, pk):
     if request.method == 'POST':
         # Store bill info for message
         bill_number = bill.bill_number
-        patient = bill.patient
-        
-        # Delete all payments first (Payment.delete() will adjust patient balance)
-        for payment in bill.payments.all():
-            payment.delete()
-        
-        # Adjust patient balance for bill total
-        bill_total = bill.total_amount or Decimal('0.00')
-        if bill_total != 0:
-            type(patient).objects.filter(pk=patient.pk).update(
-                balance=F('balance') - bill_total
-            )
-        
+
+        # Drop the bill's ledger entries and release what was still due on it
+        delete_bill_payments(bill)
+
         # Delete the bill (cascade will delete items)
         bill.delete()
         
@@ -1528,84 +1598,28 @@ def service_bill_delete(request, pk):
 def pharmacy_bill_create(request):
     if request.method == 'POST':
         header_form = BillHeaderForm(request.POST)
-        
-        if header_form.is_valid():
-            # Create bill without updating patient balance yet
-            bill = header_form.save(commit=False)
-            bill.bill_type = 'pharmacy'
-            bill.created_by = request.user
-            bill.save()  # Save without balance update
-
-            formset = PharmacyBillItemFormSet(request.POST, instance=bill)
-            if formset.is_valid():
-                # Save non-empty items
-                saved_any = False
-                for f in formset.forms:
-                    if getattr(f, '_empty_row_skip', False) or f.cleaned_data.get('DELETE'):
-                        continue
-                    it = f.save(commit=False)
-                    it.bill = bill
-                    it.kind = 'pharmacy'
-                    it.save()
-
-                    if it.medicine:
-                        StockTransaction.objects.create(
-                            medicine=it.medicine,
-                            transaction_type='sale',
-                            quantity=it.quantity,
-                            unit_price=it.unit_price,
-                            patient=bill.patient,
-                            reference_number=bill.bill_number,
-                            notes=f'Pharmacy Bill #{bill.bill_number}',
-                            created_by=request.user
-                        )
-                    
-                    saved_any = True
-
-                if not saved_any:
-                    transaction.set_rollback(True)
-                    messages.error(request, "Add at least one medicine item.")
-                    return render(request, 'bills/pharmacy_bill_create.html', {
-                        'header_form': header_form,
-                        'formset': PharmacyBillItemFormSet(),
-                    })
-
-                # Finalize totals with tax/discount
-                finalize_bill_totals(bill)
-                
-                # NOW update patient balance for the complete bill
-                update_patient_balance_for_bill(bill, is_new=True)
-
-                # Handle payment
-                paid = header_form.cleaned_data.get('paid_amount') or Decimal('0.00')
-                method = header_form.cleaned_data.get('payment_method')
-                bill.paid_amount = paid
-                bill.save(update_fields=['paid_amount'])
-                
-                if paid > 0 and method:
-                    Payment.objects.create(
-                        patient=bill.patient, 
-                        bill=bill, 
-                        amount=paid, 
-                        method=method,
-                        received_by=request.user,
-                    )
-
-                messages.success(request, f"Pharmacy bill #{bill.bill_number} created successfully.")
-                return redirect('bill_receipt', pk=bill.pk)
+        formset = PharmacyBillItemFormSet(request.POST, instance=Bill(bill_type='pharmacy'))
 
-            transaction.set_rollback(True)
-            messages.error(request, "Please fix the errors below.")
-            return render(request, 'bills/pharmacy_bill_create.html', {
-                'header_form': header_form,
-                'formset': PharmacyBillItemFormSet(),
-            })
+        if header_form.is_valid() and formset.is_valid():
+            lines = collect_bill_lines(formset, 'pharmacy')
+            if lines:
+                try:
+                    bill = create_bill(header_form, lines, 'pharmacy', request.user)
+                except ValueError as e:
+                    # Stock moved between validation and save
+                    messages.error(request, str(e))
+                else:
+                    messages.success(request, f"Pharmacy bill #{bill.bill_number} created successfully.")
+                    return redirect('bill_receipt', pk=bill.pk)
+            else:
+                messages.error(request, "Add at least one medicine item.")
         else:
             messages.error(request, "Please fix the errors below.")
-            return render(request, 'bills/pharmacy_bill_create.html', {
-                'header_form': header_form,
-                'formset': PharmacyBillItemFormSet(),
-            })
+
+        return render(request, 'bills/pharmacy_bill_create.html', {
+            'header_form': header_form,
+            'formset': formset,
+        })
 
     # GET
     return render(request, 'bills/pharmacy_bill_create.html', {
@@ -1617,80 +1631,24 @@ def pharmacy_bill_create(request):
 @transaction.atomic
 def pharmacy_bill_edit(request, pk):
     bill = get_object_or_404(Bill, pk=pk, bill_type='pharmacy')
-    D0 = Decimal('0.00')
 
     if request.method == 'POST':
         header_form = BillHeaderForm(request.POST, instance=bill)
         formset = PharmacyBillItemFormSet(request.POST, instance=bill)
 
         if header_form.is_valid() and formset.is_valid():
-            old_total = bill.total_amount or D0
-            old_paid_total = bill.payments.aggregate(s=Sum('amount'))['s'] or D0
-
-            # --- STEP 1: Restore old stock automatically by deleting old transactions ---
-            StockTransaction.objects.filter(reference_number=bill.bill_number).delete()
-
-            # --- STEP 2: Save bill header ---
-            bill = header_form.save(commit=False)
-            if not bill.created_by:
-                bill.created_by = request.user
-            bill.save()
-
-            # --- STEP 3: Save items & create new StockTransactions ---
-            items = formset.save(commit=False)
-            for item in items:
-                item.bill = bill
-                item.kind = 'pharmacy'
-                item.save()
-
-                if item.medicine:
-                    StockTransaction.objects.create(
-                        medicine=item.medicine,
-                        transaction_type='sale',
-                        quantity=item.quantity,
-                        unit_price=item.unit_price,
-                        patient=bill.patient,
-                        reference_number=bill.bill_number,
-                        notes=f'Bill #{bill.bill_number} (edited)',
-                        created_by=request.user,
-                    )
-
-            # Delete removed items
-            for obj in formset.deleted_objects:
-                obj.delete()
-
-            # --- STEP 4: Finalize totals ---
-            finalize_bill_totals(bill)
-
-            # --- STEP 5: Update patient balance based on bill total delta ---
-            new_total = bill.total_amount or D0
-            total_delta = new_total - old_total
-            if total_delta != 0:
-                type(bill.patient).objects.filter(pk=bill.patient_id).update(
-                    balance=F('balance') + total_delta
-                )
-
-            # --- STEP 6: Handle payments ---
-            new_paid_total = header_form.cleaned_data.get('paid_amount') or D0
-            new_method = header_form.cleaned_data.get('payment_method')
-
-            # Delete old payments (auto adjust balances if signals used)
-            for p in bill.payments.all():
-                p.delete()
-
-            # Update bill.paid_amount
-            bill.paid_amount = new_paid_total
-            bill.save(update_fields=['paid_amount'])
-
-            # Recreate payment record if applicable
-            if new_paid_total > D0 and new_method:
-                Payment.objects.create(
-                    patient=bill.patient,
-                    bill=bill,
-                    amount=new_paid_total,
-                    method=new_method,
-                    received_by=request.user,
-                )
+            try:
+                # One stock adjustment per medicine whose quantity changed
+                bill = update_bill(header_form, formset, 'pharmacy', request.user)
+            except ValueError as e:
+                transaction.set_rollback(True)
+                messages.error(request, str(e))
+                return render(request, 'bills/pharmacy_bill_edit.html', {
+                    'header_form': header_form,
+                    'formset': formset,
+                    'bill': bill,
+                    'is_edit': True,
+                })
 
             messages.success(request, f"Pharmacy bill #{bill.bill_number} updated successfully.")
             return redirect('bill_receipt', pk=bill.pk)
@@ -1724,7 +1682,6 @@ def pharmacy_bill_delete(request, pk):
 
     if request.method == 'POST':
         bill_number = bill.bill_number
-        patient = bill.patient
 
         # Signals to temporarily disconnect
         signals_to_disconnect = [
@@ -1753,16 +1710,8 @@ def pharmacy_bill_delete(request, pk):
                         created_by=request.user
                     )
 
-            # Delete payments (Payment.delete adjusts patient balance)
-            for payment in bill.payments.all():
-                payment.delete()
-
-            # Adjust patient balance for bill total
-            bill_total = bill.total_amount or Decimal('0.00')
-            if bill_total != 0:
-                type(patient).objects.filter(pk=patient.pk).update(
-                    balance=F('balance') - bill_total
-                )
+            # Drop the bill's ledger entries and release what was still due on it
+            delete_bill_payments(bill)
 
             # Delete the bill
             bill.delete()
@@ -1789,15 +1738,15 @@ def bill_receipt(request, pk):
     D0 = Decimal('0.00')
 
     bill = get_object_or_404(Bill.objects.select_related('patient'), pk=pk)
-    items = bill.items.select_related('service', 'medicine').all()
+    items = list(bill.items.select_related('service', 'medicine'))
 
     # Subtotal = sum of line totals
-    subtotal = items.aggregate(s=Sum('total_price'))['s'] or D0
+    subtotal = sum((it.total_price or D0 for it in items), D0)
 
-    # Payments attached to THIS bill
-    payments = bill.payments.order_by('date')
-    paid_total = payments.aggregate(s=Sum('amount'))['s'] or D0
-    last_payment = payments.last()
+    # Payments attached to THIS bill; paid_amount follows the payment ledger
+    payments = list(bill.payments.order_by('date'))
+    paid_total = bill.paid_amount or D0
+    last_payment = next((p for p in reversed(payments) if p.entry_type == 'payment'), None)
     method_display = last_payment.get_method_display() if last_payment else ''
 
     # Balances
@@ -1854,6 +1803,62 @@ def patient_previous_bills(request, patient_id):
 
     return JsonResponse({"bills": data})
 
+
+PATIENT_AUTOCOMPLETE_PAGE_SIZE = 20
+PATIENT_AUTOCOMPLETE_FIELDS = ('id', 'file_number', 'name', 'age', 'gender', 'phone_number', 'address', 'city',
+                               'balance', 'created_at')
+
+
+@require_GET
+@group_required('Receptionist','Doctor','ConsultingDoctor','OperationsManager','PharmacyManager','CRO','Staff')
+def patient_timeline(request, patient_id):
+    """API: one page (50 events, newest first) of a patient's timeline; pass `next` back as ?cursor= for the next."""
+    patient = get_object_or_404(Patient.objects.only('id'), pk=patient_id)
+    events, next_cursor = timeline_page(patient.pk, request.GET.get('cursor'))
+    return JsonResponse({
+        "events": [serialize_event(e) for e in events],
+        "next": next_cursor,
+    })
+
+
+@group_required('Receptionist','OperationsManager','Doctor','ConsultingDoctor','PharmacyManager')
+@require_GET
+def patient_autocomplete(request):
+    """
+    API: one page of patients for the patient pickers. With q (3+ characters)
+    the best search matches, paged by offset in the ranking query; otherwise the
+    newest patients (or name / file number prefix matches), keyset paged on
+    the created_at index. `next` is passed back as is to get the next page.
+    """
+    q = (request.GET.get('q') or '').strip()
+    nxt = request.GET.get('next') or ''
+    qs = Patient.objects.only(*PATIENT_AUTOCOMPLETE_FIELDS).filter(merged_into__isnull=True)
+    if request.GET.get('active'):
+        qs = qs.filter(is_active=True)
+
+    if len(q) >= 3:
+        offset = int(nxt) if nxt.isdigit() else 0
+        # One extra match tells whether there is a next page
+        ranked = search_patients(q, limit=PATIENT_AUTOCOMPLETE_PAGE_SIZE + 1, offset=offset, patients=qs)
+        ids = [pk for pk, _ in ranked[:PATIENT_AUTOCOMPLETE_PAGE_SIZE]]
+        found = qs.in_bulk(ids)
+        patients = [found[pk] for pk in ids if pk in found]
+        more = len(ranked) > PATIENT_AUTOCOMPLETE_PAGE_SIZE
+        nxt = str(offset + PATIENT_AUTOCOMPLETE_PAGE_SIZE) if more else None
+    else:
+        if q:
+            qs = qs.filter(patient_search_q(q))
+        page = keyset_page(qs, PATIENT_LIST_ORDERING, after=nxt, per_page=PATIENT_AUTOCOMPLETE_PAGE_SIZE)
+        patients = page.items
+        more = page.has_next
+        nxt = page.next_cursor if more else None
+
+    return JsonResponse({
+        "results": [patient_option_data(p) for p in patients],
+        "more": more,
+        "next": nxt,
+    })
+
 # ---------------- Medicals ----------------
 @group_required('PharmacyManager','OperationsManager','Doctor','Receptionist','Staff')
 def medicine_list(request):
@@ -2120,11 +2125,11 @@ def lead_list(request):
 
     # Text search
     if q:
-        qs = qs.filter(
-            Q(name__icontains=q) |
-            Q(phone_number__icontains=q) |
-            Q(email__icontains=q)
-        )
+        match = Q(name__icontains=q) | Q(email__icontains=q)
+        phone_match = phone_q(q)
+        if phone_match is not None:
+            match |= phone_match
+        qs = qs.filter(match)
 
     # Facets
     if src:
@@ -2221,7 +2226,12 @@ def lead_convert(request, pk):
             'city': '', 'state': '', 'pincode': '', 'occupation': ''
         }
         form = LeadConvertForm(initial=initial)
-    return render(request, 'leads/convert.html', {'form': form, 'lead': lead})
+
+    # Patients already registered with the lead's number (indexed on phone_digits)
+    phone_patients = (Patient.objects
+                      .filter(phone_digits=lead.phone_digits)
+                      .only('id', 'name', 'file_number')[:5]) if lead.phone_digits else []
+    return render(request, 'leads/convert.html', {'form': form, 'lead': lead, 'phone_patients': phone_patients})
 
 # ---------------- Expenses ----------------
 @group_required('OperationsManager','Doctor')
@@ -2481,12 +2491,16 @@ def staff_list(request):
         qs = qs.filter(user_type=role)
 
     if q:
-        qs = qs.filter(
+        match = (
             Q(first_name__icontains=q) |
             Q(last_name__icontains=q) |
             Q(username__icontains=q) |
             Q(email__icontains=q)
         )
+        phone_match = phone_q(q)
+        if phone_match is not None:
+            match |= phone_match
+        qs = qs.filter(match)
 
     return render(request, 'staff/list.html', {
         'staff': qs,
@@ -2544,6 +2558,10 @@ class FinanceFilterForm(forms.Form):
     start = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
     end = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
 
+# Longer finance reports run as background jobs (core/report_jobs.py)
+FINANCE_REPORT_SYNC_DAYS = 92
+
+
 @group_required('OperationsManager','Doctor')
 def finance_report(request):
     today = timezone.localdate()
@@ -2557,89 +2575,103 @@ def finance_report(request):
         start = form.cleaned_data['start']
         end = form.cleaned_data['end']
 
-        # ---------------- Bills / Collections / Expenses ----------------
-        bills = (
-            Bill.objects
-            .select_related('patient')
-        )
-        bills = apply_date_range(bills, 'bill_date', start, end)
+        # Long periods are built by the report worker and kept as files
+        if (end - start).days + 1 > FINANCE_REPORT_SYNC_DAYS:
+            ctx['job'] = submit_finance_report(start, end, request.user)
+            ctx['job_period'] = f"{start.strftime('%d-%b-%Y')} to {end.strftime('%d-%b-%Y')}"
+            return render(request, 'reports/finance.html', ctx)
 
-        total_collection = bills.aggregate(
-            s=Coalesce(Sum('paid_amount'), Decimal('0.00'))
-        )['s']
+        # Bills, collections and sales come from the daily finance facts
+        ctx['summary'], ctx['by_area'] = finance_summary(start, end)
 
-        expenses = Expense.objects.filter(
-            expense_date__gte=start,
-            expense_date__lte=end,
-            status='paid'
-        )
-        total_expenses = expenses.aggregate(
-            s=Coalesce(Sum('amount'), Decimal('0.00'))
-        )['s']
-
-        total_billed = bills.aggregate(
-            s=Coalesce(Sum('total_amount'), Decimal('0.00'))
-        )['s']
-
-        # Pharmacy sales
-        pharm_items = (
-            BillItem.objects
-            .filter(bill__in=bills, kind='pharmacy')
-            .select_related('bill', 'medicine')
-        )
-        total_medicine_sale = pharm_items.aggregate(
-            s=Coalesce(Sum('total_price'), Decimal('0.00'))
-        )['s']
-
-        # Service sales
-        service_items = BillItem.objects.filter(bill__in=bills, kind='service')
-        total_service_sale = service_items.aggregate(
-            s=Coalesce(Sum('total_price'), Decimal('0.00'))
-        )['s']
-
-        # By area (district)
-        by_area_qs = (
-            pharm_items
-            .values('bill__patient__district')
-            .annotate(
-                qty=Coalesce(Sum('quantity'), 0),
-                sale=Coalesce(Sum('total_price'), Decimal('0.00')),
-            )
-            .order_by('-sale')
-        )
+    return render(request, 'reports/finance.html', ctx)
 
-        # ---------------- Leads KPIs ----------------
-        # NOTE: if your Lead model uses a different created field,
-        # change created_at -> created / created_on etc.
-        leads_qs = Lead.objects.all()
-        leads_qs = apply_date_range(leads_qs, 'created_at', start, end)
-
-        total_leads = leads_qs.count()
-        leads_converted = leads_qs.filter(converted_patient__isnull=False).count()
-        leads_open = leads_qs.filter(converted_patient__isnull=True).count()
-        lead_conversion_rate = (Decimal(leads_converted) / total_leads * Decimal('100.0')) if total_leads else Decimal('0.00')
-
-        ctx['by_area'] = list(by_area_qs)
-        ctx['summary'] = {
-            'period': f"{start.strftime('%d-%b-%Y')} to {end.strftime('%d-%b-%Y')}",
-            'area': 'All',
-
-            'total_billed': total_billed,
-            'total_collection': total_collection,
-            'total_expenses': total_expenses,
-            'net': total_collection - total_expenses,
-            'total_medicine_sale': total_medicine_sale,
-            'total_service_sale': total_service_sale,
-
-            # Leads
-            'total_leads': total_leads,
-            'leads_converted': leads_converted,
-            'leads_open': leads_open,
-            'lead_conversion_rate': lead_conversion_rate,  # percent
-        }
 
+@require_GET
+@group_required('OperationsManager','Doctor')
+def report_job_status(request, pk):
+    """Progress of a background report, polled by the report page."""
+    job = get_object_or_404(ReportJob, pk=pk)
+    data = {
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'progress': job.progress,
+        'error': job.error if job.status == 'failed' else '',
+    }
+    if job.status == 'done':
+        data['files'] = {fmt: reverse('report_job_file', args=[job.pk, fmt]) for fmt in ARTIFACTS}
+    return JsonResponse(data)
 
-    return render(request, 'reports/finance.html', ctx)
+
+@require_GET
+@group_required('OperationsManager','Doctor')
+def report_job_file(request, pk, fmt):
+    """A finished report as HTML (opened in the browser) or CSV (downloaded)."""
+    job = get_object_or_404(ReportJob, pk=pk, status='done')
+    if fmt not in ARTIFACTS:
+        raise Http404("Unknown format")
+    path = artifact_path(job, fmt)
+    if not path.exists():
+        raise Http404("Report file is no longer available")
+    _, content_type = ARTIFACTS[fmt]
+    period = f"{job.params.get('start')}_{job.params.get('end')}"
+    return FileResponse(open(path, 'rb'), content_type=content_type,
+                        as_attachment=(fmt == 'csv'), filename=f"finance_{period}.{fmt}")
+
+
+AGING_PAGE_SIZE = 50
+AGING_EXPORT_HEADER = ['File No', 'Patient', 'Phone'] + [label for _, label, _ in AGING_BUCKETS] + [
+    'Total Due', 'Unpaid Bills', 'Oldest Unpaid Bill']
+
+
+@group_required('OperationsManager','Doctor')
+def receivables_aging(request):
+    """
+    Outstanding dues per patient by age of the bill (0-30, 31-60, 61-90, 90+
+    days), largest first, keyset paginated; ?format=csv|xlsx downloads all rows.
+    """
+    search = (request.GET.get('q') or '').strip()
+    bucket = request.GET.get('bucket') or ''
+    rows = aging_by_patient(search=search, bucket=bucket)
+
+    fmt = request.GET.get('format')
+    if fmt:
+        if fmt not in ('csv', 'xlsx'):
+            return HttpResponseBadRequest("Unknown export format.")
+        columns = ['patient__file_number', 'patient__name', 'patient__phone_number'] + [
+            column for column, _, _ in AGING_BUCKETS] + ['total', 'bills', 'oldest']
+        export = rows.order_by(*AGING_ORDERING).values_list(*columns).iterator(chunk_size=2000)
+        try:
+            return spreadsheet_response(fmt, f"receivables-aging-{timezone.localdate().isoformat()}",
+                                        AGING_EXPORT_HEADER, export, sheet_title="Receivables aging")
+        except ImportError:
+            return HttpResponseBadRequest("XLSX export needs openpyxl; use format=csv.")
+
+    page = keyset_page(rows, AGING_ORDERING,
+                       after=request.GET.get('after'), before=request.GET.get('before'),
+                       per_page=AGING_PAGE_SIZE)
+    for row in page.items:
+        row['buckets'] = [row[column] for column, _, _ in AGING_BUCKETS]
+
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+    export_params = params.copy()
+    export_params.pop('format', None)
+
+    totals = aging_totals(rows)
+    ctx = {
+        'rows': page.items,
+        'page': page,
+        'page_query': params.urlencode(),
+        'export_query': export_params.urlencode(),
+        'buckets': AGING_BUCKETS,
+        'bucket_totals': [totals[f'sum_{column}'] for column, _, _ in AGING_BUCKETS],
+        'totals': totals,
+        'selected': {'q': search, 'bucket': bucket},
+        'today': timezone.localdate(),
+    }
+    return render(request, 'reports/receivables_aging.html', ctx)
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
@@ -2669,27 +2701,65 @@ def _sync_user_role_group(user):
         user.groups.add(g)
 
 
-def public_bill_view(request, uuid):
-    bill = get_object_or_404(Bill, id=uuid)
-    items = bill.items.all()
-    subtotal = sum(item.total_price for item in items)
+def _serve_cached_receipt(bill_id):
+    path = cached_receipt_path(bill_id)
+    if path is None:
+        raise Http404("Bill not found")
+    return FileResponse(open(path, 'rb'), content_type='text/html; charset=utf-8')
 
-    # Compute paid amount
-    payments = bill.payments.order_by('date')
-    paid = sum(p.amount for p in payments)
-    balance_for_this_bill = max(0, bill.total_amount - paid)
 
-    # Get last payment method
-    last_payment = payments.last()
-    method_display = last_payment.get_method_display() if last_payment else ''
+@group_required('Receptionist','OperationsManager','Doctor','PharmacyManager')
+def bill_receipt_print(request, pk):
+    """Print-ready receipt, rendered once per bill version and served from disk."""
+    return _serve_cached_receipt(pk)
 
-    return render(request, 'bills/public_receipt.html', {
-        'bill': bill,
-        'items': items,
-        'subtotal': subtotal,
-        'paid': paid,
-        'balance_for_this_bill': balance_for_this_bill,
-        'method_display': method_display,  # <-- add this
-    })
+
+# A snapshot URL never changes content, so proxies and browsers may keep it for good
+SNAPSHOT_MAX_AGE = 60 * 60 * 24 * 365
+
+
+def public_bill_view(request, uuid):
+    """
+    Link sent to patients. Redirects to the immutable snapshot of the bill's
+    current version; the redirect itself may be cached briefly.
+    """
+    version = bill_receipt_version(uuid)
+    if version is None:
+        raise Http404("Bill not found")
+    response = redirect('public_bill_snapshot', uuid=uuid, version=version)
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+@require_GET
+def public_bill_snapshot(request, uuid, version):
+    """
+    One version of a receipt. Conditional requests are answered with 304 and
+    snapshots already on disk are served as files, both without any query;
+    the database is only read when the file has to be rendered or the version
+    is outdated (then we redirect to the current one).
+    """
+    last_modified = version_last_modified(version)
+    if last_modified is None:
+        raise Http404("Unknown receipt version")
+    etag = quote_etag(version)
+    modified = int(last_modified.timestamp())  # HTTP dates have whole seconds
+
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+    if response is None:
+        path = snapshot_path(uuid, version)
+        if path is None:
+            current = bill_receipt_version(uuid)
+            if current is None:
+                raise Http404("Bill not found")
+            if current != version:
+                return redirect('public_bill_snapshot', uuid=uuid, version=current)
+            path = cached_receipt_path(uuid, current)
+        response = FileResponse(open(path, 'rb'), content_type='text/html; charset=utf-8')
+
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(modified)
+    patch_cache_control(response, public=True, max_age=SNAPSHOT_MAX_AGE, immutable=True)
+    return response
 
 
@@ -61,6 +61,16 @@ DATABASES = {
     }
 }
 
+# Dashboard KPIs and their invalidation counters (core/kpis.py). With more than
+# one worker process this must be a shared backend (Redis, Memcached, database).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+KPI_CACHE_TIMEOUT = 300
+
 
 AUTH_USER_MODEL = 'core.User'
 
@@ -101,6 +111,12 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Rendered receipts, one file per bill version (see core/receipts.py)
+RECEIPT_CACHE_DIR = BASE_DIR / 'receipt_cache'
+
+# Files of background reports (see core/report_jobs.py)
+REPORT_CACHE_DIR = BASE_DIR / 'report_cache'
+
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -136,7 +152,7 @@ JAZZMIN_SETTINGS = {
         # User Management
         "core.user": "fas fa-user-md",
         "core.userprofile": "fas fa-user-cog",
-        "core.employeeidsequence": "fas fa-id-card",
+        "core.documentsequence": "fas fa-id-card",
 
         # Patients
         "core.patient": "fas fa-user-injured",
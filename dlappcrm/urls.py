@@ -20,12 +20,14 @@ urlpatterns = [
     # dashboard
     path('', v.dashboard, name='home'),
     path('dashboard/', v.dashboard, name='dashboard'),
+    path('dashboard/widgets/<slug:name>/', v.dashboard_widget, name='dashboard_widget'),
 
     # patients
     path('patients/', v.patient_list, name='patient_list'),
     path('patients/new/', v.patient_create, name='patient_create'),
     path('patients/<uuid:pk>/edit/', v.patient_update, name='patient_update'),
     path('patients/<uuid:pk>/', v.patient_detail, name='patient_detail'),
+    path('patients/<uuid:pk>/sections/<slug:section>/', v.patient_detail_section, name='patient_detail_section'),
 
     # medical history
     path('patients/<uuid:patient_id>/history/new/', v.medical_history_create, name='medical_history_create'),
@@ -42,6 +44,7 @@ urlpatterns = [
     # followups & photos
     path('patients/<uuid:patient_id>/followups/new/', v.followup_create, name='followup_create'),
     path('followups/<uuid:pk>/edit/', v.followup_update, name='followup_update'),
+    path('followups/worklist/', v.followup_worklist, name='followup_worklist'),
     path('patients/<uuid:patient_id>/photos/new/', v.progress_photo_create, name='progress_photo_create'),
 
     # appointments
@@ -57,18 +60,24 @@ urlpatterns = [
     # billing
     path('bills/service/',  v.service_bill_list,  name='service_bill_list'),
     path('bills/pharmacy/', v.pharmacy_bill_list, name='pharmacy_bill_list'),
+    path('bills/service/export/', v.bill_export, {'bill_type': 'service'}, name='service_bill_export'),
+    path('bills/pharmacy/export/', v.bill_export, {'bill_type': 'pharmacy'}, name='pharmacy_bill_export'),
     path('bills/new/service/', v.service_bill_create, name='service_bill_create'),
     path('bills/new/pharmacy/', v.pharmacy_bill_create, name='pharmacy_sale_create'), 
     path('bills/<uuid:pk>/edit/service/', v.service_bill_edit, name='service_bill_edit'),
     path('bills/<uuid:pk>/edit/pharmacy/', v.pharmacy_bill_edit, name='pharmacy_sale_edit'),    
     path('bills/<uuid:pk>/receipt/', v.bill_receipt, name='bill_receipt'),
+    path('bills/<uuid:pk>/receipt/print/', v.bill_receipt_print, name='bill_receipt_print'),
     path("api/patients/<uuid:patient_id>/bills/", v.patient_previous_bills, name="patient_previous_bills"),
+    path("api/patients/search/", v.patient_autocomplete, name="patient_autocomplete"),
+    path("api/patients/<uuid:patient_id>/timeline/", v.patient_timeline, name="patient_timeline"),
 
     path('bills/<uuid:pk>/delete/', v.bill_delete, name='bill_delete'),
     path('bills/service/<uuid:pk>/delete/', v.service_bill_delete, name='service_bill_delete'),
     path('bills/pharmacy/<uuid:pk>/delete/', v.pharmacy_bill_delete, name='pharmacy_bill_delete'),
     
    path('bill/view/<uuid:uuid>/', v.public_bill_view, name='public_bill_view'),
+   path('bill/view/<uuid:uuid>/<str:version>/', v.public_bill_snapshot, name='public_bill_snapshot'),
 
 
     # pharmacy
@@ -86,6 +95,9 @@ urlpatterns = [
 
     # Finance report
     path('reports/finance/', v.finance_report, name='finance_report'),
+    path('reports/receivables/', v.receivables_aging, name='receivables_aging'),
+    path('reports/jobs/<uuid:pk>/', v.report_job_status, name='report_job_status'),
+    path('reports/jobs/<uuid:pk>/<str:fmt>/', v.report_job_file, name='report_job_file'),
 
     # leads
     path('leads/', v.lead_list, name='lead_list'),